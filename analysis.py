@@ -1,12 +1,17 @@
-import duckdb
 import logging
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+from approximate import ANALYSIS_MODE, aggregate_sql
+from charts import render_charts
+from database import connect
+from instrument import flush_metrics
+from manifest import get_fingerprint, set_fingerprint
+from result_cache import cached_query, table_version
+from services import ENABLED_SERVICES
 
 logging.basicConfig(
     level=logging.INFO, 
     format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='load.log',
+    filename='analysis.log',
     filemode='a',
     force=True
 )
@@ -22,303 +27,176 @@ def flush_logs():
     for handler in logger.handlers:
         handler.flush()
 
+# Time dimensions reported as most/least carbon heavy on average
+DIMENSIONS = {
+    'hour_of_day': 'hour of day',
+    'day_of_week': 'day of week',
+    'week_of_year': 'week of year',
+    'month_of_year': 'month of year',
+}
+
+# Trip-level distribution of each service, which the cube cannot answer.
+# ANALYSIS_MODE=exact scans trips_transform; the default, approximate, reads
+# the stratified samples and reports each estimate with its 95% interval.
+TRIP_MEASURES = {
+    'trips': ('count', None),
+    'avg_co2_kg': ('mean', 'trip_co2_kgs'),
+    'median_co2_kg': ('quantile', 'trip_co2_kgs', 0.5),
+    'p90_co2_kg': ('quantile', 'trip_co2_kgs', 0.9),
+    'avg_distance': ('mean', 'trip_distance'),
+    'avg_mph': ('mean', 'avg_mph'),
+    'vendors': ('distinct', 'vendor_id'),
+}
+
+# Anomalous days of the daily emissions series reported per service
+RECENT_ANOMALIES = 5
+
+# Tables every analysis result is derived from; their version keys the cube
+# and the cached results
+CUBE_SOURCES = ['trip_rollup_hourly', 'trip_rollup_daily']
+
+def build_emissions_cube(con):
+    # sum/count/min/max of trip_co2_kgs for every service x time dimension
+    # (plus year and an all-trips total holding the single largest trip), rolled
+    # up from the hourly/daily rollup tables that transform.py keeps current.
+    # Every question below is answered from this small table, so analysis never
+    # scans the trip tables.
+    dimensions = list(DIMENSIONS) + ['trip_year']
+    dimension_name = " ".join(f"WHEN GROUPING({d}) = 0 THEN '{d}'" for d in dimensions)
+    dimension_value = ", ".join(f"{d}::VARCHAR" for d in dimensions)
+    grouping_sets = ", ".join(f"(service_type, {d})" for d in dimensions)
+    con.execute(f"""
+    CREATE OR REPLACE TABLE emissions_cube AS
+    WITH hourly AS (
+        SELECT service_type, hour_of_day,
+               dayname(trip_date) AS day_of_week,
+               week(trip_date) AS week_of_year,
+               month(trip_date) AS month_of_year,
+               year(trip_date) AS trip_year,
+               trip_count, co2_kg_sum, co2_kg_min, co2_kg_max
+        FROM trip_rollup_hourly
+    ),
+    largest AS (
+        SELECT service_type, arg_max(largest_trip, largest_trip.trip_co2_kgs) AS largest_trip
+        FROM trip_rollup_daily
+        GROUP BY service_type
+    )
+    SELECT c.*, CASE WHEN c.dimension = 'all' THEN l.largest_trip END AS largest_trip
+    FROM (
+        SELECT service_type,
+               CASE {dimension_name} ELSE 'all' END AS dimension,
+               coalesce({dimension_value}) AS dimension_value,
+               SUM(co2_kg_sum) AS sum_co2_kg,
+               SUM(trip_count) AS trip_count,
+               MIN(co2_kg_min) AS min_co2_kg,
+               MAX(co2_kg_max) AS max_co2_kg
+        FROM hourly
+        GROUP BY GROUPING SETS ({grouping_sets}, (service_type))
+    ) c
+    LEFT JOIN largest l USING (service_type);
+    """)
+
+def refresh_emissions_cube(con):
+    # Rebuild the cube only when the rollups changed since it was built
+    version = table_version(con, CUBE_SOURCES)
+    exists = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'emissions_cube';").fetchone()[0]
+    if exists and get_fingerprint(con, 'emissions_cube') == version:
+        return False
+    build_emissions_cube(con)
+    set_fingerprint(con, 'emissions_cube', version)
+    return True
+
+def report_emissions(con, services=ENABLED_SERVICES):
+    if refresh_emissions_cube(con):
+        logger.info("Built emissions cube")
+    else:
+        logger.info("Emissions cube is up to date")
+    flush_logs()
+    version = table_version(con, CUBE_SOURCES)
+
+    for service in services:
+        # largest carbon producing trip
+        result = cached_query(con, """
+            SELECT service_type, unnest(largest_trip)
+            FROM emissions_cube
+            WHERE service_type = ? AND dimension = 'all'
+        """, [service], version=version)
+        logger.info(f"Largest carbon producing trips for {service} taxi:")
+        logger.info(result.to_dict(orient='records'))
+        flush_logs()
+
+        # on average most carbon heavy and light hour, day, week and month
+        for dimension, label in DIMENSIONS.items():
+            for heading, order in (('Most', 'DESC'), ('Least', 'ASC')):
+                result = cached_query(con, f"""
+                    SELECT service_type, dimension_value AS {dimension}, sum_co2_kg / trip_count AS avg_co2_kg
+                    FROM emissions_cube
+                    WHERE service_type = ? AND dimension = '{dimension}'
+                    ORDER BY avg_co2_kg {order}
+                    LIMIT 1;
+                """, [service], version=version)
+                logger.info(f"{heading} Carbon Heavy by {label} for {service} taxi:")
+                logger.info(result.to_dict(orient='records'))
+                flush_logs()
+
+    # Trip distribution per service, exact or estimated from the samples
+    trip_version = table_version(con, ['trips_transform', 'trip_samples'])
+    for service in services:
+        result = cached_query(con, aggregate_sql(TRIP_MEASURES, where=f"service_type = '{service}'", mode=ANALYSIS_MODE),
+                              version=trip_version)
+        logger.info(f"Trip distribution for {service} taxi ({ANALYSIS_MODE}):")
+        for record in result.to_dict(orient='records'):
+            for name in TRIP_MEASURES:
+                value, interval = record[name], record[f"{name}_ci"]
+                # NaN intervals (quantiles, distinct counts) have no bound to print
+                bound = f" ± {interval:.3g}" if interval == interval and interval else ""
+                logger.info(f"  {name}: {value:.6g}{bound}")
+        flush_logs()
+
+    # Latest day of the daily emissions series and its most recent anomalies
+    series_version = table_version(con, ['emissions_daily_series'])
+    for service in services:
+        latest = cached_query(con, """
+            SELECT trip_date, co2_kg, co2_7d_mean, co2_28d_mean, co2_yoy_change
+            FROM emissions_daily_series
+            WHERE service_type = ?
+            ORDER BY trip_date DESC
+            LIMIT 1;
+        """, [service], version=series_version)
+        logger.info(f"Latest day of the {service} emissions series:")
+        logger.info(latest.to_dict(orient='records'))
+        anomalies = cached_query(con, f"""
+            SELECT trip_date, trips, co2_kg, co2_28d_mean, co2_zscore, count(*) OVER () AS anomalous_days
+            FROM emissions_daily_series
+            WHERE service_type = ? AND anomaly
+            ORDER BY trip_date DESC
+            LIMIT {RECENT_ANOMALIES};
+        """, [service], version=series_version)
+        total = int(anomalies['anomalous_days'].iloc[0]) if len(anomalies) else 0
+        logger.info(f"{total} anomalous days for {service} taxi, most recent:")
+        logger.info(anomalies.drop(columns='anomalous_days').to_dict(orient='records'))
+        flush_logs()
+
+    # Visualizations, drawn only when their data changed
+    rendered, skipped = render_charts(con, services)
+    for path in rendered:
+        logger.info(f"Saved visualization: {path}")
+    if skipped:
+        logger.info(f"Visualizations up to date: {', '.join(skipped)}")
+    flush_logs()
+
 def analyze_data():
     con = None
 
     try:
         # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
+        con = connect(stage='analysis')
         logger.info("Connected to DuckDB instance")
         flush_logs()
 
-        # largest carbon producing trip
-        result1 = con.execute("""
-            SELECT 'yellow' AS service_type, VendorID, tpep_pickup_datetime AS pickup_datetime, tpep_dropoff_datetime AS dropoff_datetime, trip_distance, trip_co2_kgs
-            FROM yellow_tripdata_transform
-            ORDER BY trip_co2_kgs DESC
-            LIMIT 1
-        """).fetchdf()
-        logger.info("Largest carbon producing trips for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT 'green' AS service_type, VendorID, lpep_pickup_datetime AS pickup_datetime, lpep_dropoff_datetime AS dropoff_datetime, trip_distance, trip_co2_kgs
-            FROM green_tripdata_transform
-            ORDER BY trip_co2_kgs DESC
-            LIMIT 1
-        """).fetchdf()
-        logger.info("Largest carbon producing trips for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        # on average most carbon heavy and light of the day
-        result1 = con.execute("""
-            SELECT service_type, hour_of_day, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, hour_of_day, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, hour_of_day
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-            """).fetchdf()
-        logger.info("Most Carbon Heavy by yellow taxi by hour of day:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result1 = con.execute("""
-            SELECT service_type, hour_of_day, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, hour_of_day, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, hour_of_day
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-            """).fetchdf()
-        logger.info("Least Carbon Heavy by yellow taxi by hour of day:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type, hour_of_day, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, hour_of_day, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, hour_of_day
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-            """).fetchdf()
-        logger.info("Average CO2 emissions by green taxi by hour of day:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type, hour_of_day, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, hour_of_day, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, hour_of_day
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-            """).fetchdf()
-        logger.info("Average CO2 emissions by green taxi by hour of day:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()        
-
-        # on average most carbon heavy and light of the week
-        result1 = con.execute("""
-            SELECT service_type,  day_of_week , AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type,  day_of_week , trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type,  day_of_week 
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by day of week for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result1 = con.execute("""
-            SELECT service_type,  day_of_week , AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type,  day_of_week , trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type,  day_of_week 
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by day of week for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type,  day_of_week , AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type,  day_of_week , trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type,  day_of_week 
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by day of week for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type,  day_of_week , AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type,  day_of_week , trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type,  day_of_week 
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by day of week for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
+        report_emissions(con)
+        flush_metrics(con)
 
-        # on average most carbon heavy and light of the month
-        result1 = con.execute("""
-            SELECT service_type, week_of_year, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, week_of_year, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, week_of_year
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by week of year for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result1 = con.execute("""
-            SELECT service_type, week_of_year, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, week_of_year, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, week_of_year
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by week of year for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()         
-
-        result2 = con.execute("""
-            SELECT service_type, week_of_year, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, week_of_year, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, week_of_year
-            ORDER BY avg_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by week of year for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type, week_of_year, AVG(trip_co2_kgs) AS avg_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, week_of_year, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, week_of_year
-            ORDER BY avg_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by week of year for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        # total emissions by year
-        result1 = con.execute("""
-            SELECT service_type, month_of_year, AVG(trip_co2_kgs) AS total_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, month_of_year, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, month_of_year
-            ORDER BY total_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by year for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result1 = con.execute("""
-            SELECT service_type, month_of_year, AVG(trip_co2_kgs) AS total_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, month_of_year, trip_co2_kgs
-                FROM yellow_tripdata_transform
-            )
-            GROUP BY service_type, month_of_year
-            ORDER BY total_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by year for yellow taxi:")
-        logger.info(result1.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type, month_of_year, AVG(trip_co2_kgs) AS total_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, month_of_year, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, month_of_year
-            ORDER BY total_co2_kg DESC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Most Carbon Heavy by year for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        result2 = con.execute("""
-            SELECT service_type, month_of_year, AVG(trip_co2_kgs) AS total_co2_kg
-            FROM (
-                SELECT 'green' AS service_type, month_of_year, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, month_of_year
-            ORDER BY total_co2_kg ASC
-            LIMIT 1;
-        """).fetchdf()
-        logger.info("Least Carbon Heavy by year for green taxi:")
-        logger.info(result2.to_dict(orient='records'))
-        flush_logs()
-
-        # Visualizations
-
-        # Time series CO2
-
-	        # Visualizations
-
-        # Time series CO2
-        df = con.execute("""
-            SELECT service_type, trip_year, SUM(trip_co2_kgs) AS total_co2_kg
-            FROM (
-                SELECT 'yellow' AS service_type, EXTRACT(YEAR FROM tpep_pickup_datetime) AS trip_year, trip_co2_kgs
-                FROM yellow_tripdata_transform
-                UNION ALL
-                SELECT 'green' AS service_type, EXTRACT(YEAR FROM lpep_pickup_datetime) AS trip_year, trip_co2_kgs
-                FROM green_tripdata_transform
-            )
-            GROUP BY service_type, trip_year
-            ORDER BY trip_year;
-        """).fetchdf()
-
-        plt.figure(figsize=(10, 6))
-        for service_type, group in df.groupby("service_type"):
-            plt.plot(
-                group["trip_year"].to_numpy(),
-                group["total_co2_kg"].to_numpy(),
-                marker="o",
-                label=service_type
-            )
-
-        plt.title("Total CO2 Emissions by Year")
-        plt.xlabel("Year")
-        plt.ylabel("Total CO2 Emissions (kg)")
-        plt.legend(title="Service Type")
-        plt.grid(True, linestyle="--", alpha=0.6)
-        plt.savefig("total_co2_emissions_by_year.png")
-        plt.close()
-        logger.info("Saved visualization: total_co2_emissions_by_year.png")
-        flush_logs()
-        
     except Exception as e:
         logger.error(f"Error during data analysis: {e}")
         flush_logs()
@@ -0,0 +1,147 @@
+from database import DATABASE, connect
+from services import ENABLED_SERVICES, pickup_range_sql
+
+# Programmatic access to the emissions results as Arrow. Every function runs
+# one query against the rollups (or trips_transform for trip-level results)
+# and hands DuckDB's Arrow output straight back: a pyarrow.Table by default,
+# or a pyarrow.RecordBatchReader that streams batch_size rows at a time when
+# batch_size is given. No pandas is involved, and columns are cast to fixed
+# types so the schemas do not drift with the storage layout.
+#
+#   import api
+#   con = api.open_results()
+#   api.hourly_emissions(con, ['yellow']).to_pylist()
+#   for batch in api.trip_emissions(con, 'green', years=[2024]):
+#       ...
+
+DEFAULT_BATCH_ROWS = 1_000_000
+
+def open_results(database=DATABASE):
+    # Read-only, so consumers can read while no stage is writing
+    return connect(database, read_only=True)
+
+def service_filter(services):
+    return f"service_type::VARCHAR IN ({', '.join(repr(s) for s in services)})"
+
+def arrow_result(con, sql, batch_size=None):
+    result = con.execute(sql)
+    return result.to_arrow_reader(batch_size) if batch_size else result.to_arrow_table()
+
+def hourly_emissions(con, services=ENABLED_SERVICES, batch_size=None):
+    # service_type, hour_of_day, trips, total_co2_kg, avg_co2_kg
+    return arrow_result(con, f"""
+    SELECT service_type::VARCHAR AS service_type, hour_of_day::UTINYINT AS hour_of_day,
+           SUM(trip_count)::BIGINT AS trips, SUM(co2_kg_sum)::DOUBLE AS total_co2_kg,
+           (SUM(co2_kg_sum) / SUM(trip_count))::DOUBLE AS avg_co2_kg
+    FROM trip_rollup_hourly
+    WHERE {service_filter(services)}
+    GROUP BY ALL
+    ORDER BY ALL;
+    """, batch_size)
+
+def weekday_emissions(con, services=ENABLED_SERVICES, batch_size=None):
+    # service_type, iso_weekday (1 = Monday), day_of_week, trips, total_co2_kg, avg_co2_kg
+    return arrow_result(con, f"""
+    SELECT service_type::VARCHAR AS service_type, isodow(trip_date)::UTINYINT AS iso_weekday, dayname(trip_date) AS day_of_week,
+           SUM(trip_count)::BIGINT AS trips, SUM(co2_kg_sum)::DOUBLE AS total_co2_kg,
+           (SUM(co2_kg_sum) / SUM(trip_count))::DOUBLE AS avg_co2_kg
+    FROM trip_rollup_daily
+    WHERE {service_filter(services)}
+    GROUP BY ALL
+    ORDER BY ALL;
+    """, batch_size)
+
+def monthly_emissions(con, services=ENABLED_SERVICES, batch_size=None):
+    # service_type, trip_month (first day of the month), trips, total_co2_kg,
+    # avg_co2_kg, total_distance
+    return arrow_result(con, f"""
+    SELECT service_type::VARCHAR AS service_type, date_trunc('month', trip_date)::DATE AS trip_month,
+           SUM(trip_count)::BIGINT AS trips, SUM(co2_kg_sum)::DOUBLE AS total_co2_kg,
+           (SUM(co2_kg_sum) / SUM(trip_count))::DOUBLE AS avg_co2_kg, SUM(distance_sum)::DOUBLE AS total_distance
+    FROM trip_rollup_daily
+    WHERE {service_filter(services)}
+    GROUP BY ALL
+    ORDER BY ALL;
+    """, batch_size)
+
+def yearly_totals(con, services=ENABLED_SERVICES, batch_size=None):
+    # service_type, trip_year, trips, total_co2_kg
+    return arrow_result(con, f"""
+    SELECT service_type::VARCHAR AS service_type, year(trip_date)::SMALLINT AS trip_year,
+           SUM(trip_count)::BIGINT AS trips, SUM(co2_kg_sum)::DOUBLE AS total_co2_kg
+    FROM trip_rollup_daily
+    WHERE {service_filter(services)}
+    GROUP BY ALL
+    ORDER BY ALL;
+    """, batch_size)
+
+def series_columns(key):
+    return f"""service_type::VARCHAR AS service_type, {key}, trips::BIGINT AS trips, co2_kg::DOUBLE AS co2_kg,
+           co2_7d_mean::DOUBLE AS co2_7d_mean, co2_28d_mean::DOUBLE AS co2_28d_mean,
+           co2_zscore::DOUBLE AS co2_zscore, anomaly::BOOLEAN AS anomaly,
+           co2_yoy_delta::DOUBLE AS co2_yoy_delta, co2_yoy_change::DOUBLE AS co2_yoy_change"""
+
+def daily_series(con, services=ENABLED_SERVICES, batch_size=None):
+    # service_type, trip_date, trips, co2_kg, co2_7d_mean, co2_28d_mean,
+    # co2_zscore, anomaly, co2_yoy_delta, co2_yoy_change (see timeseries.py)
+    return arrow_result(con, f"""
+    SELECT {series_columns('trip_date::DATE AS trip_date')}
+    FROM emissions_daily_series
+    WHERE {service_filter(services)}
+    ORDER BY service_type, trip_date;
+    """, batch_size)
+
+def hourly_series(con, services=ENABLED_SERVICES, batch_size=None):
+    # As daily_series with trip_hour; means and z-scores are per hour of day
+    return arrow_result(con, f"""
+    SELECT {series_columns('trip_hour::TIMESTAMP AS trip_hour')}
+    FROM emissions_hourly_series
+    WHERE {service_filter(services)}
+    ORDER BY service_type, trip_hour;
+    """, batch_size)
+
+def heaviest_trips(con, n=10, services=ENABLED_SERVICES, batch_size=None):
+    # The n trips with the most CO2 per service. The n-th largest daily
+    # maximum in trip_rollup_daily is a lower bound for them (when there are
+    # n days), so only trips above it go through the top-n.
+    return arrow_result(con, f"""
+    WITH bounds AS (
+        SELECT service_type, CASE WHEN count(*) >= {int(n)} THEN min(co2) END AS lower_bound
+        FROM (
+            SELECT service_type, largest_trip.trip_co2_kgs AS co2,
+                   row_number() OVER (PARTITION BY service_type ORDER BY largest_trip.trip_co2_kgs DESC) AS rank
+            FROM trip_rollup_daily
+            WHERE {service_filter(services)}
+        )
+        WHERE rank <= {int(n)}
+        GROUP BY service_type
+    )
+    SELECT t.service_type::VARCHAR AS service_type, t.vendor_id::INTEGER AS vendor_id,
+           t.pickup_datetime, t.dropoff_datetime, t.passenger_count::INTEGER AS passenger_count,
+           t.trip_distance::DOUBLE AS trip_distance, t.trip_co2_kgs::DOUBLE AS trip_co2_kgs
+    FROM trips_transform t
+    JOIN bounds b ON b.service_type = t.service_type::VARCHAR
+    WHERE b.lower_bound IS NULL OR t.trip_co2_kgs >= b.lower_bound
+    QUALIFY row_number() OVER (PARTITION BY t.service_type ORDER BY t.trip_co2_kgs DESC, t.pickup_datetime) <= {int(n)}
+    ORDER BY service_type, trip_co2_kgs DESC, t.pickup_datetime;
+    """, batch_size)
+
+def trip_emissions(con, service, years=None, months=None, start=None, end=None, batch_size=DEFAULT_BATCH_ROWS):
+    # Per-trip emissions of one service, in no particular order so DuckDB can
+    # stream them without a sort. Always a RecordBatchReader: this is the one
+    # result that can be too large to hold at once. years/months select source
+    # files; start/end select pickup times in [start, end), which only reads
+    # the row groups holding them.
+    filters = [f"service_type = '{service}'", pickup_range_sql(start, end)]
+    if years:
+        filters.append(f"source_year IN ({', '.join(str(int(y)) for y in years)})")
+    if months:
+        filters.append(f"source_month IN ({', '.join(str(int(m)) for m in months)})")
+    return arrow_result(con, f"""
+    SELECT source_year::SMALLINT AS source_year, source_month::UTINYINT AS source_month,
+           vendor_id::INTEGER AS vendor_id, pickup_datetime, dropoff_datetime,
+           passenger_count::INTEGER AS passenger_count, trip_distance::DOUBLE AS trip_distance,
+           trip_co2_kgs::DOUBLE AS trip_co2_kgs, avg_mph::DOUBLE AS avg_mph
+    FROM trips_transform
+    WHERE {" AND ".join(filters)};
+    """, batch_size or DEFAULT_BATCH_ROWS)
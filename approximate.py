@@ -0,0 +1,198 @@
+import argparse
+import os
+
+from database import DATABASE, connect
+
+# Exact or approximate trip-level aggregates. An analysis is defined once as
+# a dict of measures, grouping columns and a filter over trips_transform;
+# aggregate_sql() turns it into either an exact scan of trips_transform or an
+# estimate from the stratified samples that samples.py maintains.
+#
+# Measures are (kind, column[, quantile]):
+#   count     trips matching the filter (column ignored)
+#   sum       total of the column
+#   mean      average of the column's non-NULL values
+#   quantile  quantile of the column
+#   distinct  number of distinct values of the column
+#
+# Every measure comes back as <name> plus <name>_ci, the half-width of its
+# confidence interval (0 in exact mode). In approximate mode counts, sums and
+# means are Horvitz-Thompson estimates over the strata, with the stratified
+# variance (means by linearisation of the ratio). Quantiles are read from a
+# t-digest over the samples. Distinct counts use the GEE estimator over the
+# samples: values seen more than once are counted as they are, and values
+# seen exactly once are scaled by sqrt(population / sample rows), since each
+# may stand for several unseen ones. Its ratio error is bounded by that
+# square root, and it is exact for low-cardinality columns such as
+# vendor_id, whose values all show up many times. Neither has a closed-form
+# interval, so their _ci is NULL.
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'approximate')
+MODES = ['exact', 'approximate']
+CONFIDENCE_Z = float(os.environ.get('ANALYSIS_CONFIDENCE_Z', '1.96'))  # 95%
+
+MOMENT_KINDS = ('count', 'sum', 'mean')
+
+def exact_sql(measures, by, where):
+    expressions = {
+        'count': lambda column, *_: "COUNT(*)",
+        'sum': lambda column, *_: f"SUM({column})",
+        'mean': lambda column, *_: f"AVG({column})",
+        'quantile': lambda column, q: f"quantile_cont({column}, {q})",
+        'distinct': lambda column, *_: f"COUNT(DISTINCT {column})",
+    }
+    columns = list(by) + [
+        f"{expressions[kind](*args)} AS {name}, 0.0 AS {name}_ci" for name, (kind, *args) in measures.items()
+    ]
+    return f"""
+    SELECT {", ".join(columns)}
+    FROM trips_transform
+    WHERE {where}
+    {"GROUP BY ALL" if by else ""}
+    {"ORDER BY ALL" if by else ""}
+    """
+
+def stratum_variance(total, squares):
+    # Variance contribution of one stratum to an estimated total, from the
+    # sum and sum of squares of the per-row values over its sample
+    return (f"(stratum_rows * stratum_rows * (1 - sampled_rows / stratum_rows)"
+            f" * ({squares} - ({total}) * ({total}) / sampled_rows) / greatest(sampled_rows - 1, 1) / sampled_rows)")
+
+def join_on(left, right, by):
+    return " AND ".join(f"{left}.{b} IS NOT DISTINCT FROM {right}.{b}" for b in by) or "true"
+
+def approximate_sql(measures, by, where, z=CONFIDENCE_Z):
+    keys = ", ".join(by)
+    select_by = f"{keys}, " if by else ""
+    columns = sorted({args[0] for kind, *args in measures.values() if kind in ('sum', 'mean')})
+    ctes = []
+
+    # Per group and stratum: matching rows and the first two moments of every
+    # column, weighted by the stratum's population over its sample size
+    ctes.append(f"""
+    cells AS (
+        SELECT c.*, st.population::DOUBLE AS stratum_rows, st.sample_rows::DOUBLE AS sampled_rows
+        FROM (
+            SELECT {select_by}service_type::VARCHAR AS stratum_service, source_year AS stratum_year, source_month AS stratum_month,
+                   COUNT(*)::DOUBLE AS rows_d
+                   {"".join(f", COUNT({c})::DOUBLE AS n_{i}, SUM({c}::DOUBLE) AS s_{i}, SUM({c}::DOUBLE * {c}::DOUBLE) AS q_{i}" for i, c in enumerate(columns))}
+            FROM trip_samples
+            WHERE {where}
+            GROUP BY ALL
+        ) c
+        JOIN sample_strata st
+          ON st.service_type = c.stratum_service AND st.source_year = c.stratum_year AND st.source_month = c.stratum_month
+    )""")
+    ctes.append(f"""
+    totals AS (
+        SELECT {select_by}SUM(stratum_rows / sampled_rows * rows_d) AS rows_est, SUM(rows_d) AS sample_d
+               {"".join(f", SUM(stratum_rows / sampled_rows * s_{i}) AS total_{i}, SUM(stratum_rows / sampled_rows * n_{i}) AS count_{i}" for i in range(len(columns)))}
+        FROM cells
+        {"GROUP BY ALL" if by else ""}
+    )""")
+
+    variances = ["SUM(" + stratum_variance("c.rows_d", "c.rows_d") + ") AS var_rows"]
+    for i in range(len(columns)):
+        variances.append("SUM(" + stratum_variance(f"c.s_{i}", f"c.q_{i}") + f") AS var_total_{i}")
+        # the mean is the ratio R = total / count; its variance is that of the
+        # residuals y - R
+        ratio = f"(t.total_{i} / NULLIF(t.count_{i}, 0))"
+        residuals = f"(c.s_{i} - {ratio} * c.n_{i})"
+        squares = f"(c.q_{i} - 2 * {ratio} * c.s_{i} + {ratio} * {ratio} * c.n_{i})"
+        variances.append("SUM(" + stratum_variance(residuals, squares) + f") AS var_residual_{i}")
+    ctes.append(f"""
+    variances AS (
+        SELECT {"".join(f"c.{b}, " for b in by)}{", ".join(variances)}
+        FROM cells c JOIN totals t ON {join_on('c', 't', by)}
+        {"GROUP BY " + ", ".join(f"c.{b}" for b in by) if by else ""}
+    )""")
+
+    sketches = [f"approx_quantile({args[0]}, {args[1]}) AS {name}" for name, (kind, *args) in measures.items() if kind == 'quantile']
+    if sketches:
+        ctes.append(f"""
+    sketches AS (
+        SELECT {select_by}{", ".join(sketches)}
+        FROM trip_samples
+        WHERE {where}
+        {"GROUP BY ALL" if by else ""}
+    )""")
+    # Per distinct measure: values seen in the samples, and those seen once
+    cardinalities = [name for name, (kind, *_) in measures.items() if kind == 'distinct']
+    for name in cardinalities:
+        column = measures[name][1]
+        ctes.append(f"""
+    distinct_{name} AS (
+        SELECT {select_by}COUNT(*)::DOUBLE AS seen, COUNT(*) FILTER (WHERE copies = 1)::DOUBLE AS once
+        FROM (
+            SELECT {select_by}{column}, COUNT(*) AS copies
+            FROM trip_samples
+            WHERE ({where}) AND {column} IS NOT NULL
+            GROUP BY ALL
+        )
+        {"GROUP BY ALL" if by else ""}
+    )""")
+
+    outputs = []
+    for name, (kind, *args) in measures.items():
+        i = columns.index(args[0]) if kind in ('sum', 'mean') else None
+        if kind == 'count':
+            outputs.append(f"t.rows_est AS {name}, {z} * sqrt(v.var_rows) AS {name}_ci")
+        elif kind == 'sum':
+            outputs.append(f"t.total_{i} AS {name}, {z} * sqrt(v.var_total_{i}) AS {name}_ci")
+        elif kind == 'mean':
+            outputs.append(f"t.total_{i} / NULLIF(t.count_{i}, 0) AS {name}, {z} * sqrt(v.var_residual_{i}) / NULLIF(t.count_{i}, 0) AS {name}_ci")
+        elif kind == 'quantile':
+            outputs.append(f"s.{name}, NULL::DOUBLE AS {name}_ci")
+        else:
+            estimate = f"d_{name}.seen - d_{name}.once + d_{name}.once * sqrt(t.rows_est / t.sample_d)"
+            outputs.append(f"least(coalesce({estimate}, 0), t.rows_est) AS {name}, NULL::DOUBLE AS {name}_ci")
+    joins = [f"JOIN variances v ON {join_on('t', 'v', by)}"]
+    if sketches:
+        joins.append(f"LEFT JOIN sketches s ON {join_on('t', 's', by)}")
+    for name in cardinalities:
+        joins.append(f"LEFT JOIN distinct_{name} d_{name} ON {join_on('t', f'd_{name}', by)}")
+    return f"""
+    WITH {",".join(ctes)}
+    SELECT {"".join(f"t.{b}, " for b in by)}{", ".join(outputs)}
+    FROM totals t
+    {" ".join(joins)}
+    {"ORDER BY " + ", ".join(f"t.{b}" for b in by) if by else ""}
+    """
+
+def aggregate_sql(measures, by=(), where='true', mode=ANALYSIS_MODE):
+    if mode not in MODES:
+        raise ValueError(f"Unknown analysis mode {mode}; expected one of {', '.join(MODES)}")
+    for name, (kind, *args) in measures.items():
+        if kind not in MOMENT_KINDS + ('quantile', 'distinct'):
+            raise ValueError(f"Unknown measure kind {kind} for {name}")
+    if mode == 'exact':
+        return exact_sql(measures, by, where)
+    return approximate_sql(measures, by, where)
+
+def aggregate(con, measures, by=(), where='true', mode=ANALYSIS_MODE):
+    return con.execute(aggregate_sql(measures, by, where, mode)).fetchdf()
+
+def parse_measure(text):
+    # name=kind:column[:quantile], e.g. p90=quantile:trip_co2_kgs:0.9
+    name, spec = text.split('=', 1)
+    kind, *args = spec.split(':')
+    if kind == 'quantile':
+        args[1] = float(args[1])
+    return name, (kind, *(args or [None]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact or approximate aggregates over trips_transform")
+    parser.add_argument('--db', default=DATABASE)
+    parser.add_argument('--mode', choices=MODES, default=ANALYSIS_MODE)
+    parser.add_argument('--measure', action='append', type=parse_measure, required=True,
+                        help='name=kind:column[:quantile], e.g. avg_co2=mean:trip_co2_kgs')
+    parser.add_argument('--by', nargs='*', default=[])
+    parser.add_argument('--where', default='true')
+    args = parser.parse_args()
+    con = connect(args.db, read_only=True)
+    try:
+        print(aggregate(con, dict(args.measure), args.by, args.where, args.mode).to_string(index=False))
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import json
+import math
+import time
+
+import duckdb
+
+from approximate import aggregate_sql
+
+# Exact vs approximate mode on an existing database: runs each analysis
+# definition both ways and reports the best time of each, the speedup, the
+# largest relative error of the estimates and how many exact answers fell
+# inside their confidence interval (about 95% is expected).
+#
+#   python -m benchmarks.approximate_analysis --db emissions.duckdb
+
+ANALYSES = {
+    'overall': ({
+        'trips': ('count', None),
+        'total_co2_kg': ('sum', 'trip_co2_kgs'),
+        'avg_co2_kg': ('mean', 'trip_co2_kgs'),
+        'p90_co2_kg': ('quantile', 'trip_co2_kgs', 0.9),
+        'vendors': ('distinct', 'vendor_id'),
+    }, ['service_type']),
+    'by_hour': ({
+        'trips': ('count', None),
+        'avg_co2_kg': ('mean', 'trip_co2_kgs'),
+        'avg_mph': ('mean', 'avg_mph'),
+    }, ['service_type', 'hour_of_day']),
+    'by_month': ({
+        'total_co2_kg': ('sum', 'trip_co2_kgs'),
+        'median_distance': ('quantile', 'trip_distance', 0.5),
+    }, ['service_type', 'source_year', 'month_of_year']),
+}
+
+def best_time(con, sql, repeats):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = con.execute(sql).fetchdf()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def compare(exact, approximate, measures, by):
+    merged = exact.merge(approximate, on=by, suffixes=('', '_est'), how='left')
+    errors = {}
+    covered = checked = 0
+    for name in measures:
+        truth, estimate, interval = merged[name], merged[f"{name}_est"], merged[f"{name}_ci_est"]
+        relative = ((estimate - truth).abs() / truth.abs().where(truth != 0)).max()
+        errors[name] = None if math.isnan(relative) else round(float(relative), 4)
+        bounded = interval.notna()
+        covered += int(((estimate - truth).abs() <= interval)[bounded].sum())
+        checked += int(bounded.sum())
+    return errors, covered, checked
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare exact and approximate analysis modes")
+    parser.add_argument('--db', default='emissions.duckdb', help='database holding trips_transform and trip_samples')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    con = duckdb.connect(args.db, read_only=True)
+    try:
+        report = {
+            'rows': con.execute("SELECT COUNT(*) FROM trips_transform;").fetchone()[0],
+            'sample_rows': con.execute("SELECT COUNT(*) FROM trip_samples;").fetchone()[0],
+        }
+        covered_total = checked_total = 0
+        for name, (measures, by) in ANALYSES.items():
+            exact, exact_seconds = best_time(con, aggregate_sql(measures, by, mode='exact'), args.repeats)
+            approximate, approximate_seconds = best_time(con, aggregate_sql(measures, by, mode='approximate'), args.repeats)
+            errors, covered, checked = compare(exact, approximate, measures, by)
+            covered_total += covered
+            checked_total += checked
+            report[name] = {
+                'groups': len(exact),
+                'exact_seconds': round(exact_seconds, 4),
+                'approximate_seconds': round(approximate_seconds, 4),
+                'speedup': round(exact_seconds / approximate_seconds, 2),
+                'max_relative_error': errors,
+            }
+        report['interval_coverage'] = round(covered_total / checked_total, 3) if checked_total else None
+    finally:
+        con.close()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckdb
+
+from benchmarks.pipeline_stages import REPO, run_stage
+from benchmarks.synthetic import generate
+
+# Build time of trips_transform through dbt against transform.py on the same
+# synthetic trips. Load and clean run once; the cleaned database is then
+# copied and trips_transform is built in each copy, first from scratch and
+# then after one month is marked as re-cleaned, which both paths should
+# rebuild alone. dbt is timed both end to end and for the model alone (its
+# start-up and project parsing take seconds on their own). The two tables are
+# compared row for row at the end.
+#
+# Needs dbt-duckdb (requirements.txt).
+#
+#   python -m benchmarks.dbt_transform --rows 2000000
+
+DBT_PROJECT = os.path.join(REPO, 'dbt')
+
+# transform.py without the rollups and samples, which dbt does not build
+TRANSFORM_ONLY = """
+from database import connect
+from manifest import pending_partitions
+from services import ENABLED_SERVICES
+from transform import prepare_transform, transform_partition
+con = connect()
+prepare_transform(con)
+for service in ENABLED_SERVICES:
+    for year, month in pending_partitions(con, 'transform', service, upstream='clean'):
+        transform_partition(con, service, year, month)
+con.close()
+"""
+
+def timed(command, workdir, db):
+    env = dict(os.environ, PYTHONPATH=REPO, EMISSIONS_DB=db)
+    started = time.perf_counter()
+    child = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    if child.returncode != 0:
+        raise RuntimeError(f"{' '.join(command[:3])} failed:\n{child.stdout[-2000:]}{child.stderr[-2000:]}")
+    return round(seconds, 3)
+
+def dbt(workdir, db, *args):
+    return timed(['dbt', *args, '--project-dir', DBT_PROJECT, '--profiles-dir', DBT_PROJECT,
+                  '--target-path', os.path.join(workdir, 'target'), '--log-path', os.path.join(workdir, 'logs')],
+                 workdir, db)
+
+def model_seconds(workdir, model='trips_transform'):
+    # Execution time of the model itself, without dbt's start-up and parsing
+    with open(os.path.join(workdir, 'target', 'run_results.json')) as f:
+        results = json.load(f)['results']
+    return round(sum(r['execution_time'] for r in results if r['unique_id'].endswith(f".{model}")), 3)
+
+def transform_py(workdir, db):
+    return timed([sys.executable, '-c', TRANSFORM_ONLY], workdir, db)
+
+def reclean_month(db, service, year, month):
+    con = duckdb.connect(db)
+    try:
+        con.execute("""
+        UPDATE stage_progress SET processed_at = now()::TIMESTAMP
+        WHERE stage = 'clean' AND service_type = ? AND source_year = ? AND source_month = ?;
+        """, [service, year, month])
+    finally:
+        con.close()
+
+def differing_rows(left, right):
+    con = duckdb.connect(left, read_only=True)
+    try:
+        con.execute(f"ATTACH '{right}' AS other (READ_ONLY);")
+        return con.execute("""
+        SELECT (SELECT COUNT(*) FROM (SELECT * FROM trips_transform EXCEPT ALL SELECT * FROM other.trips_transform))
+             + (SELECT COUNT(*) FROM (SELECT * FROM other.trips_transform EXCEPT ALL SELECT * FROM trips_transform));
+        """).fetchone()[0]
+    finally:
+        con.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dbt and transform.py build times of trips_transform")
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--years', type=int, nargs='+', default=[2024])
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = {'rows': args.rows, 'years': args.years, 'months': args.months}
+    workdir = tempfile.mkdtemp(prefix='dbt-bench-')
+    try:
+        shutil.copytree(os.path.join(REPO, 'data'), os.path.join(workdir, 'data'))
+        data = os.path.join(workdir, 'trip-data')
+        generate(data, args.rows, args.years, args.months)
+        cleaned = os.path.join(workdir, 'emissions.duckdb')
+        for stage in ('load', 'clean'):
+            run_stage(workdir, stage, data, args.years, args.months)
+
+        python_db = os.path.join(workdir, 'python.duckdb')
+        dbt_db = os.path.join(workdir, 'dbt.duckdb')
+        shutil.copy(cleaned, python_db)
+        shutil.copy(cleaned, dbt_db)
+        dbt(workdir, dbt_db, 'seed')
+
+        report['full_build'] = {'transform.py': transform_py(workdir, python_db), 'dbt': dbt(workdir, dbt_db, 'run')}
+        report['full_build']['dbt_model'] = model_seconds(workdir)
+        month = (args.years[-1], args.months[-1])
+        for db in (python_db, dbt_db):
+            reclean_month(db, 'yellow', *month)
+        report['one_month'] = {'transform.py': transform_py(workdir, python_db), 'dbt': dbt(workdir, dbt_db, 'run')}
+        report['one_month']['dbt_model'] = model_seconds(workdir)
+        report['differing_rows'] = differing_rows(python_db, dbt_db)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
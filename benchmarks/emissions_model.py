@@ -0,0 +1,66 @@
+import argparse
+import json
+import time
+
+import duckdb
+
+from emissions import ensure_vehicle_emissions
+from services import ensure_service_type
+from transform import transform_source_sql, DERIVED_COLUMNS
+
+# Compares the speed-aware emissions model used by transform.py with the old
+# flat trip_distance * co2_grams_per_mile multiply, over the same joined trips.
+# Trips come from an existing database's trips_clean (--db) or are generated
+# in memory (--rows).
+#
+#   python -m benchmarks.emissions_model --rows 50000000
+
+FLAT_SQL = "trip_distance * co2_grams_per_mile / 1000.0"
+
+def synthetic_trips(con, rows):
+    con.execute(f"""
+    CREATE TABLE trips_clean AS
+    SELECT (CASE WHEN i % 5 = 0 THEN 'green' ELSE 'yellow' END)::service_type AS service_type,
+           TIMESTAMP '2024-01-01' + to_seconds(i % 31536000) AS pickup_datetime,
+           TIMESTAMP '2024-01-01' + to_seconds(i % 31536000 + 120 + (i * 7919) % 3600) AS dropoff_datetime,
+           0.1 + (i * 104729 % 300) / 10.0 AS trip_distance
+    FROM range({rows}) t(i);
+    """)
+
+def best_of(con, sql, repeats):
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        con.execute(sql).fetchall()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the speed-aware emissions model against a flat multiply")
+    parser.add_argument('--db', default=None, help='read trips_clean from this database instead of generating trips')
+    parser.add_argument('--rows', type=int, default=20_000_000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    con = duckdb.connect()
+    ensure_service_type(con)
+    ensure_vehicle_emissions(con)
+    if args.db:
+        con.execute(f"ATTACH '{args.db}' AS src (READ_ONLY);")
+        trips = 'src.trips_clean'
+    else:
+        synthetic_trips(con, args.rows)
+        trips = 'trips_clean'
+    rows = con.execute(f"SELECT COUNT(*) FROM {trips};").fetchone()[0]
+
+    report = {'rows': rows}
+    models = {'flat': FLAT_SQL, 'speed_aware': DERIVED_COLUMNS['trip_co2_kgs'][1]}
+    for name, expression in models.items():
+        seconds = best_of(con, f"SELECT SUM({expression}) FROM ({transform_source_sql('true', trips=trips)}) e;", args.repeats)
+        report[name] = {'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds)}
+    report['overhead'] = round(report['speed_aware']['seconds'] / report['flat']['seconds'], 3)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
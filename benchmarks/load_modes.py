@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import duckdb
+
+from benchmarks.pipeline_stages import REPO, run_stage
+from benchmarks.synthetic import generate
+
+# Load stage throughput in scan mode (one multi-file read_parquet per service
+# and year) against file mode (one read_parquet per month) at several thread
+# counts. Every other month's files are rewritten with drifted column types
+# first, VendorID as INTEGER and passenger_count as DOUBLE with some NaN, as
+# the TLC files do between years, so the report also shows whether any month
+# is lost to a type mismatch. Both modes must load identical trips, with each
+# month in row groups of its own.
+#
+#   python -m benchmarks.load_modes --rows 4000000 --threads 1 2 4 8
+
+NAN_RATE = 0.001
+
+def drift_types(data):
+    # Rewrites every other file; returns how many
+    con = duckdb.connect()
+    drifted = 0
+    try:
+        for index, name in enumerate(sorted(os.listdir(data))):
+            if index % 2 == 0:
+                continue
+            path = os.path.join(data, name)
+            con.execute(f"""
+            COPY (
+                SELECT * REPLACE (VendorID::INTEGER AS VendorID,
+                                  CASE WHEN random() < {NAN_RATE} THEN 'NaN'::DOUBLE ELSE passenger_count::DOUBLE END AS passenger_count)
+                FROM read_parquet('{path}')
+            ) TO '{path}.tmp' (FORMAT parquet);
+            """)
+            os.replace(f"{path}.tmp", path)
+            drifted += 1
+    finally:
+        con.close()
+    return drifted
+
+def load_report(db):
+    # (rows, months in the manifest, row groups of trips holding more than
+    # one month). Appends fill the last row group, so some row groups span a
+    # month boundary in either mode; interleaved months would show as many.
+    con = duckdb.connect(db, read_only=True)
+    try:
+        return con.execute("""
+        SELECT (SELECT COUNT(*) FROM trips),
+               (SELECT COUNT(*) FROM load_manifest),
+               (SELECT COUNT(DISTINCT row_group_id) FROM pragma_storage_info('trips')
+                WHERE column_name IN ('source_year', 'source_month')
+                  AND regexp_extract(stats, 'Min: (\\d+)', 1) <> regexp_extract(stats, 'Max: (\\d+)', 1));
+        """).fetchone()
+    finally:
+        con.close()
+
+def differing_rows(left, right):
+    con = duckdb.connect(left, read_only=True)
+    try:
+        con.execute(f"ATTACH '{right}' AS other (READ_ONLY);")
+        return con.execute("""
+        SELECT (SELECT COUNT(*) FROM (SELECT * FROM trips EXCEPT ALL SELECT * FROM other.trips))
+             + (SELECT COUNT(*) FROM (SELECT * FROM other.trips EXCEPT ALL SELECT * FROM trips));
+        """).fetchone()[0]
+    finally:
+        con.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare scan and file load modes")
+    parser.add_argument('--rows', type=int, default=4_000_000)
+    parser.add_argument('--years', type=int, nargs='+', default=[2023, 2024])
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = {'rows': args.rows, 'years': args.years, 'months': args.months, 'runs': []}
+    workdir = tempfile.mkdtemp(prefix='load-bench-')
+    try:
+        data = os.path.join(workdir, 'trip-data')
+        generate(data, args.rows, args.years, args.months)
+        report['drifted_files'] = drift_types(data)
+        databases = {}
+        for mode in ('file', 'scan'):
+            for threads in dict.fromkeys(args.threads):
+                run_dir = os.path.join(workdir, f"{mode}-{threads}")
+                shutil.copytree(os.path.join(REPO, 'data'), os.path.join(run_dir, 'data'))
+                seconds, peak = run_stage(run_dir, 'load', data, args.years, args.months,
+                                          env={'LOAD_MODE': mode, 'DUCKDB_THREADS': str(threads)})
+                db = os.path.join(run_dir, 'emissions.duckdb')
+                rows, months, mixed = load_report(db)
+                databases[mode] = db
+                run = {
+                    'mode': mode,
+                    'threads': threads,
+                    'seconds': round(seconds, 3),
+                    'rows_per_second': round(rows / seconds),
+                    'peak_rss_mb': round(peak / 2 ** 20, 1),
+                    'months_loaded': months,
+                    'row_groups_spanning_months': mixed,
+                }
+                report['runs'].append(run)
+                print(json.dumps(run))
+        report['months_expected'] = 2 * len(args.years) * len(args.months)
+        report['differing_rows'] = differing_rows(databases['file'], databases['scan'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
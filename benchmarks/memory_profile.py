@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckdb
+
+from manifest import ensure_manifest, record_load
+from services import ensure_service_type, trip_columns_ddl
+
+# Peak memory of the clean stage under a low memory cap, for growing amounts
+# of synthetic trips. Each run cleans a fresh database in a child process with
+# DUCKDB_MEMORY_LIMIT set and reports the child's peak RSS. Months are cleaned
+# one at a time, so peak memory should stay flat as the history grows.
+#
+# A run fails when clean logs an error (clean_data logs and carries on), when
+# not every month was cleaned, or when the peak exceeds the memory limit plus
+# --overhead-mb for the interpreter, pandas and DuckDB allocations outside its
+# buffer manager. Months also repeat trips of the month before, which the
+# fingerprint index has to catch across months.
+#
+#   python -m benchmarks.memory_profile --rows 4000000 16000000 --memory-limit-mb 256
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def synthetic_database(path, rows, months):
+    # Yellow trips spread evenly over `months` months of 2024, ~1% duplicated
+    # within their month and ~0.1% repeated from the month before
+    con = duckdb.connect(path)
+    try:
+        ensure_manifest(con)
+        ensure_service_type(con)
+        con.execute(f"CREATE TABLE trips ({trip_columns_ddl()});")
+        count = rows // months
+        spacing = 28 * 86400 * 10 ** 6 // count   # pickups spread over 28 days
+        for month in range(1, months + 1):
+            con.execute(f"""
+            INSERT INTO trips
+            SELECT 'yellow', 2024, {month}, 1 + i % 2,
+                   TIMESTAMP '2024-{month:02d}-01' + to_microseconds(i * {spacing}),
+                   TIMESTAMP '2024-{month:02d}-01' + to_microseconds(i * {spacing}) + to_seconds(120 + (i * 7919) % 3600),
+                   i % 5, (i * 104729 % 300) / 10.0
+            FROM range({count}) t(j), LATERAL (SELECT CASE WHEN j % 100 = 0 THEN j - 1 ELSE j END AS i);
+            """)
+            if month > 1:
+                con.execute(f"""
+                INSERT INTO trips
+                SELECT * REPLACE ({month}::UTINYINT AS source_month)
+                FROM trips
+                WHERE source_month = {month - 1} AND hash(pickup_datetime) % 1000 = 0;
+                """)
+            record_load(con, 'yellow', 2024, month, 'synthetic', 0, '', count)
+    finally:
+        con.close()
+
+def run_clean(workdir, db, memory_limit):
+    env = dict(os.environ,
+               EMISSIONS_DB=db,
+               DUCKDB_MEMORY_LIMIT=memory_limit,
+               TRIP_SERVICES='yellow',
+               PYTHONPATH=REPO)
+    started = time.perf_counter()
+    child = subprocess.run([sys.executable, '-c', 'import clean; clean.clean_data()'],
+                           cwd=workdir, env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    if child.returncode != 0:
+        raise RuntimeError(child.stderr)
+    # Logged to the console handler, which writes to stderr
+    errors = [line for line in child.stderr.splitlines() if ' - ERROR - ' in line]
+    if errors:
+        raise RuntimeError(f"clean logged errors: {errors}")
+    return seconds
+
+def peak_rss_of_next_child(func, *args):
+    # ru_maxrss of RUSAGE_CHILDREN is the largest child so far, so each run
+    # goes through its own intermediate process
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            seconds = func(*args)
+            peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            os.write(write, json.dumps([seconds, peak, None]).encode())
+        except Exception as e:
+            os.write(write, json.dumps([None, None, str(e)]).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        seconds, peak, error = json.loads(f.read())
+    os.waitpid(pid, 0)
+    if error:
+        raise RuntimeError(error)
+    return seconds, peak * 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of the clean stage under a memory cap")
+    parser.add_argument('--rows', type=int, nargs='+', default=[2_000_000, 8_000_000, 16_000_000])
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--memory-limit-mb', type=int, default=256)
+    parser.add_argument('--overhead-mb', type=int, default=256, help='allowed peak RSS above the memory limit')
+    args = parser.parse_args()
+
+    memory_limit = f"{args.memory_limit_mb}MB"
+    bound_mb = (args.memory_limit_mb * 1000 ** 2 + args.overhead_mb * 2 ** 20) / 2 ** 20
+    report = {'memory_limit': memory_limit, 'peak_bound_mb': round(bound_mb, 1), 'runs': []}
+    failures = []
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, 'emissions.duckdb')
+            synthetic_database(db, rows, args.months)
+            seconds, peak = peak_rss_of_next_child(run_clean, tmp, db, memory_limit)
+            con = duckdb.connect(db, read_only=True)
+            try:
+                clean_rows, cleaned_months, duplicates = con.execute("""
+                SELECT (SELECT COUNT(*) FROM trips_clean),
+                       (SELECT COUNT(*) FROM stage_progress WHERE stage = 'clean'),
+                       (SELECT coalesce(SUM(rejected_rows), 0) FROM trip_quarantine WHERE reject_mask & 1 <> 0);
+                """).fetchone()
+            finally:
+                con.close()
+        run = {
+            'rows': rows,
+            'clean_rows': clean_rows,
+            'duplicates': duplicates,
+            'seconds': round(seconds, 2),
+            'peak_rss_mb': round(peak / 2 ** 20, 1),
+        }
+        report['runs'].append(run)
+        print(json.dumps(run))
+        if cleaned_months != args.months:
+            failures.append(f"{rows} rows: {cleaned_months} of {args.months} months cleaned")
+        if run['peak_rss_mb'] > bound_mb:
+            failures.append(f"{rows} rows: peak RSS {run['peak_rss_mb']} MB above {bound_mb:.1f} MB")
+    print(json.dumps(report, indent=2))
+    if failures:
+        sys.exit("Memory profile failed: " + "; ".join(failures))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+import duckdb
+
+from benchmarks.pipeline_stages import REPO, run_stage
+from benchmarks.synthetic import generate
+from services import PICKUP_ORDER, period_range, pickup_range_sql
+
+# Per-period queries against trips_transform as the pipeline writes it (pickup
+# order within each partition) and against two copies of it: partitions kept
+# together but their rows in file order, and all rows in arbitrary order. Each
+# year is generated with a different number of trips, so a query that prunes
+# shows its rows scanned (and time) following the size of its year, and one
+# that does not follows the size of the table. Every period is filtered both
+# as a pickup range and as year(...)/month(...) = ..., which zone maps cannot
+# use.
+#
+#   python -m benchmarks.pickup_pruning --rows 4000000
+
+LAYOUTS = {
+    'pickup_sorted': None,
+    'file_order': f"ORDER BY {PICKUP_ORDER.replace('pickup_datetime', 'hash(rowid)')}",
+    'arbitrary': "ORDER BY hash(rowid)",
+}
+
+def periods(years):
+    # (label, start, end, calendar predicate): every year, the first month of
+    # each year and the first week of each year
+    for year in years:
+        start, end = period_range(year)
+        yield str(year), start, end, f"year(pickup_datetime) = {year}"
+        start, end = period_range(year, 1)
+        yield f"{year}-01", start, end, f"year(pickup_datetime) = {year} AND month(pickup_datetime) = 1"
+        yield f"{year}-W1", start, start + timedelta(days=7), f"pickup_datetime::DATE BETWEEN DATE '{start}' AND DATE '{start + timedelta(days=6)}'"
+
+def measure(con, profile_path, sql, repeats):
+    # (best latency, rows scanned, result) from DuckDB's profile, which is
+    # written once the result has been fetched
+    best = None
+    for _ in range(repeats):
+        result = con.execute(sql).fetchall()[0]
+        with open(profile_path) as f:
+            profile = json.load(f)
+        best = profile['latency'] if best is None else min(best, profile['latency'])
+    return best, profile['cumulative_rows_scanned'], result
+
+def main():
+    parser = argparse.ArgumentParser(description="Row group pruning of per-period queries on trips_transform")
+    parser.add_argument('--rows', type=int, default=4_000_000)
+    parser.add_argument('--years', type=int, nargs='+', default=[2021, 2022, 2023, 2024])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = {'rows': args.rows, 'years': args.years, 'periods': {}}
+    workdir = tempfile.mkdtemp(prefix='pruning-bench-')
+    try:
+        shutil.copytree(os.path.join(REPO, 'data'), os.path.join(workdir, 'data'))
+        data = os.path.join(workdir, 'trip-data')
+        # Year i gets i shares of the trips
+        shares = sum(range(1, len(args.years) + 1))
+        for i, year in enumerate(args.years, 1):
+            generate(data, args.rows * i // shares, [year], list(range(1, 13)))
+        for stage in ('load', 'clean', 'transform'):
+            run_stage(workdir, stage, data, args.years, list(range(1, 13)))
+
+        db = os.path.join(workdir, 'emissions.duckdb')
+        setup = duckdb.connect(db)
+        for layout, order in LAYOUTS.items():
+            if order:
+                setup.execute(f"CREATE TABLE {layout} AS SELECT * FROM trips_transform {order};")
+        report['table_rows'] = setup.execute("SELECT COUNT(*) FROM trips_transform;").fetchone()[0]
+        setup.close()
+
+        profile_path = os.path.join(workdir, 'profile.json')
+        con = duckdb.connect(db, read_only=True)
+        con.execute("SET enable_profiling = 'json';")
+        con.execute(f"SET profiling_output = '{profile_path}';")
+        try:
+            for label, start, end, calendar in periods(args.years):
+                results = {}
+                for layout in LAYOUTS:
+                    table = 'trips_transform' if layout == 'pickup_sorted' else layout
+                    for kind, predicate in (('range', pickup_range_sql(start, end)), ('calendar', calendar)):
+                        seconds, scanned, (rows, _) = measure(con, profile_path, f"""
+                        SELECT COUNT(*), SUM(trip_co2_kgs) FROM {table} WHERE {predicate};
+                        """, args.repeats)
+                        results[f"{layout}/{kind}"] = {'seconds': round(seconds, 4), 'rows_scanned': scanned}
+                report['periods'][label] = {'rows': rows, **results}
+                print(json.dumps({label: report['periods'][label]}))
+        finally:
+            con.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
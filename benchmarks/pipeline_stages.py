@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckdb
+
+from benchmarks.synthetic import generate
+
+# Times each pipeline stage on synthetic trips and compares the result with a
+# stored baseline. Every stage runs as `pipeline.py --only <stage>` in its own
+# process against a fresh database, so its peak RSS is measured on its own.
+# Reports seconds, rows/s (rows read by the stage), peak RSS and database file
+# size after the stage.
+#
+#   python -m benchmarks.pipeline_stages --rows 2000000                   # compare with baseline
+#   python -m benchmarks.pipeline_stages --rows 2000000 --update-baseline
+#
+# The stored baseline is only meaningful on the machine that produced it;
+# refresh it before comparing on a different one.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPO, 'benchmarks', 'baseline.json')
+STAGES = ['load', 'clean', 'transform', 'analysis']
+
+# Table each stage reads, for rows/s
+STAGE_INPUT = {
+    'load': 'trips',
+    'clean': 'trips',
+    'transform': 'trips_clean',
+    'analysis': 'trips_transform',
+}
+
+def run_stage(workdir, stage, data, years, months, env=None):
+    env = dict(os.environ,
+               PYTHONPATH=REPO,
+               TRIP_CACHE_DIR='',
+               LOAD_REQUESTS_PER_SECOND='1000',
+               LOAD_REQUEST_BURST='1000',
+               **(env or {}))
+    command = [sys.executable, os.path.join(REPO, 'pipeline.py'), '--only', stage, '--source', data,
+               '--years', *map(str, years), '--months', *map(str, months)]
+    started = time.perf_counter()
+    with open(os.path.join(workdir, f"{stage}.out"), 'w') as out:
+        child = subprocess.Popen(command, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - started
+    if child.returncode != 0:
+        raise RuntimeError(f"{stage} failed, see {workdir}/{stage}.out")
+    return seconds, usage.ru_maxrss * 1024
+
+def table_rows(db, table):
+    con = duckdb.connect(db, read_only=True)
+    try:
+        return con.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+    finally:
+        con.close()
+
+def benchmark(rows, years, months, data=None):
+    report = {'rows': rows, 'years': years, 'months': months, 'stages': {}}
+    workdir = tempfile.mkdtemp(prefix='pipeline-bench-')
+    try:
+        shutil.copytree(os.path.join(REPO, 'data'), os.path.join(workdir, 'data'))
+        if data is None:
+            data = os.path.join(workdir, 'trip-data')
+            generate(data, rows, years, months)
+        db = os.path.join(workdir, 'emissions.duckdb')
+        for stage in STAGES:
+            seconds, peak = run_stage(workdir, stage, data, years, months)
+            stage_rows = table_rows(db, STAGE_INPUT[stage])
+            report['stages'][stage] = {
+                'seconds': round(seconds, 3),
+                'rows': stage_rows,
+                'rows_per_second': round(stage_rows / seconds),
+                'peak_rss_mb': round(peak / 2 ** 20, 1),
+                'db_bytes': os.path.getsize(db),
+            }
+            print(json.dumps({stage: report['stages'][stage]}))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def compare(report, baseline, tolerance):
+    # Stage metrics (time, peak memory, file size) that grew by more than `tolerance`
+    if (report['rows'], report['years'], report['months']) != (baseline['rows'], baseline['years'], baseline['months']):
+        print("Baseline was recorded at a different scale; not comparing")
+        return []
+    regressions = []
+    for stage, result in report['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before is None:
+            continue
+        for metric in ('seconds', 'peak_rss_mb', 'db_bytes'):
+            ratio = result[metric] / before[metric] if before[metric] else 1.0
+            print(f"{stage:<10} {metric:<12} {before[metric]:>14} -> {result[metric]:>14}  ({ratio:.2f}x)")
+            if ratio > tolerance:
+                regressions.append((stage, metric, round(ratio, 2)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each pipeline stage on synthetic trips")
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--years', type=int, nargs='+', default=[2024])
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--data', default=None, help='use existing monthly files instead of generating them')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed growth of a metric before a stage counts as regressed')
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    report = benchmark(args.rows, args.years, args.months, args.data)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+        return
+    with open(args.baseline) as f:
+        regressions = compare(report, json.load(f), args.tolerance)
+    if regressions:
+        print(f"Regressions beyond {args.tolerance}x: {regressions}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
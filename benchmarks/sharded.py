@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import duckdb
+
+from benchmarks.pipeline_stages import REPO, run_stage
+from benchmarks.synthetic import generate
+
+# Wall-clock time of load + clean + transform run as pipeline stages in one
+# process against `shards.py run` with 1..N local workers, each from a fresh
+# directory. Every sharded run must produce the same trips_clean,
+# trips_transform and daily rollup as the unsharded one. With one
+# (service, year) shard per worker the sharded time should fall with the
+# number of workers until it runs out of cores or shards.
+#
+#   python -m benchmarks.sharded --rows 4000000 --workers 1 2 4 8
+
+COMPARED_TABLES = ['trips_clean', 'trips_transform', 'trip_rollup_daily']
+
+def run_sharded(workdir, data, years, months, workers):
+    env = dict(os.environ,
+               PYTHONPATH=REPO,
+               TRIP_CACHE_DIR='',
+               LOAD_REQUESTS_PER_SECOND='1000',
+               LOAD_REQUEST_BURST='1000')
+    command = [sys.executable, os.path.join(REPO, 'shards.py'), 'run', '--skip-analysis', '--workers', str(workers),
+               '--source', data, '--years', *map(str, years), '--months', *map(str, months)]
+    started = time.perf_counter()
+    with open(os.path.join(workdir, 'shards.out'), 'w') as out:
+        status = subprocess.run(command, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT).returncode
+    seconds = time.perf_counter() - started
+    if status != 0:
+        raise RuntimeError(f"sharded run failed, see {workdir}/shards.out")
+    return seconds
+
+def differing_rows(left, right, table):
+    con = duckdb.connect(left, read_only=True)
+    try:
+        con.execute(f"ATTACH '{right}' AS other (READ_ONLY);")
+        return con.execute(f"""
+        SELECT (SELECT COUNT(*) FROM (SELECT * FROM {table} EXCEPT ALL SELECT * FROM other.{table}))
+             + (SELECT COUNT(*) FROM (SELECT * FROM other.{table} EXCEPT ALL SELECT * FROM {table}));
+        """).fetchone()[0]
+    finally:
+        con.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Unsharded pipeline against sharded runs with 1..N workers")
+    parser.add_argument('--rows', type=int, default=4_000_000)
+    parser.add_argument('--years', type=int, nargs='+', default=[2021, 2022, 2023, 2024])
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = {'rows': args.rows, 'years': args.years, 'months': args.months, 'cores': os.cpu_count(), 'runs': []}
+    workdir = tempfile.mkdtemp(prefix='sharded-bench-')
+    try:
+        data = os.path.join(workdir, 'trip-data')
+        generate(data, args.rows, args.years, args.months)
+
+        baseline_dir = os.path.join(workdir, 'unsharded')
+        shutil.copytree(os.path.join(REPO, 'data'), os.path.join(baseline_dir, 'data'))
+        seconds = sum(run_stage(baseline_dir, stage, data, args.years, args.months)[0] for stage in ('load', 'clean', 'transform'))
+        baseline = os.path.join(baseline_dir, 'emissions.duckdb')
+        report['unsharded_seconds'] = round(seconds, 3)
+        print(json.dumps({'unsharded_seconds': report['unsharded_seconds']}))
+
+        for workers in args.workers:
+            run_dir = os.path.join(workdir, f"workers-{workers}")
+            shutil.copytree(os.path.join(REPO, 'data'), os.path.join(run_dir, 'data'))
+            seconds = run_sharded(run_dir, data, args.years, args.months, workers)
+            db = os.path.join(run_dir, 'emissions.duckdb')
+            run = {
+                'workers': workers,
+                'seconds': round(seconds, 3),
+                'speedup': round(report['unsharded_seconds'] / seconds, 2),
+                'differing_rows': {table: differing_rows(baseline, db, table) for table in COMPARED_TABLES},
+            }
+            report['runs'].append(run)
+            print(json.dumps(run))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import os
+
+import duckdb
+
+# Writes yellow/green monthly trip files shaped like the TLC ones (same file
+# names and source columns) so the pipeline can run offline at any scale.
+# Every value is a hash of the row number and the seed, so output is
+# reproducible and DuckDB streams each file out without holding it in memory.
+#
+# Dirty rows are injected at controlled rates; a duplicate repeats the previous
+# row exactly, the other kinds each break one cleaning rule.
+#
+#   python -m benchmarks.synthetic --rows 10000000 --out synthetic-data
+#   TRIP_DATA_SOURCE=synthetic-data python load.py
+
+COLUMN_PREFIX = {'yellow': 'tpep', 'green': 'lpep'}
+
+# Share of all trips per service, roughly the real yellow/green split
+SERVICE_SHARE = {'yellow': 0.9, 'green': 0.1}
+
+DEFAULT_RATES = {
+    'duplicate': 0.01,
+    'zero_passengers': 0.02,
+    'zero_miles': 0.015,
+    'over_100_miles': 0.0005,
+    'over_24_hours': 0.0005,
+}
+
+def uniform(row, salt, seed):
+    # Deterministic pseudo-random number in [0, 1) for a row
+    return f"(hash({row}, {salt}, {seed}) % 1000000) / 1000000.0"
+
+def month_sql(service, year, month, rows, rates, seed):
+    prefix = COLUMN_PREFIX[service]
+    seed = seed * 1000 + year * 12 + month
+    u = lambda salt: uniform('j', salt, seed)
+    # Dirty-row kinds take consecutive slices of one uniform draw, so a row
+    # breaks at most one rule
+    cuts, edge = {}, 0.0
+    for kind in ('zero_passengers', 'zero_miles', 'over_100_miles', 'over_24_hours'):
+        cuts[kind] = (edge, edge + rates[kind])
+        edge += rates[kind]
+    kind = lambda name: f"(d >= {cuts[name][0]} AND d < {cuts[name][1]})"
+    seconds_in_month = f"date_diff('second', TIMESTAMP '{year}-{month:02d}-01', TIMESTAMP '{year}-{month:02d}-01' + INTERVAL 1 MONTH)"
+    return f"""
+    SELECT (1 + hash(j, 1, {seed}) % 2)::BIGINT AS VendorID,
+           pickup AS {prefix}_pickup_datetime,
+           pickup + to_seconds(CASE WHEN {kind('over_24_hours')} THEN 90000 + minutes * 60
+                                    ELSE 60 + minutes * 60 END) AS {prefix}_dropoff_datetime,
+           (CASE WHEN {kind('zero_passengers')} THEN 0
+                 WHEN hash(j, 2, {seed}) % 10 < 7 THEN 1
+                 ELSE 2 + hash(j, 3, {seed}) % 4 END)::BIGINT AS passenger_count,
+           CASE WHEN {kind('zero_miles')} THEN 0.0
+                WHEN {kind('over_100_miles')} THEN 100.0 + 400.0 * {u(4)}
+                ELSE round(miles, 2) END AS trip_distance,
+           (1 + hash(j, 5, {seed}) % 263)::INTEGER AS PULocationID,
+           (1 + hash(j, 6, {seed}) % 263)::INTEGER AS DOLocationID,
+           round(3.0 + 2.5 * miles + 0.5 * minutes, 2) AS fare_amount
+    FROM (
+        SELECT j, {u(10)} AS d,
+               TIMESTAMP '{year}-{month:02d}-01' + to_seconds((hash(j, 7, {seed}) % {seconds_in_month})::BIGINT) AS pickup,
+               -- Trip length is heavy tailed: mostly short hops, some airport runs
+               0.3 + 2.0 * -ln(1.0 - {u(8)}) AS miles,
+               (3 + hash(j, 9, {seed}) % 40)::BIGINT AS minutes
+        FROM (
+            SELECT CASE WHEN i > 0 AND {uniform('i', 0, seed)} < {rates['duplicate']} THEN i - 1 ELSE i END AS j
+            FROM range({rows}) t(i)
+        )
+    )
+    """
+
+def generate(out, rows, years, months, services=('yellow', 'green'), rates=DEFAULT_RATES, seed=42):
+    # Writes one file per (service, year, month); returns their row counts
+    os.makedirs(out, exist_ok=True)
+    share = sum(SERVICE_SHARE[s] for s in services)
+    per_month = {s: max(1, int(rows * SERVICE_SHARE[s] / share / (len(years) * len(months)))) for s in services}
+    con = duckdb.connect()
+    written = {}
+    try:
+        for service in services:
+            for year in years:
+                for month in months:
+                    path = os.path.join(out, f"{service}_tripdata_{year}-{month:02d}.parquet")
+                    con.execute(f"COPY ({month_sql(service, year, month, per_month[service], rates, seed)}) TO '{path}' (FORMAT parquet);")
+                    written[path] = per_month[service]
+    finally:
+        con.close()
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic yellow/green monthly trip files")
+    parser.add_argument('--out', default='synthetic-data')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='total trips across all files')
+    parser.add_argument('--years', type=int, nargs='+', default=[2024])
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)))
+    parser.add_argument('--services', default='yellow,green')
+    parser.add_argument('--seed', type=int, default=42)
+    for name, rate in DEFAULT_RATES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}-rate", type=float, default=rate)
+    args = parser.parse_args()
+
+    rates = {name: getattr(args, f"{name}_rate") for name in DEFAULT_RATES}
+    written = generate(args.out, args.rows, args.years, args.months, args.services.split(','), rates, args.seed)
+    print(f"Wrote {sum(written.values())} trips to {len(written)} files in {args.out}")
+
+if __name__ == "__main__":
+    main()
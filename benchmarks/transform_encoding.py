@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import duckdb
+
+from emissions import ensure_vehicle_emissions
+from services import ensure_service_type
+from transform import TRIP_FIELDS, WEEKDAYS, transform_select, transform_source_sql
+
+# Before/after report for the trips_transform encoding: builds the table from
+# trips_clean of an existing database once with the previous layout (INTEGER
+# and strftime() text calendar fields, DOUBLE measures, redundant co2_kg and
+# trip_hours) and once with the compact layout used by transform.py, then
+# compares on-disk size and GROUP BY time per calendar field.
+#
+#   python -m benchmarks.transform_encoding --db emissions.duckdb
+
+LEGACY_SELECT = """
+    (trip_distance * co2_grams_per_mile)::DOUBLE AS trip_co2_kgs,
+    (trip_distance * co2_grams_per_mile)::DOUBLE AS co2_kg,
+    (trip_distance / NULLIF(EXTRACT(EPOCH FROM (dropoff_datetime - pickup_datetime)) / 3600, 0))::DOUBLE AS avg_mph,
+    (EXTRACT(EPOCH FROM (dropoff_datetime - pickup_datetime)) / 3600)::DOUBLE AS trip_hours,
+    EXTRACT(HOUR FROM pickup_datetime)::INTEGER AS hour_of_day,
+    strftime('%A', pickup_datetime) AS day_of_week,
+    EXTRACT(WEEK FROM pickup_datetime)::INTEGER AS week_of_year,
+    strftime('%m', pickup_datetime) AS month_of_year
+"""
+
+CALENDAR_FIELDS = ['hour_of_day', 'day_of_week', 'week_of_year', 'month_of_year']
+
+def build(path, source_db, derived_select):
+    con = duckdb.connect(path)
+    try:
+        ensure_service_type(con)
+        ensure_vehicle_emissions(con)
+        con.execute(f"CREATE TYPE IF NOT EXISTS weekday AS ENUM ({', '.join(repr(d) for d in WEEKDAYS)});")
+        con.execute(f"ATTACH '{source_db}' AS src (READ_ONLY);")
+        started = time.perf_counter()
+        con.execute(f"""
+        CREATE TABLE trips_transform AS
+        SELECT {TRIP_FIELDS.replace('service_type', 'service_type::VARCHAR::service_type AS service_type')}, {derived_select}
+        FROM ({transform_source_sql('true', trips='src.trips_clean')}) e;
+        """)
+        build_seconds = time.perf_counter() - started
+        con.execute("DETACH src;")
+        con.execute("CHECKPOINT;")
+        rows = con.execute("SELECT COUNT(*) FROM trips_transform;").fetchone()[0]
+    finally:
+        con.close()
+    return {'rows': rows, 'build_seconds': round(build_seconds, 3), 'file_bytes': os.path.getsize(path)}
+
+def time_group_bys(path, repeats):
+    con = duckdb.connect(path, read_only=True)
+    timings = {}
+    try:
+        for field in CALENDAR_FIELDS:
+            best = None
+            for _ in range(repeats):
+                started = time.perf_counter()
+                con.execute(f"""
+                SELECT service_type, {field}, AVG(trip_co2_kgs), COUNT(*) FROM trips_transform GROUP BY ALL;
+                """).fetchall()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[field] = round(best, 4)
+    finally:
+        con.close()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the old and compact trips_transform layouts")
+    parser.add_argument('--db', default='emissions.duckdb', help='database holding trips_clean')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        layouts = {
+            'before': LEGACY_SELECT,
+            'after': transform_select(),
+        }
+        for name, derived_select in layouts.items():
+            path = os.path.join(tmp, f"{name}.duckdb")
+            report[name] = build(path, args.db, derived_select)
+            report[name]['group_by_seconds'] = time_group_bys(path, args.repeats)
+
+    report['size_ratio'] = round(report['after']['file_bytes'] / report['before']['file_bytes'], 3)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
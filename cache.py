@@ -0,0 +1,242 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# On-disk cache for the monthly trip files. Files are stored once under their
+# SHA-256 (objects/ab/abcdef....parquet) and index.json maps each source URL to
+# the object holding its content plus the validators needed to revalidate it.
+# The directory can be shared between runs and machines; least recently used
+# objects are evicted once the cache grows past its byte budget.
+CACHE_DIR = os.environ.get('TRIP_CACHE_DIR', os.path.join('.cache', 'trip-data'))
+CACHE_BUDGET_BYTES = int(float(os.environ.get('TRIP_CACHE_BUDGET_GB', '50')) * 1024 ** 3)
+
+# Trip files are immutable once published, so an entry younger than this is
+# served without contacting the source at all. Older entries are revalidated
+# with a conditional GET, which costs headers only when nothing changed.
+CACHE_MAX_AGE_SECONDS = float(os.environ.get('TRIP_CACHE_MAX_AGE_HOURS', '168')) * 3600
+
+# Another process sharing the directory may still be reading an object it
+# fetched or touched this recently, so eviction leaves it alone.
+CACHE_IN_USE_SECONDS = float(os.environ.get('TRIP_CACHE_IN_USE_MINUTES', '30')) * 60
+
+CHUNK_BYTES = 1024 * 1024
+
+class ParquetCache:
+    def __init__(self, cache_dir=CACHE_DIR, budget_bytes=CACHE_BUDGET_BYTES, max_age_seconds=CACHE_MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.max_age_seconds = max_age_seconds
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        # Objects handed to callers, which may still be reading them; eviction
+        # leaves them alone
+        self.in_use = set()
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evicted': 0,
+                      'bytes_downloaded': 0, 'bytes_saved': 0}
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], f"{sha256}.parquet")
+
+    @contextmanager
+    def _locked(self):
+        # The thread lock plus an advisory file lock, so concurrent threads and
+        # processes sharing the directory never lose each other's index entries
+        # or evict an object while another is using or evicting it
+        with self.lock, open(os.path.join(self.cache_dir, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(tmp_fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _locked_index(self, update=None):
+        # Read (and optionally modify) the index under the locks
+        with self._locked():
+            index = self._read_index()
+            if update is None:
+                return index
+            result = update(index)
+            self._write_index(index)
+            return result
+
+    def _entry(self, url):
+        entry = self._locked_index().get(url)
+        if entry and os.path.exists(self.object_path(entry['sha256'])):
+            return entry
+        return None
+
+    def stat(self, url):
+        # (size, etag) of a fresh cached copy of url, or None. Lets callers skip
+        # a HEAD request for files the cache has validated recently.
+        entry = self._entry(url)
+        if entry and time.time() - entry['validated_at'] < self.max_age_seconds:
+            return entry['size'], entry.get('etag') or entry.get('last_modified')
+        return None
+
+    def fetch(self, url):
+        # Return a local path holding the content of url, downloading it only
+        # when the cache has no valid copy.
+        if '://' not in url or url.startswith('file://'):
+            return url[len('file://'):] if url.startswith('file://') else url
+
+        entry = self._entry(url)
+        if entry and time.time() - entry['validated_at'] < self.max_age_seconds:
+            path = self._hit(entry)
+            if path:
+                return path
+            entry = None
+
+        # A conditional GET first when there is a copy; should that copy be
+        # evicted before it is used, the file is downloaded again in full
+        for cached in ([entry, None] if entry else [None]):
+            request = urllib.request.Request(url)
+            if cached:
+                if cached.get('etag') and cached['etag'] != cached.get('last_modified'):
+                    request.add_header('If-None-Match', cached['etag'])
+                if cached.get('last_modified'):
+                    request.add_header('If-Modified-Since', cached['last_modified'])
+            try:
+                response = urllib.request.urlopen(request, timeout=60)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code != 304 or not cached:
+                    raise
+                self._update(url, validated_at=time.time())
+                path = self._hit(cached)
+                if path:
+                    with self.lock:
+                        self.stats['revalidated'] += 1
+                    return path
+
+        with response:
+            sha256, size, path = self._download(response)
+            # The same validator source_stat records in the load manifest, so
+            # the two compare equal for an unchanged file
+            last_modified = response.headers.get('Last-Modified')
+            etag = response.headers.get('ETag') or last_modified
+        self._update(url, sha256=sha256, size=size, etag=etag, last_modified=last_modified,
+                     validated_at=time.time())
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['bytes_downloaded'] += size
+        logger.info(f"Cached {url} ({size} bytes)")
+        self.evict()
+        return path
+
+    def _hit(self, entry):
+        # Path of the cached object, or None when another process evicted it
+        # since the index was read
+        path = self.object_path(entry['sha256'])
+        with self._locked():
+            try:
+                os.utime(path)  # recency for LRU eviction, visible to every machine
+            except FileNotFoundError:
+                return None
+            self.in_use.add(path)
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += entry['size']
+        return path
+
+    def _download(self, response):
+        digest = hashlib.sha256()
+        size = 0
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as f:
+                while True:
+                    chunk = response.read(CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.object_path(sha256)
+            with self.lock:
+                self.in_use.add(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(tmp_path)  # identical content is already stored
+            else:
+                os.replace(tmp_path, path)
+            return sha256, size, path
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _update(self, url, **fields):
+        def apply(index):
+            index.setdefault(url, {}).update(fields)
+        self._locked_index(apply)
+
+    def evict(self, keep=None):
+        # Drop least recently used objects until the cache fits its budget,
+        # except those in `keep` (by default the ones handed out so far, which
+        # a loader may still be reading) and those other processes used within
+        # CACHE_IN_USE_SECONDS. Runs entirely under the locks, so two evictions
+        # never pick the same object.
+        removed = set()
+        with self._locked():
+            keep = self.in_use if keep is None else set(keep)
+            recent = time.time() - CACHE_IN_USE_SECONDS
+            objects = []
+            for root, _, files in os.walk(os.path.join(self.cache_dir, 'objects')):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    objects.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in objects)
+            for mtime, size, path in sorted(objects):
+                if total <= self.budget_bytes:
+                    break
+                if path in keep or (path not in self.in_use and mtime > recent):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                removed.add(os.path.basename(path)[:-len('.parquet')])
+                total -= size
+            if removed:
+                index = self._read_index()
+                for url in [u for u, e in index.items() if e.get('sha256') in removed]:
+                    del index[url]
+                self._write_index(index)
+        if removed:
+            with self.lock:
+                self.stats['evicted'] += len(removed)
+            logger.info(f"Evicted {len(removed)} cached files to stay within {self.budget_bytes} bytes")
@@ -0,0 +1,175 @@
+import hashlib
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import get_fingerprint, set_fingerprint
+
+# Chart rendering. Each chart's data is aggregated in DuckDB and fetched as
+# NumPy arrays; the charts are then drawn in a process pool, so matplotlib is
+# only ever imported by the workers and stages that never plot do not pay for
+# it. A chart is skipped when the file exists and its data is byte-for-byte
+# what it was drawn from last time.
+#
+# ANALYSIS_CHARTS picks a subset, e.g. ANALYSIS_CHARTS=yearly_totals.
+CHART_DIR = os.environ.get('CHART_DIR', '.')
+MAX_CHART_WORKERS = int(os.environ.get('CHART_WORKERS', str(os.cpu_count() or 1)))
+
+WEEKDAY_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def yearly_totals(con, services):
+    data = con.execute(f"""
+    SELECT service_type, dimension_value::INTEGER AS trip_year, sum_co2_kg AS total_co2_kg
+    FROM emissions_cube
+    WHERE dimension = 'trip_year' AND service_type IN ({", ".join(repr(s) for s in services)})
+    ORDER BY service_type, trip_year;
+    """).fetchnumpy()
+    yield 'total_co2_emissions_by_year.png', 'render_yearly_totals', data
+
+def hour_weekday(con, services):
+    # Average kg CO2 per trip for every weekday x hour, one heatmap per service
+    for service in services:
+        data = con.execute("""
+        SELECT isodow(trip_date) - 1 AS weekday, hour_of_day, SUM(co2_kg_sum) / SUM(trip_count) AS avg_co2_kg
+        FROM trip_rollup_hourly
+        WHERE service_type = ?
+        GROUP BY ALL
+        ORDER BY ALL;
+        """, [service]).fetchnumpy()
+        yield f"co2_by_weekday_and_hour_{service}.png", 'render_hour_weekday', {'service': service, **data}
+
+def monthly_trend(con, services):
+    data = con.execute(f"""
+    SELECT service_type, date_trunc('month', trip_date) AS trip_month, SUM(co2_kg_sum) AS total_co2_kg, SUM(trip_count) AS trips
+    FROM trip_rollup_daily
+    WHERE service_type IN ({", ".join(repr(s) for s in services)})
+    GROUP BY ALL
+    ORDER BY ALL;
+    """).fetchnumpy()
+    yield 'co2_by_month.png', 'render_monthly_trend', data
+
+def daily_series(con, services):
+    # Daily CO2 with its rolling means and anomalies, one chart per service
+    for service in services:
+        data = con.execute("""
+        SELECT trip_date, co2_kg, co2_7d_mean, co2_28d_mean, anomaly
+        FROM emissions_daily_series
+        WHERE service_type = ?
+        ORDER BY trip_date;
+        """, [service]).fetchnumpy()
+        yield f"co2_daily_series_{service}.png", 'render_daily_series', {'service': service, **data}
+
+CHARTS = {
+    'yearly_totals': yearly_totals,
+    'hour_weekday': hour_weekday,
+    'monthly_trend': monthly_trend,
+    'daily_series': daily_series,
+}
+ENABLED_CHARTS = [c for c in os.environ.get('ANALYSIS_CHARTS', ",".join(CHARTS)).split(',') if c]
+
+# Renderers run in the worker processes; each takes the output path and the
+# chart's arrays
+
+def pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def render_yearly_totals(path, data):
+    plt = pyplot()
+    plt.figure(figsize=(10, 6))
+    for service in sorted(set(data['service_type'])):
+        rows = data['service_type'] == service
+        plt.plot(data['trip_year'][rows], data['total_co2_kg'][rows], marker="o", label=service)
+    plt.title("Total CO2 Emissions by Year")
+    plt.xlabel("Year")
+    plt.ylabel("Total CO2 Emissions (kg)")
+    plt.legend(title="Service Type")
+    plt.grid(True, linestyle="--", alpha=0.6)
+    plt.savefig(path)
+    plt.close()
+
+def render_hour_weekday(path, data):
+    import numpy as np
+    plt = pyplot()
+    grid = np.full((7, 24), np.nan)
+    grid[data['weekday'].astype(int), data['hour_of_day'].astype(int)] = data['avg_co2_kg']
+    plt.figure(figsize=(12, 4.5))
+    plt.imshow(grid, aspect='auto', cmap='viridis')
+    plt.colorbar(label="Average CO2 per trip (kg)")
+    plt.yticks(range(7), WEEKDAY_ORDER)
+    plt.xticks(range(24))
+    plt.xlabel("Hour of day")
+    plt.title(f"Average CO2 per Trip by Weekday and Hour ({data['service']})")
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_monthly_trend(path, data):
+    plt = pyplot()
+    figure, (totals, per_trip) = plt.subplots(2, 1, figsize=(12, 8), sharex=True)
+    for service in sorted(set(data['service_type'])):
+        rows = data['service_type'] == service
+        totals.plot(data['trip_month'][rows], data['total_co2_kg'][rows], marker="o", label=service)
+        per_trip.plot(data['trip_month'][rows], data['total_co2_kg'][rows] / data['trips'][rows], marker="o", label=service)
+    totals.set_title("CO2 Emissions by Month")
+    totals.set_ylabel("Total CO2 (kg)")
+    per_trip.set_ylabel("Average CO2 per trip (kg)")
+    per_trip.set_xlabel("Month")
+    for axis in (totals, per_trip):
+        axis.legend(title="Service Type")
+        axis.grid(True, linestyle="--", alpha=0.6)
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+def render_daily_series(path, data):
+    plt = pyplot()
+    anomalies = data['anomaly'].astype(bool)
+    plt.figure(figsize=(14, 5))
+    plt.plot(data['trip_date'], data['co2_kg'], linewidth=0.6, alpha=0.5, label="Daily total")
+    plt.plot(data['trip_date'], data['co2_7d_mean'], label="7-day mean")
+    plt.plot(data['trip_date'], data['co2_28d_mean'], label="28-day mean")
+    plt.scatter(data['trip_date'][anomalies], data['co2_kg'][anomalies], color="red", s=12, zorder=3, label="Anomaly")
+    plt.title(f"Daily CO2 Emissions ({data['service']})")
+    plt.xlabel("Date")
+    plt.ylabel("Total CO2 (kg)")
+    plt.legend()
+    plt.grid(True, linestyle="--", alpha=0.6)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render(renderer, path, data):
+    globals()[renderer](path, data)
+    return path
+
+def data_fingerprint(renderer, data):
+    return hashlib.sha256(pickle.dumps((renderer, sorted(data.items())))).hexdigest()
+
+def render_charts(con, services, charts=ENABLED_CHARTS, chart_dir=CHART_DIR, max_workers=MAX_CHART_WORKERS):
+    # Fetch every chart's data, then draw the changed ones in parallel.
+    # Returns (rendered paths, skipped paths).
+    tasks = []
+    skipped = []
+    for chart in charts:
+        for name, renderer, data in CHARTS[chart](con, services):
+            path = os.path.join(chart_dir, name)
+            fingerprint = data_fingerprint(renderer, data)
+            if os.path.exists(path) and get_fingerprint(con, f"chart:{name}") == fingerprint:
+                skipped.append(path)
+            else:
+                tasks.append((name, renderer, path, data, fingerprint))
+    if not tasks:
+        return [], skipped
+
+    # spawn, not fork: the parent holds DuckDB's worker threads
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [(name, fingerprint, pool.submit(render, renderer, path, data)) for name, renderer, path, data, fingerprint in tasks]
+        rendered = []
+        for name, fingerprint, future in futures:
+            rendered.append(future.result())
+            set_fingerprint(con, f"chart:{name}", fingerprint)
+    return rendered, skipped
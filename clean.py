@@ -1,10 +1,16 @@
-import duckdb
 import logging
+import sys
+
+from database import connect
+from instrument import tagged, flush_metrics
+from manifest import ensure_manifest, pending_partitions, mark_processed
+from quality import profile_table, failed_checks, write_report
+from services import SERVICES, ENABLED_SERVICES, TRIP_COLUMNS, ensure_service_type, ensure_pickup_order, trip_columns_ddl
 
 logging.basicConfig(
     level=logging.INFO, 
     format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='load.log',
+    filename='clean.log',
     filemode='a',
     force=True
 )
@@ -21,123 +27,242 @@ def flush_logs():
     for handler in logger.handlers:
         handler.flush()
 
-def clean_data():
-    con = None
+# Cleaning rules, one bit each in the quarantine reject_mask. A row is kept only
+# when no rule fires; duplicates keep one copy and quarantine the rest.
+DUPLICATE = 1
+RULES = [
+    ('zero_passengers', 2, "NOT coalesce(passenger_count > 0, false)"),
+    ('zero_miles', 4, "NOT coalesce(trip_distance > 0, false)"),
+    ('over_100_miles', 8, "trip_distance > 100"),
+    ('over_24_hours', 16, "NOT coalesce(date_diff('second', pickup_datetime, dropoff_datetime) <= 86400, false)"),
+    ('outside_2015_2024', 32, "NOT coalesce(pickup_datetime >= TIMESTAMP '2015-01-01' AND pickup_datetime < TIMESTAMP '2025-01-01', false)"),
+]
+REJECT_REASONS = {'duplicate': DUPLICATE, **{name: bit for name, bit, _ in RULES}}
 
-    try:
-        # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
-        logger.info("Connected to DuckDB instance")
-        flush_logs()
+TRIP_FIELDS = "service_type, source_year, source_month, " + ", ".join(TRIP_COLUMNS)
 
-        # Drop existing clean tables if they exist
-        con.execute("DROP TABLE IF EXISTS yellow_tripdata_clean;")
-        con.execute("DROP TABLE IF EXISTS green_tripdata_clean;")
-        logger.info("Dropped existing clean tables if they existed")
-        flush_logs()
+def service_rules(service):
+    skipped = SERVICES[service].get('skip_rules', [])
+    return [(name, bit, predicate) for name, bit, predicate in RULES if name not in skipped]
+
+def rule_mask_sql(service):
+    return " | ".join(f"(CASE WHEN {predicate} THEN {bit} ELSE 0 END)" for _, bit, predicate in service_rules(service)) or "0"
+
+def violation_sql(name, predicate):
+    # A rule's predicate restricted to the services it applies to
+    skipping = [service for service in SERVICES if name in SERVICES[service].get('skip_rules', [])]
+    if not skipping:
+        return predicate
+    return f"(service_type NOT IN ({', '.join(repr(s) for s in skipping)}) AND {predicate})"
+
+# Trip identity for deduplication across months: a 64-bit hash of the trip
+# columns, stored with the pickup time in trip_fingerprints for every trip in
+# trips_clean. A duplicate has the same pickup time, so the (pickup, hash) pair
+# is the key, and a newly cleaned month only probes the index rows within its
+# own pickup range: the hash join pushes the new month's min/max pickup down
+# to the index scan, whose zone maps skip the rest of history.
+def fingerprint_sql(alias=None):
+    prefix = f"{alias}." if alias else ""
+    return f"hash({', '.join(prefix + column for column in TRIP_COLUMNS)})"
 
-        # Final Clean Table
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS yellow_tripdata_clean AS SELECT * FROM yellow_tripdata WHERE 1 = 0;
+def clean_partition(con, service, year, month):
+    # One scan of the raw trips of a month: group identical rows (in-month
+    # duplicates), evaluate every rule on the grouped rows, probe the
+    # fingerprint index for trips another month already holds, then split the
+    # rows into trips_clean and the quarantine. The month's fingerprints,
+    # clean rows and progress are replaced in the same transaction.
+    scope = f"service_type = '{service}' AND source_year = {year} AND source_month = {month}"
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        for table in ('trips_clean', 'trip_quarantine', 'trip_fingerprints'):
+            con.execute(f"DELETE FROM {table} WHERE {scope};")
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE clean_candidates AS
+        SELECT g.*, f.fingerprint IS NOT NULL AS seen
+        FROM (
+            SELECT *, ({rule_mask_sql(service)})::UTINYINT AS rule_mask, {fingerprint_sql()} AS fingerprint
+            FROM (
+                SELECT {TRIP_FIELDS}, COUNT(*) AS copies
+                FROM trips
+                WHERE {scope}
+                GROUP BY ALL
+            )
+        ) g
+        LEFT JOIN (
+            SELECT pickup_datetime, fingerprint FROM trip_fingerprints WHERE service_type = '{service}'
+        ) f ON f.pickup_datetime = g.pickup_datetime AND f.fingerprint = g.fingerprint;
         """)
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS green_tripdata_clean AS SELECT * FROM green_tripdata WHERE 1 = 0;
+        # Pickup order keeps the zone maps of both tables tight
+        con.execute(f"""
+        INSERT INTO trips_clean
+        SELECT {TRIP_FIELDS}
+        FROM clean_candidates
+        WHERE rule_mask = 0 AND NOT seen
+        ORDER BY pickup_datetime;
         """)
-        logger.info("Initialized clean tables")
-        flush_logs()
+        con.execute(f"""
+        INSERT INTO trip_fingerprints
+        SELECT service_type, source_year, source_month, pickup_datetime, fingerprint
+        FROM clean_candidates
+        WHERE rule_mask = 0 AND NOT seen
+        ORDER BY pickup_datetime;
+        """)
+        con.execute(f"""
+        INSERT INTO trip_quarantine
+        SELECT {TRIP_FIELDS},
+               rule_mask | (CASE WHEN copies > 1 OR seen THEN {DUPLICATE} ELSE 0 END),
+               CASE WHEN rule_mask = 0 AND NOT seen THEN copies - 1 ELSE copies END
+        FROM clean_candidates
+        WHERE rule_mask <> 0 OR copies > 1 OR seen;
+        """)
+        con.execute("DROP TABLE clean_candidates;")
+        mark_processed(con, 'clean', service, year, month)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
 
-        for year in range(2015, 2025):
-            logger.info(f"Cleaning yellow trip data for year {year}")
-            flush_logs()
+def orphaned_partitions(con, service):
+    # Months holding a quarantined duplicate whose kept copy is gone, i.e. the
+    # month that owned it was reloaded without that trip. Read from the small
+    # quarantine table.
+    rows = con.execute(f"""
+    SELECT DISTINCT q.source_year, q.source_month
+    FROM trip_quarantine q
+    ANTI JOIN (
+        SELECT pickup_datetime, fingerprint FROM trip_fingerprints WHERE service_type = '{service}'
+    ) f ON f.pickup_datetime = q.pickup_datetime AND f.fingerprint = {fingerprint_sql('q')}
+    WHERE q.service_type = '{service}' AND q.reject_mask = {DUPLICATE}
+    ORDER BY ALL;
+    """).fetchall()
+    return [(year, month) for year, month in rows]
 
-            con.execute(f"""
-                INSERT INTO yellow_tripdata_clean
-                SELECT DISTINCT * 
-                FROM yellow_tripdata
-                WHERE strftime(tpep_pickup_datetime, '%Y') = '{year}'
-                  AND passenger_count > 0
-                  AND trip_distance > 0
-                  AND trip_distance <= 100
-                  AND (EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime)) / 3600) <= 24;
-            """) # Remove duplicates, trip with 0 passenger, trips 0 miles in length, trips greater than 100 miles, trips greater than 24 hrs
-            logger.info(f"Cleaned yellow trip data for year {year}")
+def clean_service(con, service):
+    # Only months loaded since the last clean are processed, oldest first, so
+    # a trip repeated in a later month's file is kept where it first appeared.
+    # Each month is cleaned in its own transaction, so the cost and peak
+    # memory follow the new data rather than the history.
+    pending = pending_partitions(con, 'clean', service)
+    while pending:
+        for year, month in pending:
+            with tagged(con, source_year=year, source_month=month):
+                clean_partition(con, service, year, month)
+        pending = orphaned_partitions(con, service)
+        if pending:
+            logger.info(f"Cleaning {len(pending)} {service} months again whose duplicates lost their kept copy")
             flush_logs()
 
-            logger.info(f"Cleaning green trip data for year {year}")
-            flush_logs()
+def rejection_stats(con):
+    # Rows rejected per service and reason, read from the (small) quarantine
+    # table. A row that breaks several rules is counted under each of them.
+    reasons = ", ".join(f"coalesce(SUM(rejected_rows) FILTER (WHERE reject_mask & {bit} <> 0), 0)::BIGINT AS {name}" for name, bit in REJECT_REASONS.items())
+    return con.execute(f"""
+    SELECT service_type, SUM(rejected_rows)::BIGINT AS rejected_rows, {reasons}
+    FROM trip_quarantine
+    GROUP BY service_type
+    ORDER BY service_type;
+    """).fetchdf()
 
-            con.execute(f"""
-                INSERT INTO green_tripdata_clean
-                SELECT DISTINCT *
-                FROM green_tripdata
-                WHERE strftime(lpep_pickup_datetime, '%Y') = '{year}'
-                  AND passenger_count > 0
-                  AND trip_distance > 0
-                  AND trip_distance <= 100
-                  AND (EXTRACT(EPOCH FROM (lpep_dropoff_datetime - lpep_pickup_datetime)) / 3600) <= 24;
-            """) # Remove duplicates, trip with 0 passenger, trips 0 miles in length, trips greater than 100 miles, trips greater than 24 hrs
-            logger.info(f"Cleaned green trip data for year {year}")
-            flush_logs()
+def ensure_fingerprints(con):
+    # Created from trips_clean when missing, e.g. in a database cleaned
+    # before the index existed
+    exists = con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'trip_fingerprints';").fetchone()[0]
+    if exists:
+        return
+    con.execute("""
+    CREATE TABLE trip_fingerprints (
+        service_type service_type, source_year SMALLINT, source_month UTINYINT, pickup_datetime TIMESTAMP, fingerprint UBIGINT
+    );
+    """)
+    con.execute(f"""
+    INSERT INTO trip_fingerprints
+    SELECT service_type, source_year, source_month, pickup_datetime, {fingerprint_sql()}
+    FROM trips_clean
+    ORDER BY pickup_datetime;
+    """)
 
-    except Exception as e:
-        logger.error(f"Error during data cleaning: {e}")
-        flush_logs()
+def prepare_clean(con):
+    ensure_manifest(con)
+    ensure_service_type(con)
+    con.execute(f"CREATE TABLE IF NOT EXISTS trips_clean ({trip_columns_ddl()});")
+    ensure_pickup_order(con, 'trips_clean')
+    con.execute(f"""
+    CREATE TABLE IF NOT EXISTS trip_quarantine ({trip_columns_ddl()}, reject_mask UTINYINT, rejected_rows BIGINT);
+    """)
+    ensure_fingerprints(con)
 
-def verify_clean_data():
+def clean_data(services=ENABLED_SERVICES):
     con = None
 
     try:
         # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=True)
-        logger.info("Connected to DuckDB instance for verification")
+        con = connect(stage='clean')
+        logger.info("Connected to DuckDB instance")
         flush_logs()
 
-        # Verify yellow tripdata clean table
-        yellow_count = con.execute("SELECT COUNT(*) FROM yellow_tripdata_clean").fetchone()[0]
-        logger.info(f"Yellow tripdata clean table has {yellow_count} records.")
+        prepare_clean(con)
+        logger.info("Initialized clean and quarantine tables")
         flush_logs()
 
-        # Verify green tripdata clean table
-        green_count = con.execute("SELECT COUNT(*) FROM green_tripdata_clean").fetchone()[0]
-        logger.info(f"Green tripdata clean table has {green_count} records.")
-        flush_logs()
+        for service in services:
+            logger.info(f"Cleaning {service} trip data")
+            flush_logs()
+            with tagged(con, service=service):
+                clean_service(con, service) # Remove duplicates, trip with 0 passenger, trips 0 miles in length, trips greater than 100 miles, trips greater than 24 hrs
+            logger.info(f"Cleaned {service} trip data")
+            flush_logs()
 
-        # Verify no 0 passengers
-        yellow_zero_passengers = con.execute("SELECT COUNT(*) FROM yellow_tripdata_clean WHERE passenger_count = 0").fetchone()[0]
-        green_zero_passengers = con.execute("SELECT COUNT(*) FROM green_tripdata_clean WHERE passenger_count = 0").fetchone()[0]
-        logger.info(f"Yellow tripdata clean table has {yellow_zero_passengers} records with 0 passengers.")
-        logger.info(f"Green tripdata clean table has {green_zero_passengers} records with 0 passengers.")
+        logger.info("Rejected rows by reason:")
+        logger.info(rejection_stats(con).to_dict(orient='records'))
         flush_logs()
+        flush_metrics(con)
 
-        # Verify no 0 miles
-        yellow_zero_miles = con.execute("SELECT COUNT(*) FROM yellow_tripdata_clean WHERE trip_distance = 0").fetchone()[0]
-        green_zero_miles = con.execute("SELECT COUNT(*) FROM green_tripdata_clean WHERE trip_distance = 0").fetchone()[0]
-        logger.info(f"Yellow tripdata clean table has {yellow_zero_miles} records with 0 miles.")
-        logger.info(f"Green tripdata clean table has {green_zero_miles} records with 0 miles.")
+    except Exception as e:
+        logger.error(f"Error during data cleaning: {e}")
         flush_logs()
 
-        #Verify no trips greater than 100 miles
-        yellow_over_100_miles = con.execute("SELECT COUNT(*) FROM yellow_tripdata_clean WHERE trip_distance > 100").fetchone()[0]
-        green_over_100_miles = con.execute("SELECT COUNT(*) FROM green_tripdata_clean WHERE trip_distance > 100").fetchone()[0]
-        logger.info(f"Yellow tripdata clean table has {yellow_over_100_miles} records with over 100 miles.")
-        logger.info(f"Green tripdata clean table has {green_over_100_miles} records with over 100 miles.")
-        flush_logs()
+# Violations allowed per check before verification fails the run
+QUALITY_THRESHOLDS = {name: 0 for name, _, _ in RULES}
 
-        # Verify no trips greater than 24 hours
-        yellow_over_24hrs = con.execute("""SELECT COUNT(*) FROM yellow_tripdata_clean 
-            WHERE (EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime)) / 3600) > 24""").fetchone()[0]
-        green_over_24hrs = con.execute("""SELECT COUNT(*) FROM green_tripdata_clean 
-            WHERE (EXTRACT(EPOCH FROM (lpep_dropoff_datetime - lpep_pickup_datetime)) / 3600) > 24""").fetchone()[0]
-        logger.info(f"Yellow tripdata clean table has {yellow_over_24hrs} records over 24 hours.")
-        logger.info(f"Green tripdata clean table has {green_over_24hrs} records over 24 hours.")
+def verify_clean(con, thresholds=QUALITY_THRESHOLDS):
+    # Profile the clean table in one scan: rule violations plus per-column
+    # null counts, min/max and approximate distinct counts
+    checks = {name: violation_sql(name, predicate) for name, _, predicate in RULES}
+    report = profile_table(con, "trips_clean", checks)
+    logger.info(f"Clean trips table has {report['row_count']} records.")
+    for name, count in report['checks'].items():
+        logger.info(f"Clean trips table has {count} records failing {name}.")
+    failures = failed_checks(report, thresholds)
+    flush_logs()
+
+    write_report(con, [report])
+    logger.info("Wrote data quality report")
+    if failures:
+        logger.error(f"Data quality checks above threshold: {failures}")
+    flush_logs()
+    return not failures
+
+def verify_clean_data(thresholds=QUALITY_THRESHOLDS):
+    con = None
+
+    try:
+        # Connect to local DuckDB instance
+        con = connect(stage='clean')
+        logger.info("Connected to DuckDB instance for verification")
         flush_logs()
 
+        passed = verify_clean(con, thresholds)
+        flush_metrics(con)
+        return passed
+
     except Exception as e:
         logger.error(f"Error during verification: {e}")
         flush_logs()
-   
+        return False
+
 if __name__ == "__main__":
     clean_data()
-    verify_clean_data()
+    if not verify_clean_data():
+        sys.exit(1)
     logger.info("Data cleaning and verification completed.")
 
@@ -0,0 +1,35 @@
+import os
+
+import duckdb
+
+from instrument import instrument
+
+# Execution profile shared by every stage. Defaults suit a laptop; smaller
+# workers set e.g. DUCKDB_MEMORY_LIMIT=2GB DUCKDB_THREADS=2. Anything that does
+# not fit in memory_limit spills to temp_directory instead of failing.
+DATABASE = os.environ.get('EMISSIONS_DB', 'emissions.duckdb')
+MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT', '')   # empty: DuckDB default (80% of RAM)
+THREADS = int(os.environ.get('DUCKDB_THREADS', '0'))        # 0: one per core
+TEMP_DIRECTORY = os.environ.get('DUCKDB_TEMP_DIRECTORY', '.duckdb_tmp')
+# Stages order their writes explicitly, so DuckDB may reorder everything else;
+# this lets large inserts and aggregations stream instead of buffering
+PRESERVE_INSERTION_ORDER = os.environ.get('DUCKDB_PRESERVE_INSERTION_ORDER', 'false').lower() == 'true'
+
+def profile_config(memory_limit=None, threads=None):
+    config = {
+        'temp_directory': TEMP_DIRECTORY,
+        'preserve_insertion_order': PRESERVE_INSERTION_ORDER,
+    }
+    memory_limit = memory_limit or MEMORY_LIMIT
+    if memory_limit:
+        config['memory_limit'] = memory_limit
+    threads = threads or THREADS
+    if threads:
+        config['threads'] = threads
+    return config
+
+def connect(database=DATABASE, read_only=False, memory_limit=None, threads=None, stage=None):
+    # Every stage connects through here so they all run under the same
+    # profile; connections opened for a stage record per-query metrics
+    con = duckdb.connect(database=database, read_only=read_only, config=profile_config(memory_limit, threads))
+    return instrument(con, stage) if stage else con
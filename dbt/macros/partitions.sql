@@ -0,0 +1,41 @@
+-- Same rule as manifest.pending_partitions(): the (service, year, month)
+-- partitions `upstream` produced after `stage` last processed them.
+{% macro pending_partitions(stage, upstream) %}
+    SELECT u.service_type, u.source_year, u.source_month
+    FROM {{ source('pipeline', 'stage_progress') }} u
+    LEFT JOIN {{ source('pipeline', 'stage_progress') }} p
+      ON p.stage = '{{ stage }}' AND p.service_type = u.service_type
+     AND p.source_year = u.source_year AND p.source_month = u.source_month
+    WHERE u.stage = '{{ upstream }}'
+      AND (p.processed_at IS NULL OR p.processed_at < u.processed_at)
+{% endmacro %}
+
+-- Pre-hook deleting the partitions an incremental model is about to
+-- re-insert. dbt's own delete+insert joins the new rows to the target on the
+-- unique key, which is every row of a partition against every other; deleting
+-- by partition is one filtered DELETE.
+{% macro delete_pending_partitions(stage, upstream) %}
+    {% if is_incremental() %}
+    DELETE FROM {{ this }}
+    WHERE (service_type::VARCHAR, source_year, source_month) IN (
+        SELECT (service_type, source_year, source_month) FROM ({{ pending_partitions(stage, upstream) }})
+    )
+    {% endif %}
+{% endmacro %}
+
+-- Post-hook recording the partitions a model rebuilt in stage_progress, so
+-- the rollups and samples pick them up exactly as after transform.py. A full
+-- refresh rebuilt every cleaned partition.
+{% macro mark_processed(stage, upstream) %}
+    INSERT OR REPLACE INTO {{ source('pipeline', 'stage_progress') }}
+    SELECT '{{ stage }}', service_type, source_year, source_month, now()::TIMESTAMP
+    FROM (
+        {% if flags.FULL_REFRESH %}
+        SELECT service_type, source_year, source_month
+        FROM {{ source('pipeline', 'stage_progress') }}
+        WHERE stage = '{{ upstream }}'
+        {% else %}
+        {{ pending_partitions(stage, upstream) }}
+        {% endif %}
+    )
+{% endmacro %}
@@ -0,0 +1,9 @@
+-- Per-service factors of the speed-aware emissions model (see emissions.py):
+-- kg CO2 per mile at city speed and the change towards highway speed
+SELECT s.service_type,
+       e.co2_grams_per_mile / e.mpg_city
+           / ({{ var('city_share') }} / e.mpg_city + {{ 1 - var('city_share') }} / e.mpg_highway) / 1000.0 AS city_kg_per_mile,
+       e.co2_grams_per_mile * (1.0 / e.mpg_highway - 1.0 / e.mpg_city)
+           / ({{ var('city_share') }} / e.mpg_city + {{ 1 - var('city_share') }} / e.mpg_highway) / 1000.0 AS highway_delta_kg_per_mile
+FROM {{ source('pipeline', 'service_types') }} s
+JOIN {{ ref('vehicle_emissions') }} e ON e.vehicle_type = s.vehicle_type
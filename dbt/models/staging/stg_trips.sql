@@ -0,0 +1,5 @@
+-- Clean trips of every service with the average speed the emissions model
+-- needs, computed once
+SELECT *,
+       trip_distance / NULLIF(date_diff('second', pickup_datetime, dropoff_datetime) / 3600.0, 0) AS trip_mph
+FROM {{ source('pipeline', 'trips_clean') }}
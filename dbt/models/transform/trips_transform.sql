@@ -0,0 +1,37 @@
+-- Same speed-aware emissions model as emissions.py: kg CO2 per mile blends
+-- linearly from city to highway fuel economy between the EPA city and highway
+-- cycle speeds; trips without a usable speed get the combined rating.
+--
+-- Built incrementally like transform.py: only the (service, year, month)
+-- partitions cleaned since they were last transformed are selected, and they
+-- are replaced by deleting the partitions and appending the new rows (a
+-- delete+insert keyed on the partition). Progress is shared with
+-- transform.py through stage_progress, so either can maintain the table.
+-- Rows are written in the same partition and pickup order as transform.py
+-- so pickup range filters prune row groups.
+{{ config(
+    materialized='incremental',
+    incremental_strategy='append',
+    pre_hook="{{ delete_pending_partitions('transform', 'clean') }}",
+    post_hook="{{ mark_processed('transform', 'clean') }}"
+) }}
+{% set span = var('highway_mph') - var('city_mph') %}
+{% set combined_mph = var('city_mph') + (1 - var('city_share')) * span %}
+
+SELECT
+    t.* EXCLUDE (trip_mph),
+    (t.trip_distance * (e.city_kg_per_mile
+        + least(greatest((coalesce(t.trip_mph, {{ combined_mph }}) - {{ var('city_mph') }}) / {{ span }}, 0.0), 1.0)
+          * e.highway_delta_kg_per_mile))::FLOAT AS trip_co2_kgs,
+    t.trip_mph::FLOAT AS avg_mph,
+    hour(t.pickup_datetime)::UTINYINT AS hour_of_day,
+    dayname(t.pickup_datetime)::weekday AS day_of_week,
+    week(t.pickup_datetime)::UTINYINT AS week_of_year,
+    month(t.pickup_datetime)::UTINYINT AS month_of_year
+FROM {{ ref('stg_trips') }} t
+JOIN {{ ref('stg_service_emissions') }} e ON e.service_type = t.service_type::VARCHAR
+{% if is_incremental() %}
+SEMI JOIN ({{ pending_partitions('transform', 'clean') }}) p
+  ON p.service_type = t.service_type::VARCHAR AND p.source_year = t.source_year AND p.source_month = t.source_month
+{% endif %}
+ORDER BY t.service_type, t.source_year, t.source_month, t.pickup_datetime
@@ -0,0 +1,46 @@
+# Speed-aware CO2 model. vehicle_emissions.csv gives, per vehicle type, a
+# combined co2_grams_per_mile plus city and highway fuel economy. A trip's
+# emissions per mile scale with fuel burned per mile, which is blended between
+# the city and highway figures by the trip's average speed: at or below the EPA
+# city cycle's average speed the city mpg applies, at or above the highway
+# cycle's average speed the highway mpg, linearly in between. Trips without a
+# usable speed fall back to the EPA combined 55/45 city/highway split, which is
+# exactly co2_grams_per_mile.
+#
+# Everything is a plain SQL expression over columns, so DuckDB evaluates it
+# vectorized inside the transform query with no per-row Python.
+EMISSIONS_CSV = 'data/vehicle_emissions.csv'
+
+CITY_MPH = 21.2      # average speed of the EPA city (FTP-75) cycle
+HIGHWAY_MPH = 48.3   # average speed of the EPA highway (HWFET) cycle
+CITY_SHARE = 0.55    # city share of the EPA combined rating
+
+def ensure_vehicle_emissions(con, path=EMISSIONS_CSV):
+    # (Re)load the lookup table so transforms always use the current CSV
+    con.execute(f"""
+    CREATE OR REPLACE TABLE vehicle_emissions AS
+    SELECT * FROM read_csv('{path}', header = true);
+    """)
+
+def emission_factors_sql():
+    # Per vehicle type: kg CO2 per mile at city speed, and how much that changes
+    # between city and highway speed. Computed once per lookup row so the
+    # per-trip expression is a clamp and a multiply-add.
+    combined = f"({CITY_SHARE} / mpg_city + {1 - CITY_SHARE:.2f} / mpg_highway)"
+    return f"""
+    SELECT *,
+           co2_grams_per_mile / mpg_city / {combined} / 1000.0 AS city_kg_per_mile,
+           co2_grams_per_mile * (1.0 / mpg_highway - 1.0 / mpg_city) / {combined} / 1000.0 AS highway_delta_kg_per_mile
+    FROM vehicle_emissions
+    """
+
+# Speed whose highway share equals the combined rating's; used for trips
+# without a usable speed (greatest/least would otherwise skip the NULL)
+COMBINED_MPH = CITY_MPH + (1 - CITY_SHARE) * (HIGHWAY_MPH - CITY_MPH)
+
+def highway_share_sql(mph):
+    return f"least(greatest((coalesce({mph}, {COMBINED_MPH:.3f}) - {CITY_MPH}) / {HIGHWAY_MPH - CITY_MPH:.1f}, 0.0), 1.0)"
+
+def co2_kg_sql(distance, mph, factors='e'):
+    # trip CO2 in kg; `factors` is the alias of the joined emission_factors_sql() row
+    return f"{distance} * ({factors}.city_kg_per_mile + {highway_share_sql(mph)} * {factors}.highway_delta_kg_per_mile)"
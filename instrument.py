@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Per-statement query metrics, off unless QUERY_METRICS=1. When on,
+# connections opened with database.connect(stage=...) are wrapped in an
+# InstrumentedConnection, which runs every statement with DuckDB's JSON
+# profiling on and records wall time, rows returned/written/scanned, bytes
+# read and the operator profile, tagged with the stage and the service/source
+# month being processed.
+#
+# Each statement is appended to QUERY_METRICS_PATH as one JSON line (with the
+# full profile tree) as soon as it finishes; the summary columns are also
+# written to the query_metrics table by flush_metrics() at the end of a stage.
+# Once the file passes QUERY_METRICS_MAX_MB it is moved to <path>.1 (replacing
+# the previous one) and a new file is started, so it never holds more than
+# about twice that.
+#
+#   QUERY_METRICS=1 python pipeline.py
+#   python instrument.py --top 20          # slowest statements and operators
+#   python instrument.py --folded > q.txt  # folded stacks for flamegraph.pl
+METRICS_PATH = os.environ.get('QUERY_METRICS_PATH', 'query_metrics.jsonl')
+ENABLED = os.environ.get('QUERY_METRICS', '0') == '1'
+MAX_BYTES = int(float(os.environ.get('QUERY_METRICS_MAX_MB', '64')) * 1024 ** 2)
+
+TAGS = ['stage', 'service', 'source_year', 'source_month']
+
+# Operators that write rows; their input cardinality is the rows written
+WRITE_OPERATORS = {'INSERT', 'CREATE_TABLE_AS', 'BATCH_CREATE_TABLE_AS', 'BATCH_INSERT', 'DELETE', 'UPDATE', 'COPY_TO_FILE', 'BATCH_COPY_TO_FILE'}
+
+class QueryRecorder:
+    # Shared by every instrumented connection and cursor of the process
+    def __init__(self, path=METRICS_PATH, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def record(self, entry, profile):
+        with self.lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, f"{self.path}.1")
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({**entry, 'profile': profile}, default=str) + "\n")
+            self.pending.append(entry)
+
+    def take(self):
+        with self.lock:
+            entries, self.pending = self.pending, []
+        return entries
+
+RECORDER = QueryRecorder()
+
+def statement_label(sql):
+    # Short name for a statement: its leading keywords up to the table it
+    # writes or reads, e.g. "INSERT OR REPLACE INTO stage_progress"
+    tokens = sql.replace('(', ' ').split()
+    for i, token in enumerate(tokens[:8]):
+        if token.upper() in ('INTO', 'TABLE', 'FROM') and i + 1 < len(tokens):
+            return " ".join(tokens[:i + 2])
+    return " ".join(tokens[:4])
+
+def rows_written(profile):
+    for node in profile.get('children', []):
+        if node.get('operator_type') in WRITE_OPERATORS:
+            return sum(child.get('operator_cardinality', 0) for child in node.get('children', []))
+    return 0
+
+class InstrumentedConnection:
+    # Wraps a DuckDB connection; execute() is timed and profiled, everything
+    # else is passed through unchanged. Tags are per wrapper, so a cursor (one
+    # per worker thread) can be tagged independently of its parent.
+    def __init__(self, con, recorder=RECORDER, tags=None):
+        self.con = con
+        self.recorder = recorder
+        self.tags = dict(tags or {})
+        self.profile_path = os.path.join(tempfile.gettempdir(), f"duckdb-profile-{uuid.uuid4().hex}.json")
+        con.execute("SET enable_profiling = 'json';")
+        con.execute(f"SET profiling_output = '{self.profile_path}';")
+
+    def execute(self, sql, parameters=None):
+        if os.path.exists(self.profile_path):
+            os.remove(self.profile_path)
+        started = time.perf_counter()
+        error = None
+        try:
+            return self.con.execute(sql, parameters) if parameters is not None else self.con.execute(sql)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            wall = time.perf_counter() - started
+            profile = {}
+            if error is None and os.path.exists(self.profile_path):
+                with open(self.profile_path) as f:
+                    profile = json.load(f)
+            self.recorder.record({
+                'recorded_at': datetime.now().isoformat(),
+                **{tag: self.tags.get(tag) for tag in TAGS},
+                'statement': " ".join(sql.split()),
+                'wall_seconds': round(wall, 6),
+                'latency_seconds': profile.get('latency'),
+                'rows_returned': profile.get('rows_returned'),
+                'rows_written': rows_written(profile) if profile else None,
+                'rows_scanned': profile.get('cumulative_rows_scanned'),
+                'bytes_read': profile.get('total_bytes_read'),
+                'peak_buffer_bytes': profile.get('system_peak_buffer_memory'),
+                'error': error,
+            }, profile.get('children'))
+
+    def cursor(self):
+        return InstrumentedConnection(self.con.cursor(), self.recorder, self.tags)
+
+    def close(self):
+        self.con.close()
+        if os.path.exists(self.profile_path):
+            os.remove(self.profile_path)
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+def instrument(con, stage):
+    return InstrumentedConnection(con, tags={'stage': stage}) if ENABLED else con
+
+@contextmanager
+def tagged(con, **tags):
+    # Tag the statements run inside the block; a no-op on plain connections
+    saved = getattr(con, 'tags', None)
+    if not isinstance(con, InstrumentedConnection):
+        yield
+        return
+    con.tags = {**saved, **tags}
+    try:
+        yield
+    finally:
+        con.tags = saved
+
+def flush_metrics(con):
+    # Write the statements recorded so far to the query_metrics table. Run it
+    # outside any open transaction so the rows are not rolled back with it.
+    entries = RECORDER.take() if isinstance(con, InstrumentedConnection) else []
+    if not entries:
+        return
+    raw = con.con
+    raw.execute("""
+    CREATE TABLE IF NOT EXISTS query_metrics (
+        recorded_at TIMESTAMP, stage VARCHAR, service VARCHAR, source_year SMALLINT, source_month UTINYINT,
+        statement VARCHAR, wall_seconds DOUBLE, latency_seconds DOUBLE, rows_returned BIGINT, rows_written BIGINT,
+        rows_scanned BIGINT, bytes_read BIGINT, peak_buffer_bytes BIGINT, error VARCHAR
+    );
+    """)
+    columns = ['recorded_at', *TAGS, 'statement', 'wall_seconds', 'latency_seconds', 'rows_returned', 'rows_written',
+               'rows_scanned', 'bytes_read', 'peak_buffer_bytes', 'error']
+    raw.executemany(f"INSERT INTO query_metrics VALUES ({', '.join('?' for _ in columns)});",
+                    [[entry[c] for c in columns] for entry in entries])
+
+def read_metrics(path=METRICS_PATH):
+    # The rotated file first: it holds the older statements
+    entries = []
+    for name in (f"{path}.1", path):
+        if os.path.exists(name):
+            with open(name) as f:
+                entries.extend(json.loads(line) for line in f if line.strip())
+    return entries
+
+def operator_stacks(nodes, prefix=()):
+    # (stack of operator names, self time) for every operator of a profile tree
+    for node in nodes or []:
+        stack = prefix + (node.get('operator_name') or node.get('operator_type', '?'),)
+        yield stack, node.get('operator_timing', 0.0)
+        yield from operator_stacks(node.get('children'), stack)
+
+def summary(entries, top):
+    statements = defaultdict(lambda: [0, 0.0])
+    operators = defaultdict(float)
+    for entry in entries:
+        key = (entry['stage'], statement_label(entry['statement']))
+        statements[key][0] += 1
+        statements[key][1] += entry['wall_seconds']
+        for stack, seconds in operator_stacks(entry.get('profile')):
+            operators[(entry['stage'], key[1], stack[-1].strip())] += seconds
+    total = sum(wall for _, wall in statements.values()) or 1.0
+    lines = [f"Slowest statements ({total:.2f}s recorded):"]
+    for (stage, label), (count, wall) in sorted(statements.items(), key=lambda item: -item[1][1])[:top]:
+        lines.append(f"  {wall:9.3f}s {100 * wall / total:5.1f}%  x{count:<5} {stage}: {label}")
+    lines.append("Slowest operators:")
+    slowest = max(operators.values(), default=0.0) or 1.0
+    for (stage, label, operator), seconds in sorted(operators.items(), key=lambda item: -item[1])[:top]:
+        bar = '#' * max(1, round(40 * seconds / slowest))
+        lines.append(f"  {seconds:9.3f}s {bar:<40} {stage}: {label} / {operator}")
+    return "\n".join(lines)
+
+def folded(entries):
+    # One "stage;service;statement;op;op... microseconds" line per operator,
+    # the input format of flamegraph.pl / speedscope
+    stacks = defaultdict(float)
+    for entry in entries:
+        head = (entry['stage'] or '-', entry['service'] or '-', statement_label(entry['statement']).replace(';', ''))
+        for stack, seconds in operator_stacks(entry.get('profile')):
+            stacks[head + tuple(s.strip().replace(';', '') for s in stack)] += seconds
+    return "\n".join(f"{';'.join(stack)} {round(seconds * 1e6)}" for stack, seconds in stacks.items() if seconds > 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise recorded query metrics")
+    parser.add_argument('--path', default=METRICS_PATH)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--folded', action='store_true', help='print folded operator stacks for a flame graph instead')
+    args = parser.parse_args()
+    entries = read_metrics(args.path)
+    print(folded(entries) if args.folded else summary(entries, args.top))
+
+if __name__ == "__main__":
+    main()
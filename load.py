@@ -1,10 +1,23 @@
 import duckdb
 import os
 import logging
+import random
+import re
+import threading
 import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from cache import ParquetCache, CACHE_DIR
+from database import connect
+from emissions import ensure_vehicle_emissions
+from instrument import tagged, flush_metrics
+from manifest import ensure_manifest, source_stat, loaded_sources, record_load, reset_progress, cached_schemas, record_schema
+from rollups import rebuild_rollups
+from services import SERVICES, TRIP_COLUMNS, ENABLED_SERVICES, ensure_service_type, trip_columns_ddl
 
 logging.basicConfig(
-    level=logging.INFO, 
+    level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     filename='load.log',
     filemode='a',
@@ -18,76 +31,396 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# Where the monthly trip files come from. Point this at a local mirror (a plain
+# directory or a file:// URL) to run the loader offline.
+TRIP_DATA_SOURCE = os.environ.get('TRIP_DATA_SOURCE', 'https://d37ci6vzurychx.cloudfront.net/trip-data')
+
+YEARS = range(2015, 2025)
+MONTHS = range(1, 13)
+
+# Fetch settings: number of files decoded at once, request rate against the
+# source and retry policy for a single file
+MAX_WORKERS = int(os.environ.get('LOAD_MAX_WORKERS', '4'))
+REQUESTS_PER_SECOND = float(os.environ.get('LOAD_REQUESTS_PER_SECOND', '1'))
+REQUEST_BURST = int(os.environ.get('LOAD_REQUEST_BURST', '4'))
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.0
+
+# How changed months are ingested. 'scan' reads up to LOAD_SCAN_FILES months of
+# a service in one multi-file read_parquet, which DuckDB decodes on all cores;
+# 'file' decodes month by month in the worker threads above and is also the
+# fallback for a scan that fails, so one bad file cannot hold back the others.
+LOAD_MODE = os.environ.get('LOAD_MODE', 'scan')
+LOAD_MODES = ['scan', 'file']
+SCAN_FILES = int(os.environ.get('LOAD_SCAN_FILES', '12'))
+
+# HTTP statuses that are worth retrying; anything else (404 etc.) fails fast
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
 def flush_logs():
     for handler in logger.handlers:
         handler.flush()
 
-def load_parquet_files():
+class TokenBucket:
+    # Simple thread-safe token bucket: `rate` tokens per second, at most
+    # `capacity` tokens banked. acquire() blocks until a token is available.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+def source_url(service, year, month, source=TRIP_DATA_SOURCE):
+    file_name = f"{service}_tripdata_{year}-{month:02d}.parquet"
+    if source.startswith('file://'):
+        return os.path.join(source[len('file://'):], file_name)
+    if '://' in source:
+        return f"{source.rstrip('/')}/{file_name}"
+    return os.path.join(source, file_name)
+
+def is_retryable(error):
+    if isinstance(error, duckdb.HTTPException):
+        return getattr(error, 'status_code', None) in RETRYABLE_STATUS
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRYABLE_STATUS
+    # A file that is not there will not appear on retry: local mirrors often
+    # lack months, e.g. fhvhv before 2019
+    if isinstance(error, FileNotFoundError) or 'No files found' in str(error):
+        return False
+    return isinstance(error, (duckdb.IOException, OSError))
+
+def retrying(func, service, year, month, *args):
+    # func(service, year, month, *args), retried with backoff while it fails
+    # with a transient error
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return func(service, year, month, *args)
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = BACKOFF_SECONDS * 2 ** (attempt - 1) + random.uniform(0, BACKOFF_SECONDS)
+            logger.warning(f"Attempt {attempt} for {service} {year}-{month:02d} failed ({e}); retrying in {delay:.1f}s")
+            flush_logs()
+            time.sleep(delay)
 
-    con = None  
+def locate_month(service, year, month, bucket, known, source=TRIP_DATA_SOURCE, cache=None):
+    # Returns (url, size, etag, path), path being where DuckDB reads the file:
+    # the cached copy when a cache is given, otherwise the source itself. path
+    # is None when the manifest already holds this exact file.
+    url = source_url(service, year, month, source)
+    if '://' not in url and not os.path.exists(url):
+        raise FileNotFoundError(f"No such file: {url}")
+    cached = cache.stat(url) if cache else None
+    # Only requests to the remote host are rate limited
+    if cached is None and '://' in url:
+        bucket.acquire()
+    size, etag = cached or source_stat(url)
+    if known.get((service, year, month)) == (size, etag):
+        return url, size, etag, None
+    return url, size, etag, (cache.fetch(url) if cache else url)
 
+def parquet_columns(con, path):
+    # {column: type} of a Parquet file, from its footer alone. Names are
+    # lower-cased: the TLC files are not consistent about case.
+    rows = con.execute(f"DESCRIBE SELECT * FROM read_parquet('{path}');").fetchall()
+    return {row[0].lower(): row[1] for row in rows}
+
+def cast_rule(expression, source_types, sql_type):
+    # Explicit cast of one source column to its canonical type. Where every
+    # file already stores it as that type this is a plain cast. Where files
+    # store another type, or types drifted between them (VendorID as INTEGER
+    # in some years and BIGINT in others, passenger_count as BIGINT or
+    # DOUBLE), a value no cast can represent, such as a NaN passenger count,
+    # becomes NULL and is quarantined by clean instead of failing the month.
+    if set(source_types) <= {sql_type}:
+        return f"({expression})::{sql_type}"
+    return f"TRY_CAST({expression} AS {sql_type})"
+
+def scan_select(service, schemas):
+    # SELECT list turning files of `service` with the given parquet_columns
+    # schemas into canonical trip columns (without the partition columns).
+    # Mapped columns that are plain source columns are cast by cast_rule from
+    # the types they have across those files.
+    columns = SERVICES[service]['columns']
+    select = []
+    for name, sql_type in TRIP_COLUMNS.items():
+        expression = columns[name]
+        types = {schema[expression.lower()] for schema in schemas if expression.lower() in schema}
+        select.append(f"{cast_rule(expression, types, sql_type)} AS {name}")
+    return ", ".join(select)
+
+def missing_columns(service, schema):
+    # Plain source columns of `service` a file does not have. union_by_name
+    # would read them as NULL, so such files are never scanned together with
+    # others.
+    return [c for c in SERVICES[service]['columns'].values()
+            if re.fullmatch(r'\w+', c) and c.upper() != 'NULL' and c.lower() not in schema]
+
+def fetch_month(service, year, month, bucket, known, source=TRIP_DATA_SOURCE, cache=None):
+    # Download and decode one monthly file into an Arrow table. Each worker uses
+    # its own in-memory DuckDB so decoding never touches the database file.
+    # Returns (url, size, etag, table); table is None when the manifest already
+    # holds this exact file. Remote files go through the local Parquet cache
+    # when one is given.
+    url, size, etag, path = locate_month(service, year, month, bucket, known, source, cache)
+    if path is None:
+        return url, size, etag, None
+    reader = connect(':memory:', stage='load')
     try:
-        # Connect to loc    al DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
-        logger.info("Connected to DuckDB instance")
-        flush_logs()
+        schema = parquet_columns(reader, path)
+        with tagged(reader, service=service, source_year=year, source_month=month):
+            table = reader.execute(f"""
+            SELECT '{service}' AS service_type, {year}::SMALLINT AS source_year, {month}::UTINYINT AS source_month, {scan_select(service, [schema])}
+            FROM read_parquet('{path}');
+            """).to_arrow_table()
+        return url, size, etag, table
+    finally:
+        reader.close()
 
-        # Create consolidated tables if not exists
-        con.execute("DROP TABLE IF EXISTS yellow_tripdata;")
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS yellow_tripdata (VendorID INTEGER, tpep_pickup_datetime TIMESTAMP, tpep_dropoff_datetime TIMESTAMP, passenger_count INTEGER, trip_distance DOUBLE);
-        """)
+def write_month(con, service, year, month, url, size, etag, batch):
+    # Replace the month and record it in the manifest in one transaction, so a
+    # crash leaves either the old month or the new one, never half of it.
+    con.register('month_batch', batch)
+    try:
+        con.execute("BEGIN TRANSACTION;")
+        con.execute(f"DELETE FROM trips WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month};")
+        con.execute("INSERT INTO trips SELECT * FROM month_batch;")
+        record_load(con, service, year, month, url, size, etag, batch.num_rows)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    finally:
+        con.unregister('month_batch')
+    logger.info(f"Loaded {service} trip data for {year}-{month:02d} ({batch.num_rows} rows)")
+    flush_logs()
+
+def file_schemas(con, files):
+    # parquet_columns of each (url, size, etag, path) file, from source_schemas
+    # when it is unchanged since its schema was recorded
+    schemas = cached_schemas(con, [(url, size, etag) for url, size, etag, _ in files])
+    for url, size, etag, path in files:
+        if url not in schemas:
+            schemas[url] = parquet_columns(con, path)
+            record_schema(con, url, size, etag, schemas[url])
+    return schemas
+
+def scan_months(con, service, months):
+    # Load several months of `service`, given as [(year, month, url, size,
+    # etag, path)], with one read_parquet over all their files. union_by_name
+    # matches columns by name whatever their position or type in each file,
+    # only the mapped columns are read, and each row's month comes from the
+    # file it was read from. Rows are inserted in file order, so every month
+    # still lands in row groups of its own, and the months are replaced and
+    # recorded in one transaction. Returns the number of rows loaded.
+    files = [(url, size, etag, path) for _, _, url, size, etag, path in months]
+    schemas = file_schemas(con, files)
+    for url, _, _, _ in files:
+        missing = missing_columns(service, schemas[url])
+        if missing:
+            raise ValueError(f"{url} has no column {', '.join(missing)}")
+    paths = [path for *_, path in months]
+    if len(set(paths)) < len(paths):
+        raise ValueError("Several months are backed by the same file")
 
-        con.execute("DROP TABLE IF EXISTS green_tripdata;")
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS green_tripdata (VendorID INTEGER, lpep_pickup_datetime TIMESTAMP, lpep_dropoff_datetime TIMESTAMP, passenger_count INTEGER, trip_distance DOUBLE);
+    partition = lambda index: "CASE filename " + " ".join(f"WHEN '{m[5]}' THEN {m[index]}" for m in months) + " END"
+    rows = dict(con.execute(f"""
+    SELECT file_name, num_rows FROM parquet_file_metadata([{", ".join(repr(p) for p in paths)}]);
+    """).fetchall())
+    order = con.execute("SELECT current_setting('preserve_insertion_order');").fetchone()[0]
+    con.execute("SET preserve_insertion_order = true;")
+    try:
+        con.execute("BEGIN TRANSACTION;")
+        for year, month, *_ in months:
+            con.execute(f"DELETE FROM trips WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month};")
+        con.execute(f"""
+        INSERT INTO trips
+        SELECT '{service}', {partition(0)}::SMALLINT, {partition(1)}::UTINYINT, {scan_select(service, schemas.values())}
+        FROM read_parquet([{", ".join(repr(p) for p in paths)}], union_by_name = true, filename = true);
         """)
-        logger.info("Initialized consolidated tables")
+        for year, month, url, size, etag, path in months:
+            record_load(con, service, year, month, url, size, etag, rows[path])
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    finally:
+        con.execute(f"SET preserve_insertion_order = {order};")
+    for year, month, *_, path in months:
+        logger.info(f"Loaded {service} trip data for {year}-{month:02d} ({rows[path]} rows)")
+    flush_logs()
+    return sum(rows.values())
+
+def scan_load(con, tasks, bucket, known, source, cache, max_workers):
+    # Scan mode of load_months. Worker threads locate each file (downloading
+    # remote ones into the cache), then every service's changed months are
+    # loaded SCAN_FILES at a time, oldest first. Returns (skipped, failed,
+    # retry); retry holds the months of failed scans, for the per-file path.
+    skipped, failed, retry = [], [], []
+    located = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(retrying, locate_month, *task, bucket, known, source, cache): task for task in tasks}
+        for future, task in futures.items():
+            service, year, month = task
+            try:
+                url, size, etag, path = future.result()
+            except Exception as e:
+                logger.error(f"Failed to load {service} trip data for {year}-{month:02d}: {e}")
+                flush_logs()
+                failed.append(task)
+                continue
+            if path is None:
+                skipped.append(task)
+            else:
+                located[task] = (year, month, url, size, etag, path)
+
+    for service in dict.fromkeys(service for service, _, _ in tasks):
+        months = sorted(m for (s, _, _), m in located.items() if s == service)
+        for start in range(0, len(months), SCAN_FILES):
+            chunk = months[start:start + SCAN_FILES]
+            try:
+                with tagged(con, service=service):
+                    scan_months(con, service, chunk)
+            except Exception as e:
+                logger.warning(f"Scan of {len(chunk)} {service} files failed ({e}); loading them one by one")
+                flush_logs()
+                retry.extend((service, year, month) for year, month, *_ in chunk)
+    return skipped, failed, retry
+
+def migrate_legacy_tables(con):
+    # Move trips out of the old per-service tables (yellow_tripdata with tpep_*
+    # columns, green_tripdata with lpep_*) into the shared trips table. Tables
+    # without source partition columns cannot be attributed to a month and are
+    # dropped so their months reload. Downstream tables are rebuilt from trips.
+    legacy = {'yellow': 'tpep', 'green': 'lpep'}
+    for service, prefix in legacy.items():
+        columns = [row[0] for row in con.execute(f"""
+        SELECT column_name FROM information_schema.columns WHERE table_name = '{service}_tripdata';
+        """).fetchall()]
+        if not columns:
+            continue
+        if 'source_year' in columns:
+            con.execute(f"""
+            INSERT INTO trips
+            SELECT '{service}', source_year, source_month, VendorID, {prefix}_pickup_datetime, {prefix}_dropoff_datetime, passenger_count, trip_distance
+            FROM {service}_tripdata;
+            """)
+        else:
+            con.execute("DELETE FROM load_manifest WHERE service_type = ?;", [service])
+            reset_progress(con, 'load', service)
+        for table in (f"{service}_tripdata", f"{service}_tripdata_clean", f"{service}_tripdata_transform"):
+            con.execute(f"DROP TABLE IF EXISTS {table};")
+        for stage in ('clean', 'transform'):
+            reset_progress(con, stage, service)
+        rebuild_rollups(con, service)
+        logger.info(f"Migrated {service}_tripdata into the trips table")
         flush_logs()
+    con.execute("DROP TABLE IF EXISTS tripdata_quarantine;")
+
+def prepare_load(con):
+    # Create the consolidated trips table if it does not exist. All services
+    # share it, partitioned by (service_type, source_year, source_month); each
+    # month is written as one contiguous insert so its row groups stay
+    # together and per-service/per-period filters prune.
+    ensure_manifest(con)
+    ensure_service_type(con)
+    con.execute(f"CREATE TABLE IF NOT EXISTS trips ({trip_columns_ddl()});")
+    migrate_legacy_tables(con)
+    ensure_vehicle_emissions(con)
+
+def load_months(con, source=TRIP_DATA_SOURCE, years=YEARS, months=MONTHS, services=ENABLED_SERVICES, max_workers=MAX_WORKERS, cache=None, mode=LOAD_MODE):
+    # In scan mode changed months are loaded by scan_load first. Otherwise,
+    # and for the months of any scan that failed, workers fetch and decode
+    # files concurrently; this thread is the only writer to the database. At
+    # most 2 * max_workers decoded months are kept in flight so memory stays
+    # bounded when the writer falls behind.
+    # Returns the months that could not be loaded.
+    bucket = TokenBucket(REQUESTS_PER_SECOND, REQUEST_BURST)
+    if cache is None and CACHE_DIR:
+        cache = ParquetCache()
+    tasks = [(service, year, month) for year in years for month in months for service in services]
+    known = loaded_sources(con)
+    failed = []
+    skipped = []
+    pending = {}
+    remaining = tasks
+    if mode == 'scan':
+        skipped, failed, remaining = scan_load(con, tasks, bucket, known, source, cache, max_workers)
 
-        # Loop over 10 years and all the months
-        for year in range(2015, 2025):
-            for month in range(1, 13):
-                month_str = f"{month:02d}"
-                
-                # Load yellow trip data
-                yellow_url = f"https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year}-{month_str}.parquet"
-                
-                try:
-                    time.sleep(60) 
-                    con.execute(f"""
-                    INSERT INTO yellow_tripdata SELECT VendorID, tpep_pickup_datetime, tpep_dropoff_datetime, passenger_count, trip_distance FROM read_parquet('{yellow_url}');
-                    """)
-                    logger.info(f"Loaded yellow trip data for {year}-{month_str}")
-                except Exception as e:
-                    logger.warning(f"Failed to load yellow trip data for {year}-{month_str}: {e}")
-                flush_logs()    
-
-                # Load green trip data
-                green_url = f"https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_{year}-{month_str}.parquet"
-                
-                try: 
-                    time.sleep(60)  
-                    con.execute(f"""
-                    INSERT INTO green_tripdata SELECT VendorID, lpep_pickup_datetime, lpep_dropoff_datetime, passenger_count, trip_distance FROM read_parquet('{green_url}');
-                    """)
-                    logger.info(f"Loaded green trip data for {year}-{month_str}")
-                except Exception as e:
-                    logger.warning(f"Failed to load green trip data for {year}-{month_str}: {e}")
+    def drain(done):
+        for future in done:
+            service, year, month = pending.pop(future)
+            try:
+                url, size, etag, batch = future.result()
+                if batch is None:
+                    skipped.append((service, year, month))
+                else:
+                    with tagged(con, service=service, source_year=year, source_month=month):
+                        write_month(con, service, year, month, url, size, etag, batch)
+            except Exception as e:
+                logger.error(f"Failed to load {service} trip data for {year}-{month:02d}: {e}")
                 flush_logs()
-        
-        # Basic Descriptive Statitics
-        yellow_mean1 = con.execute("SELECT AVG(trip_distance) FROM yellow_tripdata").fetchone()[0]
-        green_mean1 = con.execute("SELECT AVG(trip_distance) FROM green_tripdata").fetchone()[0]
-        logger.info(f"Average trip distance for yellow tripdata: {yellow_mean1}")
-        logger.info(f"Average trip distance for green tripdata: {green_mean1}")
+                failed.append((service, year, month))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for service, year, month in remaining:
+            if len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                drain(done)
+            future = pool.submit(retrying, fetch_month, service, year, month, bucket, known, source, cache)
+            pending[future] = (service, year, month)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            drain(done)
+
+    logger.info(f"Loaded {len(tasks) - len(failed) - len(skipped)} of {len(tasks)} monthly files, {len(skipped)} already up to date")
+    if failed:
+        logger.warning(f"Months that could not be loaded: {sorted(failed)}")
+    if cache is not None:
+        # Every month has been read by now, so nothing needs protecting
+        cache.evict(keep=())
+        logger.info(f"Parquet cache: {cache.stats}")
+    flush_logs()
+    return failed
+
+def load_parquet_files(source=TRIP_DATA_SOURCE, years=YEARS, months=MONTHS, services=ENABLED_SERVICES, max_workers=MAX_WORKERS, cache=None, mode=LOAD_MODE):
+
+    con = None
+
+    try:
+        # Connect to local DuckDB instance
+        con = connect(stage='load')
+        logger.info("Connected to DuckDB instance")
+        flush_logs()
+
+        prepare_load(con)
+        logger.info("Initialized consolidated trips table and vehicle_emissions lookup")
         flush_logs()
 
-        yellow_mean2 = con.execute("SELECT AVG(passenger_count) FROM yellow_tripdata").fetchone()[0]
-        green_mean2 = con.execute("SELECT AVG(passenger_count) FROM green_tripdata").fetchone()[0]
-        logger.info(f"Average passenger count for yellow tripdata: {yellow_mean2}")
-        logger.info(f"Average passenger count for green tripdata: {green_mean2}")
+        load_months(con, source, years, months, services, max_workers, cache, mode)
+
+        # Basic Descriptive Statitics
+        stats = con.execute("""
+        SELECT service_type, AVG(trip_distance), AVG(passenger_count) FROM trips GROUP BY service_type ORDER BY service_type;
+        """).fetchall()
+        for service, mean_distance, mean_passengers in stats:
+            logger.info(f"Average trip distance for {service} tripdata: {mean_distance}")
+            logger.info(f"Average passenger count for {service} tripdata: {mean_passengers}")
         flush_logs()
+        flush_metrics(con)
 
 
     except Exception as e:
@@ -0,0 +1,128 @@
+import os
+import urllib.request
+
+# The load manifest records one row per monthly source file that has been
+# loaded into the raw tables. stage_progress records when each stage (load,
+# clean, transform, ...) last processed a (service, year, month) partition, so
+# a stage can ask which partitions its upstream has produced since.
+
+def ensure_manifest(con):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS load_manifest (
+        service_type VARCHAR,
+        source_year SMALLINT,
+        source_month UTINYINT,
+        source VARCHAR,
+        source_size BIGINT,
+        source_etag VARCHAR,
+        row_count BIGINT,
+        loaded_at TIMESTAMP,
+        PRIMARY KEY (service_type, source_year, source_month)
+    );
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS stage_progress (
+        stage VARCHAR,
+        service_type VARCHAR,
+        source_year SMALLINT,
+        source_month UTINYINT,
+        processed_at TIMESTAMP,
+        PRIMARY KEY (stage, service_type, source_year, source_month)
+    );
+    """)
+    # Column types of every source file seen, so a multi-file load can plan
+    # its casts without reading the footers of files it already knows
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS source_schemas (
+        source VARCHAR,
+        source_size BIGINT,
+        source_etag VARCHAR,
+        column_name VARCHAR,
+        column_type VARCHAR,
+        PRIMARY KEY (source, column_name)
+    );
+    """)
+
+def source_stat(url):
+    # Cheap change detection for a source file: (size, etag). Local files use
+    # their modification time as the etag; remote files a HEAD request.
+    if '://' not in url:
+        st = os.stat(url)
+        return st.st_size, str(st.st_mtime_ns)
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        size = response.headers.get('Content-Length')
+        etag = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        return (int(size) if size is not None else None), etag
+
+def loaded_sources(con):
+    # {(service, year, month): (size, etag)} for everything already loaded
+    rows = con.execute("""
+    SELECT service_type, source_year, source_month, source_size, source_etag FROM load_manifest;
+    """).fetchall()
+    return {(service, year, month): (size, etag) for service, year, month, size, etag in rows}
+
+def cached_schemas(con, files):
+    # {source: {column: type}} for the (source, size, etag) files whose schema
+    # was recorded while they had that size and etag
+    if not files:
+        return {}
+    rows = con.execute(f"""
+    SELECT s.source, s.column_name, s.column_type
+    FROM source_schemas s
+    JOIN (VALUES {", ".join("(?, ?, ?)" for _ in files)}) f(source, source_size, source_etag)
+      ON f.source = s.source AND f.source_size IS NOT DISTINCT FROM s.source_size AND f.source_etag IS NOT DISTINCT FROM s.source_etag;
+    """, [value for file in files for value in file]).fetchall()
+    schemas = {}
+    for source, column, column_type in rows:
+        schemas.setdefault(source, {})[column] = column_type
+    return schemas
+
+def record_schema(con, source, size, etag, columns):
+    con.execute("DELETE FROM source_schemas WHERE source = ?;", [source])
+    con.executemany("INSERT INTO source_schemas VALUES (?, ?, ?, ?, ?);",
+                    [(source, size, etag, column, column_type) for column, column_type in columns.items()])
+
+def record_load(con, service, year, month, source, size, etag, row_count):
+    con.execute("""
+    INSERT OR REPLACE INTO load_manifest VALUES (?, ?, ?, ?, ?, ?, ?, now()::TIMESTAMP);
+    """, [service, year, month, source, size, etag, row_count])
+    mark_processed(con, 'load', service, year, month)
+
+def mark_processed(con, stage, service, year, month):
+    con.execute("""
+    INSERT OR REPLACE INTO stage_progress VALUES (?, ?, ?, ?, now()::TIMESTAMP);
+    """, [stage, service, year, month])
+
+def pending_partitions(con, stage, service, upstream='load'):
+    # Partitions of `service` that `upstream` produced (or reproduced) after
+    # `stage` last processed them, as a sorted list of (year, month).
+    rows = con.execute("""
+    SELECT u.source_year, u.source_month
+    FROM stage_progress u
+    LEFT JOIN stage_progress p
+      ON p.stage = $stage AND p.service_type = u.service_type
+     AND p.source_year = u.source_year AND p.source_month = u.source_month
+    WHERE u.stage = $upstream AND u.service_type = $service
+      AND (p.processed_at IS NULL OR p.processed_at < u.processed_at)
+    ORDER BY 1, 2;
+    """, {'stage': stage, 'service': service, 'upstream': upstream}).fetchall()
+    return [(year, month) for year, month in rows]
+
+def reset_progress(con, stage, service):
+    # Forget everything `stage` processed for `service`, e.g. after its output
+    # table was rebuilt, so every upstream partition is pending again.
+    con.execute("DELETE FROM stage_progress WHERE stage = ? AND service_type = ?;", [stage, service])
+
+def get_fingerprint(con, key):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS stage_fingerprints (key VARCHAR PRIMARY KEY, fingerprint VARCHAR, updated_at TIMESTAMP);
+    """)
+    row = con.execute("SELECT fingerprint FROM stage_fingerprints WHERE key = ?;", [key]).fetchone()
+    return row[0] if row else None
+
+def set_fingerprint(con, key, fingerprint):
+    get_fingerprint(con, key)  # creates the table on first use
+    con.execute("""
+    INSERT OR REPLACE INTO stage_fingerprints VALUES (?, ?, now()::TIMESTAMP);
+    """, [key, fingerprint])
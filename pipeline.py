@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from analysis import report_emissions
+from approximate import ANALYSIS_MODE, CONFIDENCE_Z
+from charts import CHART_DIR, ENABLED_CHARTS
+from clean import prepare_clean, clean_service, rejection_stats, verify_clean
+from database import connect
+from instrument import tagged, flush_metrics
+from emissions import EMISSIONS_CSV
+from load import TRIP_DATA_SOURCE, YEARS, MONTHS, LOAD_MODE, LOAD_MODES, prepare_load, load_months
+from manifest import ensure_manifest, get_fingerprint, set_fingerprint, reset_progress
+from services import ENABLED_SERVICES
+from snapshots import publish_snapshot
+from transform import prepare_transform, transform_service
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='pipeline.log',
+    filemode='a',
+    force=True
+)
+
+logger = logging.getLogger(__name__)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+def flush_logs():
+    for handler in logger.handlers:
+        handler.flush()
+
+# Stages in dependency order. Each stage's fingerprint covers the code and
+# files that define it plus the state of its upstream output (the manifest
+# rows or stage_progress timestamps it reads from), so a stage whose inputs
+# have not changed since its last successful run is skipped.
+#
+# load has no fingerprint: its inputs are the remote files, which it already
+# checks one by one against load_manifest.
+STAGES = ['load', 'clean', 'transform', 'analysis']
+
+STAGE_FILES = {
+    'clean': ['clean.py', 'quality.py', 'services.py'],
+    'transform': ['transform.py', 'emissions.py', 'rollups.py', 'samples.py', 'timeseries.py', 'services.py', EMISSIONS_CSV],
+    'analysis': ['analysis.py', 'approximate.py', 'charts.py'],
+}
+
+# Settings that change a stage's output without changing its files or inputs
+STAGE_SETTINGS = {
+    'analysis': {
+        'mode': ANALYSIS_MODE,
+        'confidence_z': CONFIDENCE_Z,
+        'charts': sorted(ENABLED_CHARTS),
+        'chart_dir': os.path.abspath(CHART_DIR),
+    },
+}
+
+UPSTREAM_STATE = {
+    'clean': """
+        SELECT service_type, source_year, source_month, source_size, source_etag, row_count
+        FROM load_manifest WHERE service_type IN ({services}) ORDER BY ALL
+    """,
+    'transform': """
+        SELECT service_type, source_year, source_month, processed_at
+        FROM stage_progress WHERE stage = 'clean' AND service_type IN ({services}) ORDER BY ALL
+    """,
+    'analysis': """
+        SELECT stage, service_type, source_year, source_month, processed_at
+        FROM stage_progress WHERE stage IN ('rollup', 'sample', 'timeseries') AND service_type IN ({services}) ORDER BY ALL
+    """,
+}
+
+def stage_fingerprint(con, stage, services):
+    if stage not in STAGE_FILES:
+        return None
+    digest = hashlib.sha256(repr(sorted(services)).encode())
+    digest.update(repr(STAGE_SETTINGS.get(stage)).encode())
+    for path in STAGE_FILES[stage]:
+        if path.endswith('.py'):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    rows = con.execute(UPSTREAM_STATE[stage].format(services=", ".join(repr(s) for s in services))).fetchall()
+    digest.update(repr(rows).encode())
+    return digest.hexdigest()
+
+def run_branch(func, cursor, service):
+    with tagged(cursor, service=service):
+        func(cursor, service)
+
+def run_branches(con, func, services):
+    # Run func(cursor, service) for every service at once. Each branch gets its
+    # own cursor (and so its own transactions); the services touch disjoint
+    # partitions of the shared tables, so their writes never conflict.
+    cursors = [con.cursor() for _ in services]
+    try:
+        with ThreadPoolExecutor(max_workers=len(services)) as pool:
+            futures = [pool.submit(run_branch, func, cursor, service) for cursor, service in zip(cursors, services)]
+            for future in futures:
+                future.result()
+    finally:
+        for cursor in cursors:
+            cursor.close()
+
+def run_load(con, services, options):
+    prepare_load(con)
+    load_months(con, options.source, options.years, options.months, services, mode=getattr(options, 'load_mode', LOAD_MODE))
+
+def run_clean(con, services, options):
+    prepare_clean(con)
+    run_branches(con, clean_service, services)
+    logger.info(f"Rejected rows by reason: {rejection_stats(con).to_dict(orient='records')}")
+    flush_logs()
+    if not verify_clean(con):
+        raise RuntimeError("Clean data failed verification")
+
+def run_transform(con, services, options):
+    prepare_transform(con)
+    run_branches(con, transform_service, services)
+
+def run_analysis(con, services, options):
+    report_emissions(con, services)
+
+RUNNERS = {
+    'load': run_load,
+    'clean': run_clean,
+    'transform': run_transform,
+    'analysis': run_analysis,
+}
+
+def selected_stages(start=None, only=None):
+    if only:
+        return [only]
+    return STAGES[STAGES.index(start):] if start else STAGES
+
+def run_pipeline(stages=STAGES, forced=(), services=ENABLED_SERVICES, options=None):
+    # Runs `stages` in order. Forced stages run even when their fingerprint
+    # matches, and the clean/transform stages then redo every month instead
+    # of only the pending ones. Returns True when every stage succeeded.
+    con = None
+    options = options or argparse.Namespace(source=TRIP_DATA_SOURCE, years=YEARS, months=MONTHS, load_mode=LOAD_MODE)
+
+    try:
+        con = connect(stage='pipeline')
+        ensure_manifest(con)
+
+        for stage in stages:
+            fingerprint = stage_fingerprint(con, stage, services)
+            key = f"stage:{stage}"
+            if stage not in forced and fingerprint is not None and get_fingerprint(con, key) == fingerprint:
+                logger.info(f"Skipping {stage}: inputs unchanged since the last run")
+                flush_logs()
+                continue
+
+            if stage in forced and stage in ('clean', 'transform'):
+                for service in services:
+                    reset_progress(con, stage, service)
+
+            logger.info(f"Running {stage} for {', '.join(services)}")
+            flush_logs()
+            with tagged(con, stage=stage):
+                RUNNERS[stage](con, services, options)
+            flush_metrics(con)
+
+            # Recorded after the run: the stage's own writes are not among its
+            # inputs, so the fingerprint taken before it ran is still current
+            if fingerprint is not None:
+                set_fingerprint(con, key, fingerprint)
+            logger.info(f"Finished {stage}")
+            flush_logs()
+
+        # Readers are served from snapshots, published only after a
+        # successful run
+        generation = publish_snapshot(con)
+        if generation:
+            logger.info(f"Published snapshot {generation}")
+            flush_logs()
+
+        return True
+
+    except Exception as e:
+        logger.error(f"Pipeline failed: {e}")
+        flush_logs()
+        return False
+
+    finally:
+        if con is not None:
+            flush_metrics(con)
+            con.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the trip emissions pipeline, skipping stages whose inputs have not changed")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--from', dest='start', choices=STAGES, help='rerun this stage and everything after it')
+    group.add_argument('--only', choices=STAGES, help='rerun just this stage')
+    parser.add_argument('--services', default=",".join(ENABLED_SERVICES), help='comma separated services')
+    parser.add_argument('--source', default=TRIP_DATA_SOURCE)
+    parser.add_argument('--years', type=int, nargs='+', default=list(YEARS))
+    parser.add_argument('--months', type=int, nargs='+', default=list(MONTHS))
+    parser.add_argument('--load-mode', choices=LOAD_MODES, default=LOAD_MODE, help='multi-file scan or one file at a time')
+    options = parser.parse_args()
+
+    stages = selected_stages(options.start, options.only)
+    forced = stages if options.start or options.only else ()
+    services = [s for s in options.services.split(',') if s]
+    if not run_pipeline(stages, forced, services, options):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
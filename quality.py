@@ -0,0 +1,50 @@
+import json
+import os
+from datetime import datetime
+
+# Single-scan data quality profiler. Every check count and every per-column
+# statistic for a table is computed by one aggregate query, so profiling costs
+# about one scan no matter how many rules are checked.
+REPORT_PATH = os.environ.get('QUALITY_REPORT_PATH', 'data_quality_report.json')
+
+def profile_table(con, table, checks):
+    # checks: {name: SQL predicate that is true for a violating row}
+    columns = [row[0] for row in con.execute(f"DESCRIBE {table};").fetchall()]
+    selects = ["COUNT(*)"]
+    selects += [f"COUNT_IF({predicate})" for predicate in checks.values()]
+    for column in columns:
+        selects += [f"COUNT(*) - COUNT({column})", f"MIN({column})::VARCHAR", f"MAX({column})::VARCHAR",
+                    f"approx_count_distinct({column})"]
+    values = list(con.execute(f"SELECT {', '.join(selects)} FROM {table};").fetchone())
+
+    report = {'table': table, 'row_count': values.pop(0), 'checks': {}, 'columns': {}}
+    for name in checks:
+        report['checks'][name] = values.pop(0)
+    for column in columns:
+        nulls, min_value, max_value, distinct = values[:4]
+        del values[:4]
+        report['columns'][column] = {'nulls': nulls, 'min': min_value, 'max': max_value, 'approx_distinct': distinct}
+    return report
+
+def failed_checks(report, thresholds):
+    # Names of checks whose violation count is above its threshold. Checks
+    # without an explicit threshold allow no violations.
+    return [name for name, count in report['checks'].items() if count > thresholds.get(name, 0)]
+
+def write_report(con, reports, path=REPORT_PATH):
+    with open(path, 'w') as f:
+        json.dump(reports, f, indent=2, default=str)
+
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS data_quality_report (profiled_at TIMESTAMP, table_name VARCHAR, column_name VARCHAR, metric VARCHAR, value VARCHAR);
+    """)
+    rows = []
+    for report in reports:
+        rows.append((report['table'], None, 'row_count', report['row_count']))
+        rows += [(report['table'], None, name, count) for name, count in report['checks'].items()]
+        for column, stats in report['columns'].items():
+            rows += [(report['table'], column, metric, value) for metric, value in stats.items()]
+    profiled_at = datetime.now()
+    con.executemany("""
+    INSERT INTO data_quality_report VALUES (?, ?, ?, ?, ?);
+    """, [(profiled_at, table, column, metric, None if value is None else str(value)) for table, column, metric, value in rows])
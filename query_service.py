@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pyarrow as pa
+
+import api
+from snapshots import SNAPSHOT_DIR, current_generation, open_snapshot
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='query_service.log',
+    filemode='a',
+    force=True
+)
+
+logger = logging.getLogger(__name__)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+def flush_logs():
+    for handler in logger.handlers:
+        handler.flush()
+
+# HTTP service answering the api.py queries from the last published snapshot
+# (see snapshots.py), so dashboards keep working while a pipeline run holds
+# emissions.duckdb. Every request runs on its own cursor of one in-memory
+# DuckDB database over the snapshot's Parquet files; cursors of one database
+# run in parallel. When a new generation is published, requests already
+# running finish on the old one and the next request gets the new one.
+#
+#   python query_service.py --port 8022
+#   curl 'localhost:8022/hourly?services=yellow&format=json'
+#   curl 'localhost:8022/heaviest_trips?n=5' > trips.arrows       # Arrow IPC stream
+HOST = os.environ.get('QUERY_SERVICE_HOST', '127.0.0.1')
+PORT = int(os.environ.get('QUERY_SERVICE_PORT', '8022'))
+POLL_SECONDS = float(os.environ.get('SNAPSHOT_POLL_SECONDS', '2'))
+BATCH_ROWS = 65536
+
+QUERIES = {
+    'hourly': api.hourly_emissions,
+    'weekday': api.weekday_emissions,
+    'monthly': api.monthly_emissions,
+    'yearly': api.yearly_totals,
+    'daily_series': api.daily_series,
+    'hourly_series': api.hourly_series,
+    'heaviest_trips': api.heaviest_trips,
+}
+
+class SnapshotPool:
+    # The current generation's database, swapped when CURRENT changes. The
+    # pointer is read at most every POLL_SECONDS.
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR, poll_seconds=POLL_SECONDS):
+        self.snapshot_dir = snapshot_dir
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.generation = None
+        self.database = None
+        self.checked_at = 0.0
+
+    def refresh(self):
+        latest = current_generation(self.snapshot_dir)
+        if latest and latest != self.generation:
+            generation, database = open_snapshot(self.snapshot_dir, latest)
+            # Cursors handed out earlier keep the old database alive until
+            # they are closed
+            self.generation, self.database = generation, database
+            logger.info(f"Serving snapshot {generation}")
+            flush_logs()
+
+    def cursor(self):
+        # (generation, cursor) for one request; the caller closes the cursor
+        with self.lock:
+            now = time.monotonic()
+            if self.database is None or now - self.checked_at >= self.poll_seconds:
+                self.checked_at = now
+                self.refresh()
+            if self.database is None:
+                raise FileNotFoundError(f"No snapshot has been published in {self.snapshot_dir}")
+            return self.generation, self.database.cursor()
+
+def query_arguments(name, params):
+    arguments = {}
+    if 'services' in params:
+        arguments['services'] = [s for s in params['services'][0].split(',') if s]
+    if name == 'heaviest_trips' and 'n' in params:
+        arguments['n'] = int(params['n'][0])
+    return arguments
+
+class ChunkedWriter:
+    # HTTP/1.1 chunked body for a response of unknown length. The closing
+    # empty chunk is only written by finish(), so a client of a stream that
+    # failed halfway sees an incomplete response rather than a complete,
+    # shorter Arrow stream.
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + bytes(data) + b"\r\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.closed = True
+
+    def finish(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 for chunked Arrow streams; JSON responses carry a Content-Length
+    protocol_version = 'HTTP/1.1'
+    pool = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        params = parse_qs(url.query)
+        if name == 'snapshot':
+            return self.send_json({'generation': current_generation(self.pool.snapshot_dir)})
+        if name not in QUERIES:
+            return self.send_json({'error': f"Unknown query {name}", 'queries': sorted(QUERIES)}, status=404)
+
+        started = time.perf_counter()
+        self.headers_sent = False
+        try:
+            generation, cursor = self.pool.cursor()
+        except FileNotFoundError as e:
+            return self.send_json({'error': str(e)}, status=503)
+        try:
+            if params.get('format', ['arrow'])[0] == 'json':
+                table = QUERIES[name](cursor, **query_arguments(name, params))
+                self.send_json(table.to_pylist(), generation=generation)
+            else:
+                # Streamed batch by batch, never materialized as one table
+                reader = QUERIES[name](cursor, batch_size=BATCH_ROWS, **query_arguments(name, params))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/vnd.apache.arrow.stream')
+                self.send_header('X-Snapshot', generation)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.headers_sent = True
+                body = ChunkedWriter(self.wfile)
+                writer = pa.ipc.new_stream(body, reader.schema)
+                for batch in reader:
+                    writer.write_batch(batch)
+                # The Arrow end-of-stream marker, then the end of the body
+                writer.close()
+                body.finish()
+        except Exception as e:
+            logger.error(f"Query {name} failed: {e}")
+            flush_logs()
+            if self.headers_sent:
+                # Part of the response is already out; an error body would
+                # corrupt it, so the body is left unterminated instead
+                self.close_connection = True
+            else:
+                self.send_json({'error': str(e)}, status=400)
+        finally:
+            cursor.close()
+        logger.info(f"{name} from {generation} in {time.perf_counter() - started:.3f}s")
+
+    def send_json(self, body, status=200, generation=None):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if generation:
+            self.send_header('X-Snapshot', generation)
+        self.end_headers()
+        self.headers_sent = True
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Requests are logged once, with their timing, in do_GET
+        pass
+
+def serve(host=HOST, port=PORT, snapshot_dir=SNAPSHOT_DIR):
+    QueryHandler.pool = SnapshotPool(snapshot_dir)
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    logger.info(f"Query service listening on {host}:{port} over snapshots in {snapshot_dir}")
+    flush_logs()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve analysis queries from the last published snapshot")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.snapshot_dir)
+
+if __name__ == "__main__":
+    main()
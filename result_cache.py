@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import uuid
+
+# Cache of analysis query results. An entry is keyed on the normalized SQL,
+# its parameters and the version of every table the query reads, so it is
+# invalidated automatically when a transform changes those tables. Results
+# are stored as Parquet files under RESULT_CACHE_DIR and indexed in the
+# result_cache table; least recently used entries are evicted once the files
+# exceed the byte budget.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join('.cache', 'results'))
+RESULT_CACHE_BUDGET_BYTES = int(float(os.environ.get('RESULT_CACHE_BUDGET_MB', '256')) * 1024 ** 2)
+
+def ensure_result_cache(con):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS result_cache (
+        key VARCHAR PRIMARY KEY, statement VARCHAR, path VARCHAR, bytes BIGINT, created_at TIMESTAMP, last_used TIMESTAMP
+    );
+    """)
+
+# Stages whose stage_progress rows move when they replace partitions of a
+# table. The cube is rebuilt from the rollups.
+TABLE_STAGES = {
+    'trips_clean': ['clean'],
+    'trip_quarantine': ['clean'],
+    'trip_fingerprints': ['clean'],
+    'trips_transform': ['transform'],
+    'trip_rollup_hourly': ['rollup'],
+    'trip_rollup_daily': ['rollup'],
+    'emissions_cube': ['rollup'],
+    'trip_samples': ['sample'],
+    'sample_strata': ['sample'],
+    'emissions_daily_series': ['timeseries'],
+    'emissions_hourly_series': ['timeseries'],
+}
+
+def table_version(con, tables):
+    # Row counts of the tables plus the latest stage_progress timestamp of the
+    # stages that write them, which moves whenever one of those stages
+    # replaces a partition (a new "generation"). Without tables, any stage's
+    # progress counts.
+    if not tables:
+        return f"[]|{con.execute('SELECT max(processed_at) FROM stage_progress;').fetchone()[0]}"
+    names = ", ".join(repr(t) for t in tables)
+    counts = con.execute(f"""
+    SELECT table_name, estimated_size FROM duckdb_tables() WHERE table_name IN ({names}) ORDER BY table_name;
+    """).fetchall()
+    stages = sorted({stage for table in tables for stage in TABLE_STAGES.get(table, [])})
+    generation = None
+    if stages:
+        generation = con.execute(f"""
+        SELECT max(processed_at) FROM stage_progress WHERE stage IN ({", ".join(repr(s) for s in stages)});
+        """).fetchone()[0]
+    return f"{counts}|{generation}"
+
+def result_key(sql, parameters, version):
+    normalized = " ".join(sql.split())
+    return hashlib.sha256(json.dumps([normalized, parameters, version], default=str).encode()).hexdigest()
+
+def cached_query(con, sql, parameters=None, tables=(), version=None, cache_dir=RESULT_CACHE_DIR):
+    # Run a read-only query through the cache and return a DataFrame. Callers
+    # issuing several queries against the same tables can pass the version
+    # from table_version() to avoid recomputing it per query.
+    ensure_result_cache(con)
+    key = result_key(sql, parameters, version or table_version(con, tables))
+    row = con.execute("SELECT path FROM result_cache WHERE key = ?;", [key]).fetchone()
+    if row and os.path.exists(row[0]):
+        con.execute("UPDATE result_cache SET last_used = now()::TIMESTAMP WHERE key = ?;", [key])
+        return con.execute("SELECT * FROM read_parquet(?);", [row[0]]).fetchdf()
+
+    result = con.execute(sql, parameters).fetchdf() if parameters is not None else con.execute(sql).fetchdf()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.parquet")
+    # Written under a temporary name and renamed, so readers never see half a file
+    partial = f"{path}.{uuid.uuid4().hex}.tmp"
+    con.register('cached_result', result)
+    try:
+        con.execute(f"COPY cached_result TO '{partial}' (FORMAT parquet);")
+    finally:
+        con.unregister('cached_result')
+    os.replace(partial, path)
+    con.execute("""
+    INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?, now()::TIMESTAMP, now()::TIMESTAMP);
+    """, [key, " ".join(sql.split()), path, os.path.getsize(path)])
+    evict_results(con)
+    return result
+
+def evict_results(con, budget_bytes=RESULT_CACHE_BUDGET_BYTES):
+    # Drop least recently used entries until the cached files fit the budget.
+    # Returns the number of entries removed.
+    entries = con.execute("SELECT key, path, bytes FROM result_cache ORDER BY last_used DESC;").fetchall()
+    kept = 0
+    evicted = []
+    for key, path, size in entries:
+        if kept + size <= budget_bytes:
+            kept += size
+        else:
+            evicted.append(key)
+            if os.path.exists(path):
+                os.remove(path)
+    if evicted:
+        con.executemany("DELETE FROM result_cache WHERE key = ?;", [[key] for key in evicted])
+    return len(evicted)
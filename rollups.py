@@ -0,0 +1,95 @@
+from instrument import tagged
+from manifest import pending_partitions, mark_processed, reset_progress
+
+# Hourly and daily rollups of the transform tables. Both are keyed by the
+# source partition (service, source_year, source_month) as well as the pickup
+# date/hour, so a newly transformed month is merged by replacing only that
+# month's rows: the rest of the history is never re-aggregated. Readers sum
+# the partial aggregates across partitions.
+
+def ensure_rollups(con):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS trip_rollup_hourly (
+        service_type VARCHAR, source_year SMALLINT, source_month UTINYINT, trip_date DATE, hour_of_day TINYINT,
+        trip_count BIGINT,
+        co2_kg_sum DOUBLE, co2_kg_min DOUBLE, co2_kg_max DOUBLE,
+        distance_sum DOUBLE, distance_min DOUBLE, distance_max DOUBLE,
+        mph_count BIGINT, mph_sum DOUBLE, mph_min DOUBLE, mph_max DOUBLE,
+        PRIMARY KEY (service_type, source_year, source_month, trip_date, hour_of_day)
+    );
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS trip_rollup_daily (
+        service_type VARCHAR, source_year SMALLINT, source_month UTINYINT, trip_date DATE,
+        trip_count BIGINT,
+        co2_kg_sum DOUBLE, co2_kg_min DOUBLE, co2_kg_max DOUBLE,
+        distance_sum DOUBLE, distance_min DOUBLE, distance_max DOUBLE,
+        mph_count BIGINT, mph_sum DOUBLE, mph_min DOUBLE, mph_max DOUBLE,
+        largest_trip STRUCT(vendor_id INTEGER, pickup_datetime TIMESTAMP, dropoff_datetime TIMESTAMP, trip_distance DOUBLE, trip_co2_kgs DOUBLE),
+        PRIMARY KEY (service_type, source_year, source_month, trip_date)
+    );
+    """)
+
+def merge_partition(con, service, year, month):
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        for table in ('trip_rollup_hourly', 'trip_rollup_daily'):
+            con.execute(f"""
+            DELETE FROM {table} WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month};
+            """)
+        con.execute(f"""
+        INSERT INTO trip_rollup_hourly
+        SELECT '{service}', source_year, source_month, pickup_datetime::DATE, hour_of_day,
+               COUNT(*),
+               SUM(trip_co2_kgs), MIN(trip_co2_kgs), MAX(trip_co2_kgs),
+               SUM(trip_distance), MIN(trip_distance), MAX(trip_distance),
+               COUNT(avg_mph), SUM(avg_mph), MIN(avg_mph), MAX(avg_mph)
+        FROM trips_transform
+        WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month}
+        GROUP BY ALL;
+        """)
+        con.execute(f"""
+        INSERT INTO trip_rollup_daily
+        SELECT h.*, l.largest_trip
+        FROM (
+            SELECT service_type, source_year, source_month, trip_date,
+                   SUM(trip_count),
+                   SUM(co2_kg_sum), MIN(co2_kg_min), MAX(co2_kg_max),
+                   SUM(distance_sum), MIN(distance_min), MAX(distance_max),
+                   SUM(mph_count), SUM(mph_sum), MIN(mph_min), MAX(mph_max)
+            FROM trip_rollup_hourly
+            WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month}
+            GROUP BY ALL
+        ) h
+        LEFT JOIN (
+            SELECT pickup_datetime::DATE AS trip_date,
+                   arg_max({{'vendor_id': vendor_id, 'pickup_datetime': pickup_datetime, 'dropoff_datetime': dropoff_datetime,
+                             'trip_distance': trip_distance, 'trip_co2_kgs': trip_co2_kgs}}, trip_co2_kgs) AS largest_trip
+            FROM trips_transform
+            WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month}
+            GROUP BY ALL
+        ) l USING (trip_date);
+        """)
+        mark_processed(con, 'rollup', service, year, month)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+def update_rollups(con, service):
+    # Merge every month transformed since the rollups were last updated.
+    # Returns the merged partitions. The tables are created by
+    # prepare_transform, before services are updated concurrently.
+    partitions = pending_partitions(con, 'rollup', service, upstream='transform')
+    for year, month in partitions:
+        with tagged(con, source_year=year, source_month=month):
+            merge_partition(con, service, year, month)
+    return partitions
+
+def rebuild_rollups(con, service):
+    # Drop the service from the rollups so the next update re-merges all of
+    # its transformed months.
+    ensure_rollups(con)
+    for table in ('trip_rollup_hourly', 'trip_rollup_daily'):
+        con.execute(f"DELETE FROM {table} WHERE service_type = ?;", [service])
+    reset_progress(con, 'rollup', service)
@@ -0,0 +1,83 @@
+import math
+import os
+
+from instrument import tagged
+from manifest import pending_partitions, mark_processed, reset_progress
+
+# Persisted stratified sample of trips_transform for approximate analytics.
+# Every (service, source_year, source_month) partition is a stratum: a simple
+# random sample of SAMPLE_FRACTION of its trips (at least SAMPLE_MIN_ROWS, or
+# the whole month when it is smaller) is kept in trip_samples, and the
+# stratum's population and sample size in sample_strata, which is what the
+# estimators in approximate.py weight by. Like the rollups, a newly
+# transformed month only replaces its own stratum.
+SAMPLE_FRACTION = float(os.environ.get('SAMPLE_FRACTION', '0.01'))
+SAMPLE_MIN_ROWS = int(os.environ.get('SAMPLE_MIN_ROWS', '1000'))
+SAMPLE_SEED = 3022
+
+def ensure_samples(con):
+    # trip_samples mirrors the trips_transform layout; when that layout
+    # changes the samples are dropped and every month is sampled again
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS sample_strata (
+        service_type VARCHAR, source_year SMALLINT, source_month UTINYINT,
+        population BIGINT, sample_rows BIGINT,
+        PRIMARY KEY (service_type, source_year, source_month)
+    );
+    """)
+    layout = """
+    SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = ? ORDER BY column_index;
+    """
+    expected = con.execute(layout, ['trips_transform']).fetchall()
+    current = con.execute(layout, ['trip_samples']).fetchall()
+    if current != expected:
+        con.execute("DROP TABLE IF EXISTS trip_samples;")
+        con.execute("CREATE TABLE trip_samples AS SELECT * FROM trips_transform LIMIT 0;")
+        con.execute("DELETE FROM sample_strata;")
+        for (service,) in con.execute("SELECT DISTINCT service_type FROM stage_progress WHERE stage = 'sample';").fetchall():
+            reset_progress(con, 'sample', service)
+
+def sample_size(population, fraction=SAMPLE_FRACTION, min_rows=SAMPLE_MIN_ROWS):
+    return min(population, max(min_rows, math.ceil(population * fraction)))
+
+def sample_partition(con, service, year, month):
+    # Replace one stratum in a single transaction
+    where = f"service_type = '{service}' AND source_year = {year} AND source_month = {month}"
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"DELETE FROM trip_samples WHERE {where};")
+        con.execute(f"DELETE FROM sample_strata WHERE {where};")
+        population = con.execute(f"SELECT COUNT(*) FROM trips_transform WHERE {where};").fetchone()[0]
+        rows = sample_size(population)
+        if rows:
+            # REPEATABLE keeps a re-sampled month identical for identical input
+            con.execute(f"""
+            INSERT INTO trip_samples
+            SELECT * FROM (SELECT * FROM trips_transform WHERE {where})
+            USING SAMPLE reservoir({rows} ROWS) REPEATABLE ({SAMPLE_SEED});
+            """)
+            con.execute("""
+            INSERT INTO sample_strata VALUES (?, ?, ?, ?, ?);
+            """, [service, year, month, population, rows])
+        mark_processed(con, 'sample', service, year, month)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+def update_samples(con, service):
+    # Re-sample every month transformed since the samples were last updated.
+    # Returns the sampled partitions. The tables are created by
+    # prepare_transform, before services are updated concurrently.
+    partitions = pending_partitions(con, 'sample', service, upstream='transform')
+    for year, month in partitions:
+        with tagged(con, source_year=year, source_month=month):
+            sample_partition(con, service, year, month)
+    return partitions
+
+def rebuild_samples(con, service):
+    # Drop the service's strata so the next update samples all of its months
+    ensure_samples(con)
+    for table in ('trip_samples', 'sample_strata'):
+        con.execute(f"DELETE FROM {table} WHERE service_type = ?;", [service])
+    reset_progress(con, 'sample', service)
@@ -0,0 +1,129 @@
+import os
+from datetime import date
+
+from manifest import get_fingerprint, set_fingerprint
+
+# Every trip service the pipeline knows about. Each entry maps the columns of
+# that service's monthly files onto the canonical trips columns and names the
+# vehicle_emissions row used for its CO2 factor. Supporting a new service is a
+# new entry here; no stage has a per-service code path.
+#
+# skip_rules lists cleaning rules that cannot apply because the source has no
+# such column (high volume FHV files carry no passenger count).
+SERVICES = {
+    'yellow': {
+        'vehicle_type': 'yellow_taxi',
+        'columns': {
+            'vendor_id': 'VendorID',
+            'pickup_datetime': 'tpep_pickup_datetime',
+            'dropoff_datetime': 'tpep_dropoff_datetime',
+            'passenger_count': 'passenger_count',
+            'trip_distance': 'trip_distance',
+        },
+    },
+    'green': {
+        'vehicle_type': 'green_taxi',
+        'columns': {
+            'vendor_id': 'VendorID',
+            'pickup_datetime': 'lpep_pickup_datetime',
+            'dropoff_datetime': 'lpep_dropoff_datetime',
+            'passenger_count': 'passenger_count',
+            'trip_distance': 'trip_distance',
+        },
+    },
+    'fhvhv': {
+        'vehicle_type': 'uber_x',
+        'columns': {
+            'vendor_id': "TRY_CAST(substr(hvfhs_license_num, 3) AS INTEGER)",
+            'pickup_datetime': 'pickup_datetime',
+            'dropoff_datetime': 'dropoff_datetime',
+            'passenger_count': 'NULL',
+            'trip_distance': 'trip_miles',
+        },
+        'skip_rules': ['zero_passengers'],
+    },
+}
+
+# Services processed by default; override with e.g. TRIP_SERVICES=yellow,green,fhvhv
+ENABLED_SERVICES = [s for s in os.environ.get('TRIP_SERVICES', 'yellow,green').split(',') if s]
+
+# Canonical trip columns, in table order, with their types
+TRIP_COLUMNS = {
+    'vendor_id': 'INTEGER',
+    'pickup_datetime': 'TIMESTAMP',
+    'dropoff_datetime': 'TIMESTAMP',
+    'passenger_count': 'INTEGER',
+    'trip_distance': 'DOUBLE',
+}
+
+# Partition key columns every trips table starts with
+PARTITION_COLUMNS = 'service_type service_type, source_year SMALLINT, source_month UTINYINT'
+
+# Order the clean and transform tables are written in: partition by
+# partition, and by pickup time within each, so the zone maps of
+# pickup_datetime stay tight and pickup_range_sql filters skip every row group
+# outside their range
+PICKUP_ORDER = 'service_type, source_year, source_month, pickup_datetime'
+
+def trip_columns_ddl():
+    return f"{PARTITION_COLUMNS}, " + ", ".join(f"{name} {sql_type}" for name, sql_type in TRIP_COLUMNS.items())
+
+def period_range(year, month=None):
+    # (start, end) of a calendar year or month, for pickup_range_sql
+    if month is None:
+        return date(year, 1, 1), date(year + 1, 1, 1)
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+def pickup_range_sql(start=None, end=None, column='pickup_datetime'):
+    # Pickup time filter as the half-open range [start, end). Unlike
+    # year(pickup_datetime) = ..., a plain comparison is checked against the
+    # zone maps, so only the row groups inside the range are read.
+    filters = []
+    if start is not None:
+        filters.append(f"{column} >= TIMESTAMP '{start}'")
+    if end is not None:
+        filters.append(f"{column} < TIMESTAMP '{end}'")
+    return " AND ".join(filters) or "true"
+
+def ensure_pickup_order(con, table):
+    # Rewrite, once, a table written before PICKUP_ORDER was kept; every later
+    # partition is inserted in that order
+    if get_fingerprint(con, f"layout:{table}") == PICKUP_ORDER:
+        return
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"CREATE OR REPLACE TABLE {table}_sorted AS SELECT * FROM {table} ORDER BY {PICKUP_ORDER};")
+        con.execute(f"DROP TABLE {table};")
+        con.execute(f"ALTER TABLE {table}_sorted RENAME TO {table};")
+        set_fingerprint(con, f"layout:{table}", PICKUP_ORDER)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+def ensure_service_type(con):
+    # service_type is an ENUM of the registry so the large tables store one
+    # byte per row. When the registry changes, the ENUM is rebuilt and the
+    # columns that use it are converted through VARCHAR.
+    wanted = list(SERVICES)
+
+    # Plain lookup of each service's emissions row, for SQL-only consumers (dbt)
+    con.execute("CREATE OR REPLACE TABLE service_types (service_type VARCHAR, vehicle_type VARCHAR);")
+    con.executemany("INSERT INTO service_types VALUES (?, ?);", [(name, s['vehicle_type']) for name, s in SERVICES.items()])
+
+    exists = con.execute("SELECT COUNT(*) FROM duckdb_types() WHERE type_name = 'service_type';").fetchone()[0]
+    if exists:
+        current = con.execute("SELECT enum_range(NULL::service_type);").fetchone()[0]
+        if list(current) == wanted:
+            return
+        users = con.execute("""
+        SELECT table_name, column_name FROM duckdb_columns() WHERE data_type LIKE 'ENUM%' AND column_name = 'service_type';
+        """).fetchall()
+        for table, column in users:
+            con.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE VARCHAR;")
+        con.execute("DROP TYPE service_type;")
+        con.execute(f"CREATE TYPE service_type AS ENUM ({', '.join(repr(s) for s in wanted)});")
+        for table, column in users:
+            con.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE service_type;")
+    else:
+        con.execute(f"CREATE TYPE service_type AS ENUM ({', '.join(repr(s) for s in wanted)});")
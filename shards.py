@@ -0,0 +1,476 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from pipeline import run_pipeline
+from clean import DUPLICATE, TRIP_FIELDS, prepare_clean, clean_service, fingerprint_sql, orphaned_partitions, rejection_stats, verify_clean
+from database import connect
+from instrument import tagged, flush_metrics
+from load import TRIP_DATA_SOURCE, YEARS, MONTHS, LOAD_MODE, REQUESTS_PER_SECOND, prepare_load, load_months
+from manifest import ensure_manifest, pending_partitions, mark_processed, get_fingerprint, set_fingerprint
+from result_cache import table_version
+from rollups import update_rollups
+from samples import update_samples
+from services import ENABLED_SERVICES, PICKUP_ORDER
+from timeseries import update_timeseries
+from transform import prepare_transform, transform_partition
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='shards.log',
+    filemode='a',
+    force=True
+)
+
+logger = logging.getLogger(__name__)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+def flush_logs():
+    for handler in logger.handlers:
+        handler.flush()
+
+# Sharded load/clean/transform. Every (service, year) is a shard, processed by
+# a worker process in a database of its own (SHARD_DIR/<service>-<year>/
+# shard.duckdb) and exported as standalone Parquet files of its trips_clean,
+# trip_quarantine and trips_transform. The coordinator then merges the shards
+# into emissions.duckdb and brings the rollups, samples and time series up to
+# date from there; analysis runs on the merged database as usual.
+#
+# Work is handed out through a queue of files in SHARD_DIR/queue, so workers on
+# other machines can join from a shared directory (`shards.py work`). A worker
+# claims a shard by renaming <shard>.todo to <shard>.running.<owner>; the
+# rename succeeds for exactly one of them. A finished shard becomes
+# <shard>.done, a failed one goes back to todo until it has failed
+# SHARD_ATTEMPTS times. Shard databases are kept between runs, so a retried or
+# repeated shard only loads and cleans the months whose files changed.
+#
+# A shard only sees its own year, so a trip duplicated across a year boundary
+# is caught when the shard is merged: rows whose fingerprint another merged
+# shard already holds are quarantined as duplicates there, as clean_service
+# does for a later month.
+SHARD_DIR = os.environ.get('SHARD_DIR', 'shards')
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', str(os.cpu_count() or 1)))
+SHARD_ATTEMPTS = int(os.environ.get('SHARD_ATTEMPTS', '3'))
+# Workers touch their claim every HEARTBEAT_SECONDS; a claim on another host
+# not touched for SHARD_TIMEOUT_SECONDS is taken to belong to a worker that died
+HEARTBEAT_SECONDS = 60
+SHARD_TIMEOUT_SECONDS = int(os.environ.get('SHARD_TIMEOUT_SECONDS', '900'))
+POLL_SECONDS = 2
+SHARD_TABLES = ['trips_clean', 'trip_quarantine', 'trips_transform']
+
+def shard_name(service, year):
+    return f"{service}-{year}"
+
+def shard_path(shard_dir, service, year):
+    return os.path.join(shard_dir, shard_name(service, year))
+
+def queue_path(shard_dir, name=''):
+    return os.path.join(shard_dir, 'queue', name)
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def write_json(path, data):
+    # Complete before it gets its name
+    staging = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(staging, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(staging, path)
+
+def queue_entries(shard_dir, state):
+    # [(shard, owner, file name)] of the queue entries in `state`
+    entries = []
+    for name in sorted(os.listdir(queue_path(shard_dir))):
+        parts = name.split('.', 2)
+        if len(parts) >= 2 and parts[1] == state and not name.endswith('.tmp'):
+            entries.append((parts[0], parts[2] if len(parts) == 3 else None, name))
+    return entries
+
+def enqueue(shard_dir, source, years, months, services):
+    # Start a run: every shard to do, nothing claimed, done or failed
+    os.makedirs(queue_path(shard_dir), exist_ok=True)
+    for name in os.listdir(queue_path(shard_dir)):
+        os.remove(queue_path(shard_dir, name))
+    shards = [(service, year) for service in services for year in years]
+    for service, year in shards:
+        write_json(queue_path(shard_dir, f"{shard_name(service, year)}.todo"), {
+            'service': service, 'year': year, 'months': list(months), 'source': source, 'attempts': 0,
+        })
+    return shards
+
+def claim(shard_dir, owner):
+    # Path of a shard this worker now owns, or None when none is left to do
+    for shard, _, name in queue_entries(shard_dir, 'todo'):
+        running = queue_path(shard_dir, f"{shard}.running.{owner}")
+        try:
+            os.rename(queue_path(shard_dir, name), running)
+        except FileNotFoundError:
+            continue  # claimed by another worker first
+        return running
+    return None
+
+def release(shard_dir, path, spec, error):
+    # Back to todo for another attempt, or failed after SHARD_ATTEMPTS
+    spec['attempts'] += 1
+    spec['error'] = error
+    state = 'todo' if spec['attempts'] < SHARD_ATTEMPTS else 'failed'
+    write_json(queue_path(shard_dir, f"{shard_name(spec['service'], spec['year'])}.{state}"), spec)
+    os.remove(path)
+    return state
+
+def export_shard(con, path, service, year, failed):
+    # Write the shard's tables to a new out-<generation> directory and point
+    # shard.json at it. Nothing is written when the tables have not changed
+    # since the last export.
+    meta_path = os.path.join(path, 'shard.json')
+    version = table_version(con, SHARD_TABLES)
+    meta = read_json(meta_path) if os.path.exists(meta_path) else None
+    if meta and meta['version'] == version and os.path.isdir(os.path.join(path, meta['generation'])):
+        if meta['failed'] != failed:
+            write_json(meta_path, {**meta, 'failed': failed})
+        return meta['generation']
+
+    generation = f"out-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}"
+    staging = os.path.join(path, f".{generation}.tmp")
+    os.makedirs(staging)
+    for table in SHARD_TABLES:
+        con.execute(f"""
+        COPY (SELECT * FROM {table} ORDER BY {PICKUP_ORDER})
+        TO '{os.path.join(staging, table + '.parquet')}' (FORMAT parquet);
+        """)
+    os.rename(staging, os.path.join(path, generation))
+    months = con.execute("""
+    SELECT source_month, source, source_size, source_etag, row_count
+    FROM load_manifest WHERE service_type = ? AND source_year = ? ORDER BY source_month;
+    """, [service, year]).fetchall()
+    write_json(meta_path, {
+        'service': service, 'year': year, 'generation': generation, 'version': version,
+        'months': [list(row) for row in months], 'failed': failed,
+        'exported_at': datetime.now().isoformat(),
+    })
+    for name in os.listdir(path):
+        if name.startswith('out-') and name != generation:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return generation
+
+def run_shard(shard_dir, spec):
+    # Load, clean and transform one (service, year) in its own database, then
+    # export it. Returns the exported generation.
+    service, year = spec['service'], spec['year']
+    path = shard_path(shard_dir, service, year)
+    os.makedirs(path, exist_ok=True)
+    con = connect(os.path.join(path, 'shard.duckdb'), stage='shard')
+    try:
+        # Spill files of concurrent workers must not share a directory
+        con.execute(f"SET temp_directory = '{os.path.join(path, 'tmp')}';")
+        with tagged(con, service=service, source_year=year):
+            prepare_load(con)
+            failed = load_months(con, spec['source'], [year], spec['months'], [service], mode=LOAD_MODE)
+            prepare_clean(con)
+            clean_service(con, service)
+            # The rollups, samples and series are built after the merge
+            prepare_transform(con)
+            for partition_year, month in pending_partitions(con, 'transform', service, upstream='clean'):
+                with tagged(con, source_month=month):
+                    transform_partition(con, service, partition_year, month)
+            generation = export_shard(con, path, service, year, [month for _, _, month in failed])
+        flush_metrics(con)
+        return generation
+    finally:
+        con.close()
+
+@contextmanager
+def heartbeat(path):
+    # Keep the claim's mtime fresh while the shard is processed
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def work(shard_dir):
+    # Process shards until the queue has none left to do. Returns how many
+    # this worker finished.
+    owner = f"{socket.gethostname().replace('.', '_')}-{os.getpid()}"
+    finished = 0
+    while True:
+        path = claim(shard_dir, owner)
+        if path is None:
+            return finished
+        spec = read_json(path)
+        name = shard_name(spec['service'], spec['year'])
+        logger.info(f"Worker {owner} processing shard {name} (attempt {spec['attempts'] + 1})")
+        flush_logs()
+        try:
+            with heartbeat(path):
+                generation = run_shard(shard_dir, spec)
+        except Exception as e:
+            state = release(shard_dir, path, spec, str(e))
+            logger.error(f"Shard {name} failed, now {state}: {e}")
+            flush_logs()
+            continue
+        write_json(queue_path(shard_dir, f"{name}.done"), {**spec, 'generation': generation, 'owner': owner})
+        os.remove(path)
+        finished += 1
+        logger.info(f"Worker {owner} finished shard {name} as {generation}")
+        flush_logs()
+
+def is_stale(shard_dir, owner, name):
+    # A claim is given up when its worker ran on this host and has exited, or
+    # when its worker runs elsewhere and has not touched it for
+    # SHARD_TIMEOUT_SECONDS (that worker died)
+    host, _, pid = owner.rpartition('-')
+    if host == socket.gethostname().replace('.', '_') and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+    try:
+        age = time.time() - os.path.getmtime(queue_path(shard_dir, name))
+    except FileNotFoundError:
+        return False
+    return age > SHARD_TIMEOUT_SECONDS
+
+def worker_env(workers):
+    # Local workers split the machine between them: threads, memory and the
+    # request rate to the trip data host, unless those are set explicitly
+    env = dict(os.environ)
+    env.setdefault('DUCKDB_THREADS', str(max(1, (os.cpu_count() or 1) // workers)))
+    if not env.get('DUCKDB_MEMORY_LIMIT'):
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        env['DUCKDB_MEMORY_LIMIT'] = f"{int(memory * 0.8 / workers / 2 ** 20)}MiB"
+    env.setdefault('LOAD_REQUESTS_PER_SECOND', str(REQUESTS_PER_SECOND / workers))
+    return env
+
+def spawn_worker(shard_dir, env):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', '--shard-dir', shard_dir], env=env)
+
+def wait_for_shards(shard_dir, workers):
+    # Run up to `workers` local worker processes until every shard is done or
+    # failed; workers on other machines may take shards from the same queue.
+    env = worker_env(max(workers, 1))
+    processes = []
+    while True:
+        for shard, owner, name in queue_entries(shard_dir, 'running'):
+            if is_stale(shard_dir, owner, name):
+                path = queue_path(shard_dir, name)
+                try:
+                    spec = read_json(path)
+                except FileNotFoundError:
+                    continue
+                state = release(shard_dir, path, spec, f"worker {owner} stopped")
+                logger.warning(f"Shard {shard} abandoned by {owner}, now {state}")
+                flush_logs()
+        processes = [p for p in processes if p.poll() is None]
+        todo = len(queue_entries(shard_dir, 'todo'))
+        # A worker exits once nothing is left to claim; shards released
+        # after that get a new one
+        while len(processes) < min(workers, todo):
+            processes.append(spawn_worker(shard_dir, env))
+        if not todo and not processes and not queue_entries(shard_dir, 'running'):
+            return
+        time.sleep(POLL_SECONDS)
+
+def merge_shard(con, shard_dir, service, year):
+    # Replace the (service, year) partitions of the shared tables with the
+    # shard's export in one transaction. Clean rows whose fingerprint another
+    # shard of the service already holds are quarantined as duplicates, and
+    # their transformed rows left out.
+    meta = read_json(os.path.join(shard_path(shard_dir, service, year), 'shard.json'))
+    files = {table: os.path.join(shard_path(shard_dir, service, year), meta['generation'], f"{table}.parquet") for table in SHARD_TABLES}
+    scope = f"service_type = '{service}' AND source_year = {year}"
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        for table in ('trips_clean', 'trip_quarantine', 'trip_fingerprints', 'trips_transform'):
+            con.execute(f"DELETE FROM {table} WHERE {scope};")
+        con.execute(f"DELETE FROM stage_progress WHERE stage IN ('clean', 'transform') AND {scope};")
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE shard_clean AS
+        SELECT *, {fingerprint_sql()} AS fingerprint FROM read_parquet('{files['trips_clean']}');
+        """)
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE shard_seen AS
+        SELECT DISTINCT c.pickup_datetime, c.fingerprint
+        FROM shard_clean c
+        SEMI JOIN (
+            SELECT pickup_datetime, fingerprint FROM trip_fingerprints WHERE service_type = '{service}'
+        ) f ON f.pickup_datetime = c.pickup_datetime AND f.fingerprint = c.fingerprint;
+        """)
+        kept = """
+        FROM shard_clean c
+        ANTI JOIN shard_seen s ON s.pickup_datetime = c.pickup_datetime AND s.fingerprint = c.fingerprint
+        """
+        con.execute(f"INSERT INTO trips_clean BY NAME SELECT {TRIP_FIELDS} {kept} ORDER BY {PICKUP_ORDER};")
+        con.execute(f"""
+        INSERT INTO trip_fingerprints
+        SELECT service_type, source_year, source_month, pickup_datetime, fingerprint {kept}
+        ORDER BY pickup_datetime;
+        """)
+        con.execute(f"INSERT INTO trip_quarantine BY NAME SELECT * FROM read_parquet('{files['trip_quarantine']}');")
+        con.execute(f"""
+        INSERT INTO trip_quarantine BY NAME
+        SELECT {TRIP_FIELDS}, {DUPLICATE} AS reject_mask, 1 AS rejected_rows
+        FROM shard_clean c
+        SEMI JOIN shard_seen s ON s.pickup_datetime = c.pickup_datetime AND s.fingerprint = c.fingerprint;
+        """)
+        con.execute(f"""
+        INSERT INTO trips_transform BY NAME
+        SELECT * FROM (
+            SELECT t.*
+            FROM read_parquet('{files['trips_transform']}') t
+            ANTI JOIN shard_seen s ON s.pickup_datetime = t.pickup_datetime AND s.fingerprint = {fingerprint_sql('t')}
+        )
+        ORDER BY {PICKUP_ORDER};
+        """)
+        con.execute("DROP TABLE shard_clean;")
+        con.execute("DROP TABLE shard_seen;")
+        # Cleaned and transformed, but never loaded here: a later unsharded
+        # load of these months cleans them again from its own raw trips
+        for month, *_ in meta['months']:
+            mark_processed(con, 'clean', service, year, month)
+            mark_processed(con, 'transform', service, year, month)
+        set_fingerprint(con, f"shard:{shard_name(service, year)}", meta['generation'])
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    return meta
+
+def merge_shards(con, shard_dir, shards):
+    # Merge every exported shard whose generation has not been merged yet,
+    # each service's years in order so a duplicated trip is kept in the
+    # earlier year. Returns the merged shards.
+    exported = [(service, year) for service, year in sorted(shards)
+                if os.path.exists(os.path.join(shard_path(shard_dir, service, year), 'shard.json'))]
+    merged = []
+    for service, year in exported:
+        generation = read_json(os.path.join(shard_path(shard_dir, service, year), 'shard.json'))['generation']
+        if get_fingerprint(con, f"shard:{shard_name(service, year)}") == generation:
+            continue
+        with tagged(con, service=service, source_year=year):
+            meta = merge_shard(con, shard_dir, service, year)
+        merged.append((service, year))
+        if meta['failed']:
+            logger.warning(f"Shard {shard_name(service, year)} could not load months {meta['failed']}")
+        logger.info(f"Merged shard {shard_name(service, year)} ({meta['generation']})")
+        flush_logs()
+
+    # A shard merged again without a trip leaves the copy another shard
+    # quarantined against it orphaned; merging that shard again keeps it
+    for service in sorted({service for service, _ in exported}):
+        years = sorted({year for year, _ in orphaned_partitions(con, service) if (service, year) in exported})
+        for year in years:
+            logger.info(f"Merging shard {shard_name(service, year)} again: its duplicates lost their kept copy")
+            flush_logs()
+            merge_shard(con, shard_dir, service, year)
+    return merged
+
+def merge(shard_dir, shards, services):
+    # Merge into emissions.duckdb, then update everything built on
+    # trips_transform there
+    con = None
+    try:
+        con = connect(stage='merge')
+        ensure_manifest(con)
+        prepare_clean(con)
+        prepare_transform(con)
+        merged = merge_shards(con, shard_dir, shards)
+        logger.info(f"Merged {len(merged)} of {len(shards)} shards")
+        flush_logs()
+        for service in services:
+            with tagged(con, service=service):
+                update_rollups(con, service)
+                update_samples(con, service)
+                update_timeseries(con, service)
+        logger.info(f"Rejected rows by reason: {rejection_stats(con).to_dict(orient='records')}")
+        flush_logs()
+        if not verify_clean(con):
+            raise RuntimeError("Clean data failed verification")
+        flush_metrics(con)
+    finally:
+        if con is not None:
+            con.close()
+
+def run_sharded(source=TRIP_DATA_SOURCE, years=YEARS, months=MONTHS, services=ENABLED_SERVICES, workers=SHARD_WORKERS, shard_dir=SHARD_DIR):
+    # Returns the shards that failed every attempt. The others are merged even
+    # when some failed, so each failed shard can be retried on its own.
+    shards = enqueue(shard_dir, source, years, months, services)
+    logger.info(f"Queued {len(shards)} shards in {shard_dir} for {workers} local workers")
+    flush_logs()
+    started = time.perf_counter()
+    wait_for_shards(shard_dir, workers)
+    failed = [(shard, read_json(queue_path(shard_dir, name))['error']) for shard, _, name in queue_entries(shard_dir, 'failed')]
+    logger.info(f"Shards finished in {time.perf_counter() - started:.1f}s, {len(failed)} failed")
+    for shard, error in failed:
+        logger.error(f"Shard {shard} failed {SHARD_ATTEMPTS} times: {error}")
+    flush_logs()
+    merge(shard_dir, shards, services)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Load, clean and transform in (service, year) shards, then merge them")
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='queue every shard, run local workers, merge and analyze')
+    run.add_argument('--workers', type=int, default=SHARD_WORKERS, help='local worker processes; 0 leaves the shards to workers elsewhere')
+    run.add_argument('--services', default=",".join(ENABLED_SERVICES), help='comma separated services')
+    run.add_argument('--source', default=TRIP_DATA_SOURCE)
+    run.add_argument('--years', type=int, nargs='+', default=list(YEARS))
+    run.add_argument('--months', type=int, nargs='+', default=list(MONTHS))
+    run.add_argument('--skip-analysis', action='store_true', help='stop after the merge')
+    worker = commands.add_parser('work', help='process queued shards until none are left')
+    for command in (run, worker):
+        command.add_argument('--shard-dir', default=SHARD_DIR)
+    options = parser.parse_args()
+
+    if options.command == 'work':
+        work(options.shard_dir)
+        return
+    if options.command != 'run':
+        parser.print_help()
+        sys.exit(2)
+
+    services = [s for s in options.services.split(',') if s]
+    try:
+        failed = run_sharded(options.source, options.years, options.months, services, options.workers, options.shard_dir)
+    except Exception as e:
+        logger.error(f"Sharded run failed: {e}")
+        flush_logs()
+        sys.exit(1)
+    if not options.skip_analysis and not run_pipeline(['analysis'], services=services):
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
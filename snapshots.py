@@ -0,0 +1,154 @@
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+import duckdb
+
+from manifest import pending_partitions, mark_processed, reset_progress, get_fingerprint, set_fingerprint
+from result_cache import table_version
+from services import SERVICES
+
+# Read-only snapshots of the results for readers that must not wait on the
+# single DuckDB writer. A snapshot is a generation directory of Parquet files
+# plus a manifest, published at the end of a pipeline run and made current by
+# atomically replacing the CURRENT pointer file, so a reader sees either the
+# old generation or the new one, never a mix.
+#
+# The small result tables are exported whole into each generation.
+# trips_transform is exported per (service, year, month) partition into
+# immutable files under partitions/, in pickup order like the table (so their
+# row group statistics prune pickup ranges too), and only the partitions transformed
+# since the last publish are written again; unchanged ones are shared between
+# generations. The newest SNAPSHOT_KEEP generations are kept, so readers still
+# on an older one can finish.
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', '3'))
+SNAPSHOT_TABLES = ['trip_rollup_hourly', 'trip_rollup_daily', 'emissions_cube', 'trip_samples', 'sample_strata',
+                   'emissions_daily_series', 'emissions_hourly_series']
+PARTITIONED_TABLE = 'trips_transform'
+
+def ensure_snapshot_files(con):
+    # Latest exported file of every trips_transform partition
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS snapshot_files (
+        service_type VARCHAR, source_year SMALLINT, source_month UTINYINT, path VARCHAR,
+        PRIMARY KEY (service_type, source_year, source_month)
+    );
+    """)
+
+def existing_tables(con, tables):
+    names = ", ".join(repr(t) for t in tables)
+    present = {row[0] for row in con.execute(f"SELECT table_name FROM duckdb_tables() WHERE table_name IN ({names});").fetchall()}
+    return [t for t in tables if t in present]
+
+def export_partitions(con, snapshot_dir):
+    # Write the partitions transformed since the last publish. Returns the
+    # number of files written.
+    ensure_snapshot_files(con)
+    written = 0
+    for service in SERVICES:
+        for year, month in pending_partitions(con, 'snapshot', service, upstream='transform'):
+            relative = os.path.join('partitions', service, f"{year}-{month:02d}-{uuid.uuid4().hex[:12]}.parquet")
+            os.makedirs(os.path.dirname(os.path.join(snapshot_dir, relative)), exist_ok=True)
+            con.execute(f"""
+            COPY (
+                SELECT * FROM {PARTITIONED_TABLE}
+                WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month}
+                ORDER BY pickup_datetime
+            ) TO '{os.path.join(snapshot_dir, relative)}' (FORMAT parquet);
+            """)
+            con.execute("INSERT OR REPLACE INTO snapshot_files VALUES (?, ?, ?, ?);", [service, year, month, relative])
+            mark_processed(con, 'snapshot', service, year, month)
+            written += 1
+    return written
+
+def publish_snapshot(con, snapshot_dir=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    # Export a new generation and make it current. Returns its name, or None
+    # when nothing changed since the last one.
+    tables = existing_tables(con, SNAPSHOT_TABLES + [PARTITIONED_TABLE])
+    if not tables:
+        return None
+    version = table_version(con, tables)
+    if get_fingerprint(con, 'snapshot') == version and current_generation(snapshot_dir):
+        return None
+
+    if not generations(snapshot_dir):
+        # First publish into this directory: every partition file is needed
+        for service in SERVICES:
+            reset_progress(con, 'snapshot', service)
+
+    generation = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    staging = os.path.join(snapshot_dir, f".{generation}.tmp")
+    os.makedirs(staging)
+    manifest = {'generation': generation, 'published_at': datetime.now().isoformat(), 'tables': {}}
+    for table in tables:
+        if table == PARTITIONED_TABLE:
+            continue
+        con.execute(f"COPY {table} TO '{os.path.join(staging, table + '.parquet')}' (FORMAT parquet);")
+        manifest['tables'][table] = [os.path.join(generation, f"{table}.parquet")]
+    if PARTITIONED_TABLE in tables:
+        export_partitions(con, snapshot_dir)
+        manifest['tables'][PARTITIONED_TABLE] = [
+            row[0] for row in con.execute("SELECT path FROM snapshot_files ORDER BY ALL;").fetchall()
+        ]
+    with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # The directory is complete before it gets its name, and CURRENT moves
+    # to it in one rename
+    os.rename(staging, os.path.join(snapshot_dir, generation))
+    pointer = os.path.join(snapshot_dir, f".CURRENT.{uuid.uuid4().hex}")
+    with open(pointer, 'w') as f:
+        f.write(generation)
+    os.replace(pointer, os.path.join(snapshot_dir, 'CURRENT'))
+    set_fingerprint(con, 'snapshot', version)
+    prune_snapshots(snapshot_dir, keep)
+    return generation
+
+def generations(snapshot_dir=SNAPSHOT_DIR):
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return sorted(name for name in os.listdir(snapshot_dir) if os.path.exists(os.path.join(snapshot_dir, name, 'manifest.json')))
+
+def read_manifest(snapshot_dir, generation):
+    with open(os.path.join(snapshot_dir, generation, 'manifest.json')) as f:
+        return json.load(f)
+
+def prune_snapshots(snapshot_dir=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    # Drop all but the newest `keep` generations, then every partition file
+    # none of the remaining ones uses
+    kept = generations(snapshot_dir)[-keep:]
+    for generation in generations(snapshot_dir)[:-keep]:
+        shutil.rmtree(os.path.join(snapshot_dir, generation), ignore_errors=True)
+    used = set()
+    for generation in kept:
+        used.update(read_manifest(snapshot_dir, generation)['tables'].get(PARTITIONED_TABLE, []))
+    partitions = os.path.join(snapshot_dir, 'partitions')
+    for root, _, files in os.walk(partitions):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, snapshot_dir) not in used:
+                os.remove(path)
+
+def current_generation(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def open_snapshot(snapshot_dir=SNAPSHOT_DIR, generation=None, threads=None):
+    # In-memory DuckDB database with one view per snapshot table over the
+    # generation's Parquet files. Nothing is copied; readers never touch
+    # emissions.duckdb. Returns (generation, connection).
+    generation = generation or current_generation(snapshot_dir)
+    if generation is None:
+        raise FileNotFoundError(f"No snapshot has been published in {snapshot_dir}")
+    con = duckdb.connect(':memory:', config={'threads': threads} if threads else {})
+    for table, files in read_manifest(snapshot_dir, generation)['tables'].items():
+        if files:
+            paths = ", ".join(repr(os.path.abspath(os.path.join(snapshot_dir, path))) for path in files)
+            con.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet([{paths}]);")
+    return generation, con
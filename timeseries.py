@@ -0,0 +1,123 @@
+import os
+
+from manifest import pending_partitions, mark_processed, reset_progress, get_fingerprint, set_fingerprint
+
+# Daily and hourly emissions time series per service, with rolling 7 and
+# 28-day means, a z-score anomaly flag and year-over-year deltas. Both are
+# computed with window functions over the rollups, never over trips, and are
+# extended incrementally: when months are merged into the rollups, only the
+# series rows from the earliest day those months touch onwards are computed
+# again, reading the rollups back just far enough to fill their windows.
+#
+# A day's z-score compares its CO2 total with the BASELINE_DAYS before it (not
+# including itself); an hour is compared with the same hour of day on those
+# days, and its rolling means are over that hour of day too. Year-over-year
+# compares with 52 weeks earlier, so weekdays line up.
+ANOMALY_Z = float(os.environ.get('ANOMALY_Z', '3'))
+BASELINE_DAYS = 28
+MIN_BASELINE_POINTS = 14
+YOY_DAYS = 364
+
+# table: (time column, its type, its value in the rollup, rollup, window partition)
+SERIES = {
+    'emissions_daily_series': ('trip_date', 'DATE', 'trip_date', 'trip_rollup_daily', ''),
+    'emissions_hourly_series': ('trip_hour', 'TIMESTAMP', 'trip_date + to_hours(hour_of_day)', 'trip_rollup_hourly', 'PARTITION BY hour(trip_hour)'),
+}
+
+def settings_fingerprint():
+    return f"{ANOMALY_Z}:{BASELINE_DAYS}:{MIN_BASELINE_POINTS}:{YOY_DAYS}"
+
+def ensure_timeseries(con):
+    # Changed anomaly settings recompute every series from scratch
+    for table, (key, key_type, *_) in SERIES.items():
+        con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            service_type VARCHAR, {key} {key_type},
+            trips BIGINT, co2_kg DOUBLE,
+            co2_7d_mean DOUBLE, co2_28d_mean DOUBLE,
+            co2_zscore DOUBLE, anomaly BOOLEAN,
+            co2_yoy_delta DOUBLE, co2_yoy_change DOUBLE,
+            PRIMARY KEY (service_type, {key})
+        );
+        """)
+    if get_fingerprint(con, 'timeseries') != settings_fingerprint():
+        for (service,) in con.execute("SELECT DISTINCT service_type FROM stage_progress WHERE stage = 'timeseries';").fetchall():
+            rebuild_timeseries(con, service)
+        set_fingerprint(con, 'timeseries', settings_fingerprint())
+
+def series_sql(service, start, key, key_type, key_sql, rollup, partition):
+    # Rows of one series from `start` (None: the whole history) onwards
+    lookback = f"AND trip_date >= DATE '{start}' - INTERVAL {max(YOY_DAYS, BASELINE_DAYS)} DAY" if start else ""
+    return f"""
+    WITH points AS (
+        SELECT ({key_sql})::{key_type} AS {key}, SUM(trip_count) AS trips, SUM(co2_kg_sum) AS co2_kg
+        FROM {rollup}
+        WHERE service_type = '{service}' {lookback}
+        GROUP BY ALL
+    ), windows AS (
+        SELECT *,
+               avg(co2_kg) OVER ({partition} ORDER BY {key} RANGE BETWEEN INTERVAL 6 DAY PRECEDING AND CURRENT ROW) AS co2_7d_mean,
+               avg(co2_kg) OVER ({partition} ORDER BY {key} RANGE BETWEEN INTERVAL 27 DAY PRECEDING AND CURRENT ROW) AS co2_28d_mean,
+               avg(co2_kg) OVER baseline AS baseline_mean,
+               stddev_samp(co2_kg) OVER baseline AS baseline_std,
+               count(*) OVER baseline AS baseline_points
+        FROM points
+        WINDOW baseline AS ({partition} ORDER BY {key} RANGE BETWEEN INTERVAL {BASELINE_DAYS} DAY PRECEDING AND INTERVAL 1 DAY PRECEDING)
+    ), scored AS (
+        SELECT *,
+               CASE WHEN baseline_points >= {MIN_BASELINE_POINTS} AND baseline_std > 0
+                    THEN (co2_kg - baseline_mean) / baseline_std END AS co2_zscore
+        FROM windows
+    )
+    SELECT '{service}', s.{key}, s.trips, s.co2_kg, s.co2_7d_mean, s.co2_28d_mean,
+           s.co2_zscore, coalesce(abs(s.co2_zscore) >= {ANOMALY_Z}, false),
+           s.co2_kg - y.co2_kg, (s.co2_kg - y.co2_kg) / nullif(y.co2_kg, 0)
+    FROM scored s
+    LEFT JOIN points y ON y.{key} = (s.{key} - INTERVAL {YOY_DAYS} DAY)::{key_type}
+    {f"WHERE s.{key} >= DATE '{start}'" if start else ""}
+    """
+
+def series_start(con, service, partitions):
+    # Earliest day whose series rows can change with these rollup partitions:
+    # the first day of the earliest month, or an earlier pickup date filed in
+    # one of them. None when the series has never been built, which builds it
+    # over the whole history.
+    built = con.execute("""
+    SELECT COUNT(*) FROM stage_progress WHERE stage = 'timeseries' AND service_type = ?;
+    """, [service]).fetchone()[0]
+    if not built:
+        return None
+    months = ", ".join(f"({year}, {month})" for year, month in partitions)
+    return con.execute(f"""
+    SELECT least(min(make_date(year, month, 1)), (
+        SELECT min(trip_date) FROM trip_rollup_daily
+        WHERE service_type = '{service}' AND (source_year, source_month) IN ({months})
+    ))
+    FROM (VALUES {months}) m(year, month);
+    """).fetchone()[0]
+
+def update_timeseries(con, service):
+    # Extend both series with every month merged into the rollups since they
+    # were last updated, in one transaction. Returns those partitions.
+    partitions = pending_partitions(con, 'timeseries', service, upstream='rollup')
+    if not partitions:
+        return partitions
+    start = series_start(con, service, partitions)
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        for table, (key, *spec) in SERIES.items():
+            con.execute(f"""
+            DELETE FROM {table} WHERE service_type = '{service}' {f"AND {key} >= DATE '{start}'" if start else ""};
+            """)
+            con.execute(f"INSERT INTO {table} {series_sql(service, start, key, *spec)};")
+        for year, month in partitions:
+            mark_processed(con, 'timeseries', service, year, month)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    return partitions
+
+def rebuild_timeseries(con, service):
+    # Forget the service's progress so the next update rebuilds its series
+    reset_progress(con, 'timeseries', service)
@@ -1,11 +1,19 @@
-import duckdb
+import hashlib
 import logging
-import pandas as pd
+
+from database import connect
+from instrument import tagged, flush_metrics
+from emissions import EMISSIONS_CSV, co2_kg_sql, emission_factors_sql, ensure_vehicle_emissions
+from manifest import ensure_manifest, pending_partitions, mark_processed, reset_progress, get_fingerprint, set_fingerprint
+from rollups import ensure_rollups, update_rollups, rebuild_rollups
+from samples import ensure_samples, update_samples, rebuild_samples
+from services import SERVICES, ENABLED_SERVICES, TRIP_COLUMNS, ensure_service_type, ensure_pickup_order, trip_columns_ddl
+from timeseries import ensure_timeseries, update_timeseries, rebuild_timeseries
 
 logging.basicConfig(
     level=logging.INFO, 
     format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='load.log',
+    filename='transform.log',
     filemode='a',
     force=True
 )
@@ -22,75 +30,160 @@ def flush_logs():
     for handler in logger.handlers:
         handler.flush()
 
-def transform_data():
+TRIP_FIELDS = "service_type, source_year, source_month, " + ", ".join(TRIP_COLUMNS)
+
+# Derived columns of trips_transform: (type, expression). Calendar fields are
+# stored as one-byte integers or an ENUM and the per-trip measures as 4-byte
+# FLOATs, which keeps ~7 significant digits, plenty for kg and mph.
+WEEKDAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+DERIVED_COLUMNS = {
+    'trip_co2_kgs': ('FLOAT', co2_kg_sql('trip_distance', 'trip_mph')),
+    'avg_mph': ('FLOAT', "trip_mph"),
+    'hour_of_day': ('UTINYINT', "hour(pickup_datetime)"),
+    'day_of_week': ('weekday', "dayname(pickup_datetime)"),
+    'week_of_year': ('UTINYINT', "week(pickup_datetime)"),
+    'month_of_year': ('UTINYINT', "month(pickup_datetime)"),
+}
+
+def ensure_transform_table(con):
+    # Create trips_transform with the compact schema. A table with any other
+    # layout (e.g. the older VARCHAR/INTEGER calendar columns) is dropped and
+    # every month is transformed again.
+    con.execute(f"CREATE TYPE IF NOT EXISTS weekday AS ENUM ({', '.join(repr(d) for d in WEEKDAYS)});")
+    con.execute(f"CREATE TABLE IF NOT EXISTS trips_transform ({transform_columns_ddl()});")
+    current = con.execute("""
+    SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = 'trips_transform' ORDER BY column_index;
+    """).fetchall()
+    expected = [(name, 'ENUM' if sql_type == 'weekday' else sql_type) for name, (sql_type, _) in DERIVED_COLUMNS.items()]
+    if [(name, 'ENUM' if data_type.startswith('ENUM') else data_type) for name, data_type in current[-len(expected):]] != expected:
+        con.execute("DROP TABLE trips_transform;")
+        con.execute(f"CREATE TABLE trips_transform ({transform_columns_ddl()});")
+        for service in SERVICES:
+            reset_progress(con, 'transform', service)
+            rebuild_rollups(con, service)
+            rebuild_samples(con, service)
+
+def transform_columns_ddl():
+    return f"{trip_columns_ddl()}, " + ", ".join(f"{name} {sql_type}" for name, (sql_type, _) in DERIVED_COLUMNS.items())
+
+def transform_select():
+    return ", ".join(f"({expression})::{sql_type} AS {name}" for name, (sql_type, expression) in DERIVED_COLUMNS.items())
+
+def transform_source_sql(where, trips='trips_clean'):
+    # Clean trips joined to their service's vehicle_emissions row, with the
+    # average speed computed once for both avg_mph and the emissions model
+    return f"""
+    SELECT t.*, e.co2_grams_per_mile, e.city_kg_per_mile, e.highway_delta_kg_per_mile,
+           t.trip_distance / NULLIF(date_diff('second', t.pickup_datetime, t.dropoff_datetime) / 3600.0, 0) AS trip_mph
+    FROM {trips} t
+    JOIN service_types s ON s.service_type = t.service_type::VARCHAR
+    JOIN ({emission_factors_sql()}) e ON e.vehicle_type = s.vehicle_type
+    WHERE {where}
+    """
+
+def model_fingerprint(path=EMISSIONS_CSV):
+    digest = hashlib.sha256(repr(DERIVED_COLUMNS).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def transform_partition(con, service, year, month):
+    # Replace one source month of the transform table in a single transaction
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"""
+            DELETE FROM trips_transform WHERE service_type = '{service}' AND source_year = {year} AND source_month = {month};
+        """)
+        # Calculate CO2 emissions, average speed, trip hour, trip day, trip week, trip month,
+        # written in pickup order so pickup range filters prune
+        con.execute(f"""
+            INSERT INTO trips_transform ({TRIP_FIELDS}, {", ".join(DERIVED_COLUMNS)})
+            SELECT {TRIP_FIELDS}, {transform_select()}
+            FROM ({transform_source_sql(f"t.service_type = '{service}' AND t.source_year = {year} AND t.source_month = {month}")}) e
+            ORDER BY pickup_datetime;
+        """)
+        mark_processed(con, 'transform', service, year, month)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+def prepare_transform(con):
+    # The transform table is maintained one (service, source month) at a time
+    ensure_manifest(con)
+    ensure_service_type(con)
+    ensure_transform_table(con)
+    ensure_pickup_order(con, 'trips_transform')
+
+    # Emission factors are joined from the vehicle_emissions table
+    ensure_vehicle_emissions(con)
+
+    # A changed emissions CSV or model re-transforms every month
+    fingerprint = model_fingerprint()
+    if get_fingerprint(con, 'transform_model') != fingerprint:
+        for service in SERVICES:
+            reset_progress(con, 'transform', service)
+            rebuild_rollups(con, service)
+            rebuild_samples(con, service)
+            rebuild_timeseries(con, service)
+        set_fingerprint(con, 'transform_model', fingerprint)
+        logger.info("Emissions model or lookup changed; all months will be transformed again")
+        flush_logs()
+
+    # Rollups, samples and the daily/hourly series over the rollups are shared
+    # by every service, so they are created here, before the services are
+    # transformed concurrently
+    ensure_rollups(con)
+    ensure_samples(con)
+    ensure_timeseries(con)
+
+def transform_service(con, service):
+    vehicle_type = SERVICES[service]['vehicle_type']
+    known = con.execute("SELECT COUNT(*) FROM vehicle_emissions WHERE vehicle_type = ?;", [vehicle_type]).fetchone()[0]
+    if not known:
+        raise ValueError(f"No vehicle_emissions row for {service} (vehicle_type {vehicle_type})")
+
+    # Only months cleaned since the last transform are processed
+    for year, month in pending_partitions(con, 'transform', service, upstream='clean'):
+        logger.info(f"Transforming {service} trip data for {year}-{month:02d}")
+        flush_logs()
+        with tagged(con, source_year=year, source_month=month):
+            transform_partition(con, service, year, month)
+        logger.info(f"Transformed {service} trip data for {year}-{month:02d}")
+        flush_logs()
+
+    # Merge the newly transformed months into the hourly/daily rollups
+    merged = update_rollups(con, service)
+    logger.info(f"Merged {len(merged)} {service} months into the rollup tables")
+    flush_logs()
+
+    # Re-sample the same months for approximate analysis
+    sampled = update_samples(con, service)
+    logger.info(f"Sampled {len(sampled)} {service} months into trip_samples")
+    flush_logs()
+
+    # Extend the emissions time series from the earliest changed day
+    extended = update_timeseries(con, service)
+    logger.info(f"Extended the {service} emissions time series with {len(extended)} months")
+    flush_logs()
+
+def transform_data(services=ENABLED_SERVICES):
     con = None
 
     try:
         # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
+        con = connect(stage='transform')
         logger.info("Connected to DuckDB instance")
         flush_logs()
 
-        # Drop existing transform tables if they exist
-        con.execute("DROP TABLE IF EXISTS yellow_tripdata_transform;")
-        con.execute("DROP TABLE IF EXISTS green_tripdata_transform;")
-        logger.info("Dropped existing transform tables if they existed")
-        flush_logs()
-
-        
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS yellow_tripdata_transform (VendorID INTEGER, tpep_pickup_datetime TIMESTAMP, tpep_dropoff_datetime TIMESTAMP, passenger_count INTEGER, trip_distance DOUBLE, co2_kg DOUBLE, avg_mph DOUBLE, trip_hours DOUBLE, trip_day INTEGER, trip_week INTEGER, trip_month INTEGER);
-        """)
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS green_tripdata_transform (VendorID INTEGER, lpep_pickup_datetime TIMESTAMP, lpep_dropoff_datetime TIMESTAMP, passenger_count INTEGER, trip_distance DOUBLE, co2_kg DOUBLE, avg_mph DOUBLE, trip_hours DOUBLE, trip_day INTEGER, trip_week INTEGER, trip_month INTEGER);
-        """)
-        logger.info("Initialized transform tables")
+        prepare_transform(con)
+        logger.info("Initialized transform table")
         flush_logs()
 
-        df = pd.read_csv('data/vehicle_emissions.csv')
-        yellow_co2_per_mile = df[df['vehicle_type'] == 'yellow_taxi']['co2_grams_per_mile'].values[0]
-        green_co2_per_mile = df[df['vehicle_type'] == 'green_taxi']['co2_grams_per_mile'].values[0]
-
-        for year in range(2015, 2025):
-            logger.info(f"Transforming data for year {year}")
-            flush_logs()
-
-                        
-            con.execute(f"""
-                INSERT INTO yellow_tripdata_transform
-                SELECT *,
-                       (trip_distance * {yellow_co2_per_mile}) AS trip_co2_kgs,
-                        (trip_distance)/NULLIF((EXTRACT(EPOCH FROM (tpep_dropoff_datetime - tpep_pickup_datetime)) / 3600), 0) AS avg_mph,
-                        (EXTRACT(HOUR FROM tpep_pickup_datetime)) AS hour_of_day,
-                        (strftime('%A', tpep_pickup_datetime)) AS day_of_week,
-                        (EXTRACT(WEEK FROM tpep_pickup_datetime)) AS week_of_year,
-                        (strftime('%m', tpep_pickup_datetime)) AS month_of_year
-                FROM yellow_tripdata_clean
-                WHERE EXTRACT(YEAR FROM tpep_pickup_datetime) = {year};
-            """)
-            logger.info(f"Transformed yellow trip data for year {year}")
-            flush_logs()
-
-            logger.info(f"Transforming green trip data for year {year}")
-            flush_logs()
-
-            # Calculate CO2 emissions, average speed, trip duration in hours, trip day, trip week, trip month
-            con.execute(f"""
-                INSERT INTO green_tripdata_transform
-                SELECT *,
-                       (trip_distance * {green_co2_per_mile}) AS trip_co2_kgs,
-                        (trip_distance)/NULLIF((EXTRACT(EPOCH FROM (lpep_dropoff_datetime - lpep_pickup_datetime)) / 3600), 0) AS avg_mph,
-                        (EXTRACT(HOUR FROM lpep_pickup_datetime)) AS hour_of_day,
-                        (strftime('%A', lpep_pickup_datetime)) AS day_of_week,
-                        (EXTRACT(WEEK FROM lpep_pickup_datetime)) AS week_of_year,
-                        (strftime('%m', lpep_pickup_datetime)) AS month_of_year
-                FROM green_tripdata_clean
-                WHERE EXTRACT(YEAR FROM lpep_pickup_datetime) = {year};
-            """)
-            logger.info(f"Transformed green trip data for year {year}")
-            flush_logs()
-        
-            
+        for service in services:
+            with tagged(con, service=service):
+                transform_service(con, service)
+        flush_metrics(con)
 
     except Exception as e:
         logger.error(f"An error occurred: {e}")